@@ -0,0 +1,144 @@
+import json
+import os
+import time
+
+from perf import get_tracer
+
+# The Batch API accepts at most 50,000 requests and 200 MB per input file
+MAX_REQUESTS_PER_FILE = 50000
+MAX_BYTES_PER_FILE = 190 * 1024 * 1024
+POLL_INTERVAL = 30  # Seconds between batch status checks
+TERMINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+CHAT_COMPLETIONS_ENDPOINT = "/v1/chat/completions"
+
+
+# Function to write (custom_id, payload) pairs into one or more JSONL batch input files
+def write_batch_files(batch_requests, batch_folder, max_requests=MAX_REQUESTS_PER_FILE, max_bytes=MAX_BYTES_PER_FILE):
+    os.makedirs(batch_folder, exist_ok=True)
+    batch_files = []
+    batch_file = None
+    count = size = 0
+
+    for custom_id, payload in batch_requests:
+        line = json.dumps({"custom_id": custom_id, "method": "POST", "url": CHAT_COMPLETIONS_ENDPOINT, "body": payload}) + "\n"
+        line_size = len(line.encode("utf-8"))
+        if batch_file is None or count >= max_requests or size + line_size > max_bytes:
+            if batch_file is not None:
+                batch_file.close()
+            batch_files.append(os.path.join(batch_folder, f"input-{len(batch_files) + 1:04d}.jsonl"))
+            batch_file = open(batch_files[-1], "w")
+            count = size = 0
+        batch_file.write(line)
+        count += 1
+        size += line_size
+
+    if batch_file is not None:
+        batch_file.close()
+    return batch_files
+
+
+class BatchClient:
+    """Minimal client for the files and batches endpoints; `api_base` can point at a local stub server."""
+
+    def __init__(self, api_base, api_key, timeout=300):
+        import requests
+
+        self.api_base = api_base.rstrip("/")
+        self.session = requests.Session()
+        self.session.headers["Authorization"] = f"Bearer {api_key}"
+        self.timeout = timeout
+
+    def _request(self, method, path, **kwargs):
+        response = self.session.request(method, f"{self.api_base}{path}", timeout=self.timeout, **kwargs)
+        response.raise_for_status()
+        return response
+
+    def upload_file(self, path):
+        with open(path, "rb") as batch_file:
+            response = self._request("POST", "/files", data={"purpose": "batch"}, files={"file": (os.path.basename(path), batch_file)})
+        return response.json()["id"]
+
+    def create_batch(self, input_file_id):
+        response = self._request("POST", "/batches", json={
+            "input_file_id": input_file_id,
+            "endpoint": CHAT_COMPLETIONS_ENDPOINT,
+            "completion_window": "24h",
+        })
+        return response.json()["id"]
+
+    def get_batch(self, batch_id):
+        return self._request("GET", f"/batches/{batch_id}").json()
+
+    def file_lines(self, file_id):
+        response = self._request("GET", f"/files/{file_id}/content")
+        for line in response.text.splitlines():
+            if line.strip():
+                yield json.loads(line)
+
+
+# Helper function to pull the completion text (or "DUMMY") out of one batch output line
+def _batch_line_content(line):
+    response = line.get("response") or {}
+    body = response.get("body") or {}
+    if response.get("status_code") == 200 and body.get("choices"):
+        get_tracer().count_usage(body.get("usage"))
+        return body["choices"][0]["message"]["content"].strip()
+    error = line.get("error") or body.get("error")
+    print(f"Error: Batch request {line.get('custom_id')} failed - {error}")
+    return "DUMMY"
+
+
+def run_batch_job(batch_requests, batch_folder, api_base, api_key, poll_interval=POLL_INTERVAL, requests_key=None):
+    """
+    Submit (custom_id, payload) pairs through the Batch API and return {custom_id: content}.
+
+    Submitted batch ids are recorded in batch_folder/state.json, so re-running with the
+    same folder (e.g. after the process was stopped while polling) picks up the batches
+    already in flight instead of submitting and paying for them again. The state is only
+    reused while `requests_key` (an id of the pending request set) matches the one it was
+    saved with; otherwise the input files are rewritten and submitted afresh.
+    """
+    client = BatchClient(api_base, api_key)
+    state_path = os.path.join(batch_folder, "state.json")
+    state = {}
+    if os.path.exists(state_path):
+        with open(state_path, "r") as f:
+            state = json.load(f)
+        if state.get("requests_key") != requests_key:
+            print(f"Ignoring {state_path}: it was written for a different set of pending requests")
+            state = {}
+
+    # Input files are written once; each is then submitted exactly once and its batch id saved immediately
+    if "input_files" not in state:
+        state["input_files"] = write_batch_files(batch_requests, batch_folder)
+        state["batches"] = {}
+        state["requests_key"] = requests_key
+    elif state["batches"]:
+        print(f"Resuming {len(state['batches'])} batches recorded in {state_path}")
+
+    for input_file in state["input_files"]:
+        if input_file in state["batches"]:
+            continue
+        batch_id = client.create_batch(client.upload_file(input_file))
+        print(f"Submitted {input_file} as batch {batch_id}")
+        state["batches"][input_file] = batch_id
+        with open(state_path, "w") as f:
+            json.dump(state, f, indent=4)
+
+    contents = {}
+    for batch_id in state["batches"].values():
+        batch = client.get_batch(batch_id)
+        while batch["status"] not in TERMINAL_STATUSES:
+            counts = batch.get("request_counts") or {}
+            print(f"Batch {batch_id} is {batch['status']} ({counts.get('completed', 0)}/{counts.get('total', '?')} done)")
+            time.sleep(poll_interval)
+            batch = client.get_batch(batch_id)
+
+        if batch["status"] != "completed":
+            print(f"Error: Batch {batch_id} ended with status '{batch['status']}'")
+        for file_key in ("output_file_id", "error_file_id"):
+            if batch.get(file_key):
+                for line in client.file_lines(batch[file_key]):
+                    contents[line["custom_id"]] = _batch_line_content(line)
+
+    return contents
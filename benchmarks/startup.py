@@ -0,0 +1,109 @@
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Cold-start commands: every CLI subcommand's --help (parsing its options loads the module and its eager imports),
+# the import a spawned pool worker pays, and the bare interpreter as the floor everything else sits on
+COMMANDS = {
+    "interpreter": ["-c", "pass"],
+    "cli": ["-m", "cli", "--help"],
+    "eval": ["-m", "cli", "eval", "--help"],
+    "metadata": ["-m", "cli", "metadata", "--help"],
+    "loader": ["-m", "cli", "loader", "--help"],
+    "download": ["-m", "cli", "download", "--help"],
+    "pool-worker": ["-c", "import prompt_eval"],
+}
+
+# Dependencies that must only be loaded by the code paths that use them
+HEAVY_MODULES = ("pandas", "sklearn", "openai", "aiohttp", "requests", "tqdm", "PIL")
+MIN_REGRESSION_MS = 10  # Slowdowns smaller than this are process-startup noise, whatever the tolerance
+
+IMPORT_TIME_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( +)(\S+)")
+
+
+# Function to time one cold start of a command, in milliseconds
+def time_command(arguments):
+    started = time.perf_counter()
+    subprocess.run([sys.executable] + arguments, cwd=REPO_ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+    return (time.perf_counter() - started) * 1000
+
+
+# Function to run a command under -X importtime; returns (heavy modules it loaded, its slowest top-level imports)
+def import_profile(arguments, top=5):
+    completed = subprocess.run([sys.executable, "-X", "importtime"] + arguments, cwd=REPO_ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    heavy, top_level = set(), []
+    for match in IMPORT_TIME_LINE.finditer(completed.stderr):
+        _, cumulative, indent, name = match.groups()
+        root = name.split(".")[0]
+        if root in HEAVY_MODULES:
+            heavy.add(root)
+        if len(indent) == 1:
+            top_level.append((int(cumulative) / 1000, name))
+    slowest = [f"{name} {milliseconds:.0f}ms" for milliseconds, name in sorted(top_level, reverse=True)[:top]]
+    return sorted(heavy), slowest
+
+
+# Function to compare results with a saved baseline and list commands that start slower or load new heavy modules
+def find_regressions(results, baseline_file, tolerance):
+    with open(baseline_file, "r") as f:
+        baseline = {row["command"]: row for row in json.load(f)["results"]}
+    regressions = []
+    for row in results:
+        previous = baseline.get(row["command"])
+        if not previous:
+            continue
+        if row["median_ms"] > previous["median_ms"] * (1 + tolerance) + MIN_REGRESSION_MS:
+            regressions.append(f"{row['command']}: {row['median_ms']}ms vs {previous['median_ms']}ms in the baseline")
+        new_heavy = sorted(set(row["heavy_imports"]) - set(previous["heavy_imports"]))
+        if new_heavy:
+            regressions.append(f"{row['command']}: now imports {', '.join(new_heavy)} at startup")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cold-start benchmark of the CLI entry points.")
+    parser.add_argument('--commands', nargs='+', choices=list(COMMANDS), default=list(COMMANDS), help="Commands to time.")
+    parser.add_argument('--repeats', type=int, default=7, help="Cold starts per command; the median is reported.")
+    parser.add_argument('--output', type=str, default=None, help="Write the results as JSON to this file.")
+    parser.add_argument('--baseline', type=str, default=None, help="Earlier --output file; exit non-zero if a command got slower by more than --tolerance or loads a heavy module it didn't.")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="Allowed fractional increase in median startup time against the baseline.")
+    args = parser.parse_args()
+
+    results = []
+    print(f"{'command':<12} {'median':>8} {'min':>8}  heavy imports / slowest top-level imports")
+    for command in args.commands:
+        arguments = COMMANDS[command]
+        time_command(arguments)  # Warm the OS file cache and __pycache__ so every measured start is comparable
+        timings = [time_command(arguments) for _ in range(args.repeats)]
+        heavy, slowest = import_profile(arguments)
+        row = {
+            "command": command,
+            "argv": ["python"] + arguments,
+            "median_ms": round(statistics.median(timings), 1),
+            "min_ms": round(min(timings), 1),
+            "heavy_imports": heavy,
+            "slowest_imports": slowest,
+        }
+        results.append(row)
+        print(f"{command:<12} {row['median_ms']:>6.0f}ms {row['min_ms']:>6.0f}ms  {', '.join(heavy) or '-'} / {', '.join(slowest) or '-'}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"settings": vars(args), "python": sys.version.split()[0], "results": results}, f, indent=4)
+    if args.baseline:
+        regressions = find_regressions(results, args.baseline, args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,224 @@
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import requests
+
+from mock_openai_server import start_mock_server
+
+try:
+    from PIL import Image
+except ImportError:  # Without Pillow the synthetic images are random bytes (fine unless --preprocess is benchmarked)
+    Image = None
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# USD per million (prompt, completion) tokens; the Batch API bills half
+PRICES_PER_MILLION = {
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4": (30.00, 60.00),
+}
+BATCH_DISCOUNT = 0.5
+RSS_SAMPLE_INTERVAL = 0.05  # Seconds between memory samples of the benchmarked process tree
+
+# Execution modes: (script, extra arguments). Every prompt_eval mode runs with --no_cache except replay.
+MODES = {
+    "async": ("prompt_eval.py", ["--engine", "async", "--no_cache"]),
+    "async-c64": ("prompt_eval.py", ["--engine", "async", "--no_cache", "--max_concurrency", "64"]),
+    "pool": ("prompt_eval.py", ["--engine", "pool", "--no_cache"]),
+    "multi-image": ("prompt_eval.py", ["--engine", "async", "--no_cache", "--images_per_request", "4"]),
+    "batch-api": ("prompt_eval.py", ["--engine", "batch", "--no_cache", "--batch_poll_interval", "0.5"]),
+    "replay": ("prompt_eval.py", ["--engine", "async", "--replay"]),
+    "metadata": ("prompt_metadata_gen.py", []),
+    "download": ("Image-downloader.py", []),
+}
+
+
+# Function to write a synthetic labeled image dataset, prompt folder and URL list into the work folder
+def build_workload(work_folder, api_base, num_images, num_prompts, seed=0):
+    rng = np.random.default_rng(seed)
+    image_folder = os.path.join(work_folder, "images")
+    prompts_folder = os.path.join(work_folder, "prompts")
+    os.makedirs(image_folder, exist_ok=True)
+    os.makedirs(prompts_folder, exist_ok=True)
+
+    rows = ["image_path,label"]
+    for i in range(num_images):
+        image_path = os.path.join(image_folder, f"image{i:06d}.jpg")
+        pixels = rng.integers(0, 256, (64, 64, 3), dtype=np.uint8)
+        if Image is not None:
+            Image.fromarray(pixels).resize((512, 512)).save(image_path, format="JPEG", quality=90)
+        else:
+            with open(image_path, "wb") as f:
+                f.write(pixels.tobytes())
+        rows.append(f"{image_path},{'offensive' if rng.random() < 0.3 else 'not_offensive'}")
+    with open(os.path.join(work_folder, "dataset.csv"), "w") as f:
+        f.write("\n".join(rows) + "\n")
+
+    for i in range(num_prompts):
+        with open(os.path.join(prompts_folder, f"Prompt{i + 1}.txt"), "w") as f:
+            f.write(f"Benchmark prompt {i + 1}. Decide whether the product image is offensive under the safety guidelines. " * 20)
+
+    # Image-downloader.py reads image_urls.txt from its working directory
+    with open(os.path.join(work_folder, "image_urls.txt"), "w") as f:
+        f.write("\n".join(f"{api_base.rsplit('/v1', 1)[0]}/images/{i:06d}.jpeg" for i in range(num_images)) + "\n")
+
+
+# Function to build the command line for one mode
+def mode_command(mode, work_folder, api_base, client_rpm, client_tpm):
+    script, extra = MODES[mode]
+    command = [sys.executable, os.path.join(REPO_ROOT, script)]
+    if script == "prompt_eval.py":
+        command += ["--dataset", os.path.join(work_folder, "dataset.csv"), "--prompts_folder", os.path.join(work_folder, "prompts"),
+                    "--results_folder", os.path.join(work_folder, "results", mode), "--runs_folder", os.path.join(work_folder, "runs"),
+                    "--cache_path", os.path.join(work_folder, "responses.sqlite3"), "--api_base", api_base,
+                    "--rpm", str(client_rpm), "--tpm", str(client_tpm)] + extra
+    elif script == "prompt_metadata_gen.py":
+        command += ["--prompts_folder", os.path.join(work_folder, "prompts"), "--output_file", os.path.join(work_folder, f"metadata-{time.time_ns()}.csv")]
+    return command
+
+
+# Function to read the resident set size (MB) of a process and all of its descendants from /proc
+def process_tree_rss_mb(pid):
+    total = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        try:
+            with open(f"/proc/{current}/status", "r") as f:
+                total += next((int(line.split()[1]) for line in f if line.startswith("VmRSS:")), 0)
+            for task in os.listdir(f"/proc/{current}/task"):
+                with open(f"/proc/{current}/task/{task}/children", "r") as f:
+                    pending.extend(int(child) for child in f.read().split())
+        except (FileNotFoundError, ProcessLookupError, StopIteration):
+            continue
+    return total / 1024
+
+
+# Function to run one mode as a child process and measure wall time and peak RSS
+def run_mode(mode, work_folder, api_base, client_rpm, client_tpm):
+    environment = dict(os.environ, OPENAI_API_KEY=os.environ.get("OPENAI_API_KEY", "mock-key"), OPENAI_API_BASE=api_base)
+    cwd = os.path.join(work_folder, f"cwd-{mode}")
+    os.makedirs(cwd, exist_ok=True)
+    shutil.copy(os.path.join(work_folder, "image_urls.txt"), cwd)
+
+    start = time.perf_counter()
+    peak_rss_mb = 0.0
+    with open(os.path.join(work_folder, f"{mode}.log"), "w") as log:
+        process = subprocess.Popen(mode_command(mode, work_folder, api_base, client_rpm, client_tpm), cwd=cwd, env=environment, stdout=log, stderr=subprocess.STDOUT)
+        # Sample the whole process tree (pool workers included); ru_maxrss would also count the harness's own pages inherited at fork
+        while process.poll() is None:
+            if os.path.exists("/proc"):
+                peak_rss_mb = max(peak_rss_mb, process_tree_rss_mb(process.pid))
+            time.sleep(RSS_SAMPLE_INTERVAL)
+    return time.perf_counter() - start, peak_rss_mb, process.returncode
+
+
+# Function to turn the mock server's counters into one benchmark result row
+def summarize(mode, stats, elapsed, peak_rss_mb, returncode):
+    latencies = np.asarray(stats["latencies_ms"]) if stats["latencies_ms"] else np.zeros(1)
+    cost = 0.0
+    for model, usage in stats["tokens_by_model"].items():
+        prompt_price, completion_price = PRICES_PER_MILLION.get(model, (0.0, 0.0))
+        cost += (usage["prompt_tokens"] * prompt_price + usage["completion_tokens"] * completion_price) / 1e6
+    if mode == "batch-api":
+        cost *= BATCH_DISCOUNT
+    return {
+        "mode": mode,
+        "exit_code": returncode,
+        "seconds": round(elapsed, 3),
+        "requests": stats["requests"],
+        "requests_per_second": round(stats["requests"] / elapsed, 2) if elapsed else 0.0,
+        "responses": stats["responses"],
+        "p50_ms": round(float(np.percentile(latencies, 50)), 1),
+        "p99_ms": round(float(np.percentile(latencies, 99)), 1),
+        "peak_rss_mb": round(peak_rss_mb, 1),
+        "prompt_tokens": stats["prompt_tokens"],
+        "completion_tokens": stats["completion_tokens"],
+        "cost_usd": round(cost, 4),
+    }
+
+
+# Function to compare results with a saved baseline and list modes whose throughput regressed
+def find_regressions(results, baseline_file, tolerance):
+    with open(baseline_file, "r") as f:
+        baseline = {row["mode"]: row for row in json.load(f)["results"]}
+    regressions = []
+    for row in results:
+        previous = baseline.get(row["mode"])
+        if previous and previous["requests_per_second"] and row["requests_per_second"] < previous["requests_per_second"] * (1 - tolerance):
+            regressions.append(f"{row['mode']}: {row['requests_per_second']} req/s vs {previous['requests_per_second']} req/s in the baseline")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end throughput benchmark against the local mock OpenAI server.")
+    parser.add_argument('--modes', nargs='+', choices=list(MODES), default=list(MODES), help="Execution modes to benchmark.")
+    parser.add_argument('--images', type=int, default=200, help="Number of synthetic images in the dataset.")
+    parser.add_argument('--prompts', type=int, default=4, help="Number of prompt files.")
+    parser.add_argument('--latency_ms', type=float, default=100, help="Mean mock response latency in milliseconds.")
+    parser.add_argument('--latency_distribution', type=str, default='lognormal', help="Mock latency distribution (constant, uniform, exponential, lognormal).")
+    parser.add_argument('--rate_429', type=float, default=0.0, help="Fraction of mock responses that are injected 429s.")
+    parser.add_argument('--rate_5xx', type=float, default=0.0, help="Fraction of mock responses that are injected 503s.")
+    parser.add_argument('--server_rpm', type=int, default=None, help="Requests per minute enforced by the mock server.")
+    parser.add_argument('--server_tpm', type=int, default=None, help="Tokens per minute enforced by the mock server.")
+    parser.add_argument('--client_rpm', type=int, default=1000000, help="--rpm passed to prompt_eval so the benchmark isn't paced by the default model limits.")
+    parser.add_argument('--client_tpm', type=int, default=1000000000, help="--tpm passed to prompt_eval.")
+    parser.add_argument('--work_folder', type=str, default=None, help="Folder for the synthetic workload and logs (defaults to a temporary folder).")
+    parser.add_argument('--output', type=str, default=None, help="Write the results as JSON to this file.")
+    parser.add_argument('--baseline', type=str, default=None, help="Earlier --output file; exit non-zero if any mode's requests/sec dropped by more than --tolerance.")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="Allowed fractional drop in requests/sec against the baseline.")
+    parser.add_argument('--seed', type=int, default=0, help="Seed for the workload and the mock server.")
+    args = parser.parse_args()
+
+    server = start_mock_server(latency_ms=args.latency_ms, latency_distribution=args.latency_distribution, rate_429=args.rate_429,
+                               rate_5xx=args.rate_5xx, rpm=args.server_rpm, tpm=args.server_tpm, batch_delay=1.0, seed=args.seed)
+    server_url = f"http://127.0.0.1:{server.server_address[1]}"
+    api_base = f"{server_url}/v1"
+    work_folder = args.work_folder or tempfile.mkdtemp(prefix="prompt-eval-bench-")
+    os.makedirs(work_folder, exist_ok=True)
+    print(f"Building workload ({args.images} images, {args.prompts} prompts) in {work_folder}")
+    build_workload(work_folder, api_base, args.images, args.prompts, seed=args.seed)
+
+    results = []
+    try:
+        for mode in args.modes:
+            if mode == "replay" and not os.path.exists(os.path.join(work_folder, "responses.sqlite3")):
+                # Fill the cache first; only the replay pass itself is measured
+                fill_command = mode_command("async", work_folder, api_base, args.client_rpm, args.client_tpm)
+                subprocess.run([part for part in fill_command if part != "--no_cache"], cwd=work_folder, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                               env=dict(os.environ, OPENAI_API_KEY=os.environ.get("OPENAI_API_KEY", "mock-key")))
+
+            requests.post(f"{server_url}/stats/reset")
+            elapsed, peak_rss_mb, returncode = run_mode(mode, work_folder, api_base, args.client_rpm, args.client_tpm)
+            row = summarize(mode, requests.get(f"{server_url}/stats").json(), elapsed, peak_rss_mb, returncode)
+            results.append(row)
+            print(f"{mode:<12} {row['seconds']:>8.2f}s {row['requests']:>7} req {row['requests_per_second']:>9.1f} req/s "
+                  f"p50 {row['p50_ms']:>7.1f}ms p99 {row['p99_ms']:>7.1f}ms RSS {row['peak_rss_mb']:>7.1f}MB "
+                  f"tokens {row['prompt_tokens'] + row['completion_tokens']:>9} ${row['cost_usd']:.4f}"
+                  + (f"  (exit {returncode}, see {os.path.join(work_folder, mode + '.log')})" if returncode else ""))
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"settings": vars(args), "results": results}, f, indent=4)
+
+    if args.baseline:
+        regressions = find_regressions(results, args.baseline, args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,275 @@
+import argparse
+import io
+
+import numpy as np
+
+from metrics_engine import ABSTAINED, NOT_OFFENSIVE, OFFENSIVE, encode_prediction
+from sharding import stable_hash
+
+DEFAULT_MODEL_FILE = "cascade_model.npz"
+DEFAULT_MAX_ERROR = 0.02  # Highest error rate tolerated among the images the local scorer decides itself
+DEFAULT_VALIDATION_FRACTION = 0.2
+THUMBNAIL_SIZE = 16  # Side of the RGB thumbnail used as raw pixel features
+HISTOGRAM_BINS = 8  # Bins per color channel
+FEATURE_VERSION = 1  # Bump when image_features changes, so stale models are rejected
+
+
+# Function to turn image bytes into a fixed-length feature vector: a small RGB thumbnail, color histograms and a skin-tone share
+def image_features(image_bytes):
+    try:
+        from PIL import Image
+    except ImportError:  # Pillow is only needed when the cascade is switched on
+        raise ImportError("The cascade's local scorer requires Pillow (pip install pillow).") from None
+
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        image.draft("RGB", (64, 64))  # Lets JPEG decode at reduced scale, which is most of the speedup
+        small = np.asarray(image.convert("RGB").resize((64, 64)), dtype=np.float32) / 255
+    thumbnail = small.reshape(THUMBNAIL_SIZE, 64 // THUMBNAIL_SIZE, THUMBNAIL_SIZE, 64 // THUMBNAIL_SIZE, 3).mean(axis=(1, 3))
+    histograms = [np.histogram(small[..., channel], bins=HISTOGRAM_BINS, range=(0, 1))[0] / (64 * 64) for channel in range(3)]
+    red, green, blue = small[..., 0], small[..., 1], small[..., 2]
+    skin = ((red > 0.37) & (green > 0.16) & (blue > 0.08) & (red > green) & (red > blue) & (red - np.minimum(green, blue) > 0.06)).mean()
+    return np.concatenate([thumbnail.ravel(), *histograms, [skin]]).astype(np.float32)
+
+
+class LogisticScorer:
+    """
+    L2-regularized logistic regression over image features, in plain NumPy.
+
+    Features are standardized with the training mean and spread, and the weights are
+    fitted by full-batch gradient descent, which takes well under a second for a few
+    thousand labeled images. Scoring a batch is one matrix-vector product.
+    """
+
+    def __init__(self, weights=None, bias=0.0, mean=None, scale=None):
+        self.weights = weights
+        self.bias = bias
+        self.mean = mean
+        self.scale = scale
+
+    def fit(self, features, labels, l2=1e-2, learning_rate=0.5, iterations=500):
+        self.mean = features.mean(axis=0)
+        self.scale = features.std(axis=0) + 1e-6
+        x = (features - self.mean) / self.scale
+        y = labels.astype(np.float64)
+        self.weights = np.zeros(x.shape[1])
+        self.bias = float(np.log((y.mean() + 1e-6) / (1 - y.mean() + 1e-6)))  # Start from the base rate
+        for _ in range(iterations):
+            error = self._sigmoid(x @ self.weights + self.bias) - y
+            self.weights -= learning_rate * (x.T @ error / len(y) + l2 * self.weights)
+            self.bias -= learning_rate * float(error.mean())
+        return self
+
+    def predict_proba(self, features):
+        """Probability that each row of `features` is offensive."""
+        return self._sigmoid(((features - self.mean) / self.scale) @ self.weights + self.bias)
+
+    @staticmethod
+    def _sigmoid(z):
+        return 1 / (1 + np.exp(-np.clip(z, -30, 30)))
+
+
+# Function to pick the widest thresholds whose local decisions stay within `max_error` on held-out scores
+def calibrate_thresholds(scores, labels, max_error=DEFAULT_MAX_ERROR):
+    """
+    Returns (low, high): images scoring at or below `low` are called benign and at or above
+    `high` offensive without an LLM call. Each side is chosen independently as the
+    threshold deciding the most images while the share of wrong calls among them stays
+    within `max_error`; with no such threshold nothing is decided locally on that side.
+    """
+    order = np.argsort(scores, kind="stable")
+    sorted_scores, sorted_labels = scores[order], labels[order].astype(bool)
+    ranks = np.arange(1, len(scores) + 1)
+
+    # Benign side: the lowest-scoring k images, wrong when they are actually offensive
+    benign_error = np.cumsum(sorted_labels) / ranks
+    ok = np.nonzero(benign_error <= max_error)[0]
+    low = float(sorted_scores[ok[-1]]) if len(ok) else -np.inf
+
+    # Offensive side: the highest-scoring k images, wrong when they are actually benign
+    offensive_error = np.cumsum(~sorted_labels[::-1]) / ranks
+    ok = np.nonzero(offensive_error <= max_error)[0]
+    high = float(sorted_scores[::-1][ok[-1]]) if len(ok) else np.inf
+    if low >= high:  # Overlapping calls would both claim the same images; keep only the benign side
+        high = np.inf
+    return low, high
+
+
+class Cascade:
+    """
+    Local pre-filter in front of the LLM: the scorer decides images it is confident about
+    and escalates the rest.
+
+    Scores depend only on the image, so each unique image is scored once and its local
+    verdict applies to every prompt. `low` / `high` are the probability thresholds at or
+    below / above which an image is called benign / offensive without an API call.
+    """
+
+    def __init__(self, scorer, low, high):
+        self.scorer = scorer
+        self.low = low
+        self.high = high
+
+    @classmethod
+    def load(cls, model_file, low=None, high=None):
+        with np.load(model_file) as data:
+            if int(data['feature_version']) != FEATURE_VERSION:
+                raise ValueError(f"{model_file} was trained on an older feature set; retrain it with cascade.py")
+            scorer = LogisticScorer(data['weights'], float(data['bias']), data['mean'], data['scale'])
+            return cls(scorer, float(data['low']) if low is None else low, float(data['high']) if high is None else high)
+
+    def save(self, model_file):
+        np.savez(model_file, weights=self.scorer.weights, bias=self.scorer.bias, mean=self.scorer.mean, scale=self.scorer.scale,
+                 low=self.low, high=self.high, feature_version=FEATURE_VERSION)
+
+    def verdicts(self, scores):
+        """Prediction label for each score that can be decided locally, None where it must be escalated."""
+        return ["not_offensive" if score <= self.low else "offensive" if score >= self.high else None for score in scores]
+
+    def decide(self, image_paths):
+        """
+        Score every image file (as stored, like the training images) and return
+        ({path: local prediction}, {path: score}). Images that can't be read are
+        escalated, so the LLM path reports them as it always has.
+        """
+        paths, features = [], []
+        for image_path in image_paths:
+            try:
+                with open(image_path, 'rb') as f:
+                    features.append(image_features(f.read()))
+            except (OSError, ValueError):
+                continue
+            paths.append(image_path)
+        if not paths:
+            return {}, {}
+        scores = self.scorer.predict_proba(np.vstack(features))
+        local = {path: verdict for path, verdict in zip(paths, self.verdicts(scores)) if verdict is not None}
+        return local, dict(zip(paths, scores.tolist()))
+
+
+# Function to pick a stable `fraction` of the locally decided images to send to the LLM anyway, for measuring the accuracy loss
+def split_audit_sample(local_verdicts, fraction):
+    """Returns (local verdicts kept, audited verdicts); the choice hashes the path, so every shard picks the same images."""
+    if not fraction:
+        return local_verdicts, {}
+    cutoff = fraction * 2 ** 64
+    audited = {path: verdict for path, verdict in local_verdicts.items() if stable_hash(path) < cutoff}
+    return {path: verdict for path, verdict in local_verdicts.items() if path not in audited}, audited
+
+
+# Function to spread per-image local verdicts over the dataset rows: (mask of rows with a verdict, their prediction codes)
+def local_row_codes(image_rows, verdicts, num_rows):
+    mask = np.zeros(num_rows, dtype=bool)
+    codes = np.full(num_rows, ABSTAINED, dtype=np.int8)
+    for image_index, image_path in enumerate(image_rows.paths):
+        verdict = verdicts.get(image_path)
+        if verdict is not None:
+            rows = image_rows.rows(image_index)
+            mask[rows] = True
+            codes[rows] = encode_prediction(verdict)
+    return mask, codes
+
+
+# Helper function to compute accuracy over answered rows of a prediction-code array
+def _accuracy(codes, truth):
+    answered = codes != ABSTAINED
+    return float(np.mean(codes[answered] == truth[answered])) if answered.any() else None
+
+
+def cascade_report(offensive, predictions, local_mask, audit_mask=None, audit_codes=None):
+    """
+    Cascade statistics for one prompt's prediction codes.
+
+    Reports the escalation rate (rows the local scorer couldn't decide, sent to the LLM),
+    how accurate the local calls were against the ground truth, and the accuracy on the
+    escalated rows. When a random audit sample of locally decidable rows was also sent to
+    the LLM (`audit_mask`, with the local calls in `audit_codes`), those rows are reported
+    on their own rather than as escalations, and the accuracy loss is the LLM's accuracy minus the local
+    accuracy on that sample, scaled by the share of rows decided locally: the estimated
+    drop in overall accuracy compared with sending every image to the LLM.
+    """
+    truth = np.where(offensive, OFFENSIVE, NOT_OFFENSIVE).astype(np.int8)
+    audited = audit_mask if audit_mask is not None else np.zeros_like(local_mask)
+    escalated = ~(local_mask | audited)
+    report = {
+        'Escalation Rate': float(escalated.mean()) if len(escalated) else 0.0,
+        'Local Decisions': int(local_mask.sum()),
+        'Local Accuracy': _accuracy(predictions[local_mask], truth[local_mask]),
+        'Escalated Accuracy': _accuracy(predictions[escalated], truth[escalated]),
+    }
+    if audit_mask is not None and audit_mask.any():
+        local_accuracy = _accuracy(audit_codes[audit_mask], truth[audit_mask])
+        llm_accuracy = _accuracy(predictions[audit_mask], truth[audit_mask])
+        local_share = (local_mask.sum() + audit_mask.sum()) / len(local_mask)
+        report['Audited Rows'] = int(audit_mask.sum())
+        report['Audit Rate'] = float(audit_mask.mean())
+        report['Audit Local Accuracy'] = local_accuracy
+        report['Audit LLM Accuracy'] = llm_accuracy
+        if local_accuracy is not None and llm_accuracy is not None:
+            report['Accuracy Loss'] = float((llm_accuracy - local_accuracy) * local_share)
+    return report
+
+
+# Function to read a labeled dataset's images and compute their features, skipping unreadable files;
+# returns per-row (features, labels, image codes) so rows showing the same image can be kept together
+def load_training_data(dataset_path):
+    from dataset_stream import load_dataset
+
+    dataset = load_dataset(dataset_path)
+    unique_paths = dataset.image_paths.unique_paths
+    position = np.full(len(unique_paths), -1)
+    unique_features = []
+    for code, path in enumerate(unique_paths):
+        try:
+            with open(path, 'rb') as f:
+                unique_features.append(image_features(f.read()))
+        except (OSError, ValueError):
+            print(f"Error: Could not read image {path}; it is left out of training.")
+            continue
+        position[code] = len(unique_features) - 1
+    # Every row gets its image's features, so duplicate images keep their own labels
+    rows = position[dataset.image_paths.codes] >= 0
+    image_codes = dataset.image_paths.codes[rows]
+    return np.vstack(unique_features)[position[image_codes]], dataset.offensive[rows], image_codes
+
+
+# Main function to train the local scorer on a labeled dataset and calibrate its thresholds
+def main():
+    parser = argparse.ArgumentParser(description="Train the cascade's local image scorer on a labeled dataset and calibrate its escalation thresholds.")
+    parser.add_argument('--dataset', type=str, default="./downloaded_images/Images_Ground_Truth.csv", help="CSV, Parquet or JSONL manifest with image paths and ground truth labels.")
+    parser.add_argument('--model_file', type=str, default=DEFAULT_MODEL_FILE, help="Where to save the trained scorer and its thresholds.")
+    parser.add_argument('--max_error', type=float, default=DEFAULT_MAX_ERROR, help="Highest error rate allowed among the images decided without the LLM.")
+    parser.add_argument('--validation_fraction', type=float, default=DEFAULT_VALIDATION_FRACTION, help="Share of images held out to calibrate the thresholds.")
+    parser.add_argument('--l2', type=float, default=1e-2, help="L2 regularization strength.")
+    parser.add_argument('--seed', type=int, default=0, help="Seed for the train/validation split.")
+    args = parser.parse_args()
+
+    try:
+        features, labels, image_codes = load_training_data(args.dataset)
+    except FileNotFoundError:
+        print(f"Error: The dataset file '{args.dataset}' was not found.")
+        return
+    if len(np.unique(labels)) < 2:
+        print("Error: The dataset needs both offensive and not offensive images to train the scorer.")
+        return
+
+    # Split by image, not by row, so copies of one image never land on both sides and flatter the validation accuracy
+    images = np.random.default_rng(args.seed).permutation(np.unique(image_codes))
+    split = max(int(len(images) * args.validation_fraction), 1)
+    held_out = np.isin(image_codes, images[:split])
+    validation, train = np.flatnonzero(held_out), np.flatnonzero(~held_out)
+    scorer = LogisticScorer().fit(features[train], labels[train], l2=args.l2)
+    scores = scorer.predict_proba(features[validation])
+    low, high = calibrate_thresholds(scores, labels[validation], max_error=args.max_error)
+    cascade = Cascade(scorer, low, high)
+    cascade.save(args.model_file)
+
+    decided = np.array([verdict is not None for verdict in cascade.verdicts(scores)])
+    local_correct = np.array([verdict == ("offensive" if label else "not_offensive") for verdict, label in zip(cascade.verdicts(scores), labels[validation])])
+    print(f"Trained on {len(train)} rows, calibrated on {len(validation)} rows of {split} held-out images: benign at or below {low:.3f}, offensive at or above {high:.3f}.")
+    print(f"Validation: {decided.mean():.1%} decided locally ({local_correct[decided].mean() if decided.any() else 0:.1%} correct), "
+          f"escalation rate {1 - decided.mean():.1%}.")
+    print(f"Model saved to {args.model_file}")
+
+
+if __name__ == "__main__":
+    main()
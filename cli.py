@@ -0,0 +1,40 @@
+import argparse
+import importlib
+import sys
+
+PROG = "python -m cli"
+
+# Subcommand -> (module whose main() it runs, summary). Only the chosen module is imported, so a
+# subcommand never pays for another's dependencies and `--help` returns without loading any of them.
+COMMANDS = {
+    'eval': ('prompt_eval', "Evaluate prompt files against a labeled image dataset."),
+    'metadata': ('prompt_metadata_gen', "Generate and version metadata for prompt files."),
+    'loader': ('prompt_loader', "Generate prompts from a template and exceptions (single prompts or sweeps)."),
+    'download': ('image_downloader', "Download the images listed in a URL file."),
+    'dedup': ('prompt_dedup', "Find clusters of near-duplicate prompts."),
+    'cascade': ('cascade', "Train the cascade's local image scorer."),
+    'shards': ('sharding', "Run prompt_eval as local shards and merge their results."),
+    'mock': ('mock_openai_server', "Start the local stand-in for the OpenAI API."),
+}
+
+
+# Main function to dispatch `python -m cli <command> [options]` to the command's own main()
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog=PROG,
+        description="Prompt evaluation toolkit. Run `%(prog)s <command> --help` for the options of a command.",
+        epilog="commands:\n" + "\n".join(f"  {name:<10}{summary}" for name, (_, summary) in COMMANDS.items()),
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument('command', choices=list(COMMANDS), metavar='command', help="Command to run (listed below).")
+    parser.add_argument('args', nargs=argparse.REMAINDER, help="Options passed on to the command.")
+    args = parser.parse_args(argv)
+
+    module_name, _ = COMMANDS[args.command]
+    # The command's own parser reads sys.argv and names itself after argv[0] in its usage line
+    sys.argv = [f"{PROG} {args.command}"] + args.args
+    return importlib.import_module(module_name).main()
+
+
+if __name__ == "__main__":
+    main()
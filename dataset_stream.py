@@ -0,0 +1,124 @@
+import os
+
+import numpy as np
+
+DEFAULT_CHUNK_SIZE = 100000  # Rows parsed at a time
+DATASET_COLUMNS = ('image_path', 'label', 'category')
+
+
+# Function to pick the reader for a dataset file from its extension
+def dataset_format(path):
+    extension = os.path.splitext(path)[1].lower()
+    if extension in ('.parquet', '.pq'):
+        return 'parquet'
+    if extension in ('.jsonl', '.ndjson'):
+        return 'jsonl'
+    return 'csv'
+
+
+def iter_dataset_chunks(path, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Yield the dataset as DataFrames of at most `chunk_size` rows.
+
+    Only the image_path, label and (optional) category columns are parsed, and every
+    value is read as a string, so a chunk costs the same whatever else the manifest holds.
+    Missing values read as empty strings in every format, as they do for CSV.
+    CSV, Parquet (row-group batches through pyarrow) and JSONL manifests are supported.
+    """
+    import pandas as pd  # Loaded when a dataset is actually read, not when the module is imported
+
+    file_format = dataset_format(path)
+    if file_format == 'parquet':
+        import pyarrow.parquet as pq
+
+        parquet_file = pq.ParquetFile(path)
+        columns = [column for column in DATASET_COLUMNS if column in parquet_file.schema_arrow.names]
+        for batch in parquet_file.iter_batches(batch_size=chunk_size, columns=columns):
+            yield batch.to_pandas().fillna("").astype(str)
+    elif file_format == 'jsonl':
+        with pd.read_json(path, lines=True, chunksize=chunk_size, dtype=False) as reader:
+            for chunk in reader:
+                yield chunk[[column for column in DATASET_COLUMNS if column in chunk.columns]].fillna("").astype(str)
+    else:
+        with pd.read_csv(path, chunksize=chunk_size, usecols=lambda column: column in DATASET_COLUMNS, dtype=str, keep_default_na=False) as reader:
+            yield from reader
+
+
+class PathColumn:
+    """
+    Per-row image paths stored as a list of unique paths plus one int32 code per row.
+
+    Behaves like a read-only list of paths, but costs 4 bytes per row instead of a
+    Python string, and exposes the codes so callers can group rows by image with NumPy.
+    """
+
+    def __init__(self, unique_paths, codes):
+        self.unique_paths = unique_paths
+        self.codes = codes
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, row_index):
+        return self.unique_paths[self.codes[row_index]]
+
+    def __iter__(self):
+        return map(self.unique_paths.__getitem__, self.codes.tolist())
+
+    def take(self, row_indices):
+        return PathColumn(self.unique_paths, self.codes[row_indices])
+
+    def tolist(self):
+        return list(self)
+
+
+class Dataset:
+    """Column-oriented, compact view of a labeled image dataset."""
+
+    def __init__(self, image_paths, offensive, category_names=None, category_codes=None):
+        self.image_paths = image_paths  # PathColumn
+        self.offensive = offensive  # bool per row: is the ground truth label "offensive"
+        self.category_names = category_names
+        self.category_codes = category_codes  # int16 per row, or None without a category column
+
+    def __len__(self):
+        return len(self.offensive)
+
+    @property
+    def empty(self):
+        return len(self) == 0
+
+
+# Helper function to map a chunk's values onto codes shared by the whole file
+def _encode_chunk(values, vocabulary):
+    import pandas as pd
+
+    local_codes, local_uniques = pd.factorize(values)
+    mapping = np.fromiter((vocabulary.setdefault(value, len(vocabulary)) for value in local_uniques), dtype=np.int64, count=len(local_uniques))
+    return mapping[local_codes]
+
+
+def load_dataset(path, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Stream a CSV, Parquet or JSONL manifest into a compact Dataset.
+
+    Chunks are factorized as they arrive, so peak memory is one chunk of parsed text
+    plus a few bytes per row (path code, label bit, category code) and one entry per
+    unique image, rather than a full DataFrame of Python strings.
+    """
+    path_vocabulary, category_vocabulary = {}, {}
+    path_codes, offensive, category_codes = [], [], []
+    for chunk in iter_dataset_chunks(path, chunk_size):
+        path_codes.append(_encode_chunk(chunk['image_path'], path_vocabulary).astype(np.int32))
+        offensive.append((chunk['label'] == 'offensive').to_numpy())
+        if 'category' in chunk.columns:
+            category_codes.append(_encode_chunk(chunk['category'].replace('', 'uncategorized'), category_vocabulary).astype(np.int16))
+
+    if not path_codes:
+        return Dataset(PathColumn([], np.empty(0, dtype=np.int32)), np.empty(0, dtype=bool))
+    return Dataset(
+        PathColumn(list(path_vocabulary), np.concatenate(path_codes)),
+        np.concatenate(offensive),
+        category_names=list(category_vocabulary) if category_codes else None,
+        category_codes=np.concatenate(category_codes) if category_codes else None,
+    )
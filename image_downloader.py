@@ -0,0 +1,285 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
+import time
+from collections import Counter
+from urllib.parse import urlparse
+
+DEFAULT_URL_FILE = "image_urls.txt"
+DEFAULT_DOWNLOAD_FOLDER = "downloaded_images"
+MANIFEST_NAME = "manifest.jsonl"
+MAX_CONNECTIONS = 64  # Open connections across all hosts
+MAX_PER_HOST = 8  # Open connections to any one host, so a single CDN isn't hammered
+MAX_RETRIES = 5
+REQUEST_TIMEOUT = 60  # Seconds for one download, including the body
+CHUNK_SIZE = 1 << 16  # Bytes written per streamed chunk
+RETRY_STATUSES = {408, 425, 429, 500, 502, 503, 504}
+
+# Leading bytes of the image formats we expect; anything else (e.g. an HTML error page) is rejected
+IMAGE_SIGNATURES = (b"\xff\xd8\xff", b"\x89PNG\r\n\x1a\n", b"GIF87a", b"GIF89a", b"RIFF", b"BM")
+
+
+# Function to extract the unique identifier from the URL
+def extract_filename_from_url(url):
+    parsed_url = urlparse(url)
+    # Extract the file name from the URL path (e.g., b71f95b0-a771-40ba-8caf-662266f1714d)
+    filename = os.path.basename(parsed_url.path)
+    # Remove the file extension (.jpeg) if present
+    return os.path.splitext(filename)[0]
+
+
+def plan_file_names(urls):
+    """
+    Map every URL to the file it is saved as.
+
+    Files keep the historical "<url basename>.jpeg" name, except where several URLs share
+    a basename: those get a short hash of the full URL appended, so they no longer
+    overwrite each other.
+    """
+    names = {url: extract_filename_from_url(url) or hashlib.sha256(url.encode('utf-8')).hexdigest()[:16] for url in urls}
+    shared = {name for name, count in Counter(names.values()).items() if count > 1}
+    return {
+        url: f"{name}-{hashlib.sha256(url.encode('utf-8')).hexdigest()[:8]}.jpeg" if name in shared else f"{name}.jpeg"
+        for url, name in names.items()
+    }
+
+
+# Function to check that a file starts like an image
+def looks_like_image(head):
+    return any(head.startswith(signature) for signature in IMAGE_SIGNATURES)
+
+
+# Function to hash a file on disk
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class DownloadManifest:
+    """
+    Append-only JSONL record of every verified download in a folder.
+
+    Each entry holds the URL, file name, SHA-256, size and mtime of the file as written.
+    A rerun skips a file without reading it when its size and mtime still match the
+    entry, and re-hashes it only when they don't (or with `verify`).
+    """
+
+    def __init__(self, download_folder):
+        self.path = os.path.join(download_folder, MANIFEST_NAME)
+        self.entries = {}
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # A line cut short by a crash; that file is simply checked again
+                    self.entries[entry['file']] = entry
+        self._file = None
+
+    def is_current(self, file_path, verify=False):
+        entry = self.entries.get(os.path.basename(file_path))
+        if entry is None:
+            return False
+        try:
+            stat = os.stat(file_path)
+        except FileNotFoundError:
+            return False
+        if not verify and stat.st_size == entry['bytes'] and stat.st_mtime_ns == entry['mtime_ns']:
+            return True
+        return file_sha256(file_path) == entry['sha256']
+
+    def record(self, url, file_path, sha256, size):
+        if self._file is None:
+            self._file = open(self.path, 'a')
+        entry = {'url': url, 'file': os.path.basename(file_path), 'sha256': sha256, 'bytes': size,
+                 'mtime_ns': os.stat(file_path).st_mtime_ns, 'downloaded': time.time()}
+        self.entries[entry['file']] = entry
+        self._file.write(json.dumps(entry) + "\n")
+        self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+# Function to adopt a file downloaded before the manifest existed, if it is a complete image
+def adopt_existing_file(manifest, url, file_path):
+    try:
+        with open(file_path, 'rb') as f:
+            if not looks_like_image(f.read(16)):
+                return False
+    except FileNotFoundError:
+        return False
+    manifest.record(url, file_path, file_sha256(file_path), os.path.getsize(file_path))
+    return True
+
+
+# Helper function to work out how long to back off before the next attempt
+def retry_wait_time(retry_after, retries):
+    try:
+        if retry_after is not None:
+            return float(retry_after) + random.uniform(0, 1)
+    except ValueError:
+        pass
+    return min(2 ** retries, 60) + random.uniform(0, 1)
+
+
+async def download_image(session, url, file_path, manifest, max_retries=MAX_RETRIES):
+    """
+    Download one image with retries, returning "downloaded" or "failed: <reason>".
+
+    The body is streamed into a temporary file and hashed as it arrives; only a
+    complete 200 response that looks like an image is renamed into place, so an
+    interrupted or rejected download never leaves a corrupt file under the real name.
+    """
+    import aiohttp
+
+    temp_path = f"{file_path}.{os.getpid()}.part"
+    reason = "no attempt"
+    retry_after = None
+    for retries in range(max_retries + 1):
+        if retries:
+            await asyncio.sleep(retry_wait_time(retry_after, retries))
+            retry_after = None  # A Retry-After header only paces the attempt right after the response that sent it
+        try:
+            async with session.get(url) as response:
+                if response.status != 200:
+                    reason = f"HTTP {response.status}"
+                    if response.status in RETRY_STATUSES:
+                        retry_after = response.headers.get("retry-after")
+                        continue
+                    return f"failed: {reason}"  # 403/404 and the like won't change on a retry
+
+                digest = hashlib.sha256()
+                size = 0
+                head = b""
+                with open(temp_path, 'wb') as f:
+                    async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                        if len(head) < 16:
+                            head += chunk[:16]
+                        digest.update(chunk)
+                        f.write(chunk)
+                        size += len(chunk)
+                if response.content_length is not None and size != response.content_length:
+                    reason = f"truncated body ({size} of {response.content_length} bytes)"
+                    continue
+                if not looks_like_image(head):
+                    os.remove(temp_path)
+                    return f"failed: not an image ({response.content_type})"
+                os.replace(temp_path, file_path)
+                manifest.record(url, file_path, digest.hexdigest(), size)
+                return "downloaded"
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            reason = str(e) or type(e).__name__
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+    return f"failed: {reason}"
+
+
+# Worker that pulls (url, file_path) pairs off the queue until it is drained
+async def _download_worker(queue, session, manifest, counts, pbar, max_retries):
+    while True:
+        url, file_path = await queue.get()
+        try:
+            status = await download_image(session, url, file_path, manifest, max_retries=max_retries)
+            if status != "downloaded":
+                print(f"Failed to download {url}: {status[len('failed: '):]}")
+                status = "failed"
+            counts[status] += 1
+            pbar.update(1)
+        finally:
+            queue.task_done()
+
+
+async def download_images(urls, download_folder=DEFAULT_DOWNLOAD_FOLDER, max_connections=MAX_CONNECTIONS, max_per_host=MAX_PER_HOST,
+                          max_retries=MAX_RETRIES, verify=False):
+    """
+    Download every URL into `download_folder`, skipping files the manifest has verified.
+
+    One pooled aiohttp session serves a fixed set of workers, with at most
+    `max_connections` open connections overall and `max_per_host` per host. URLs are fed
+    through a bounded queue, so a 500k-URL list costs one queue's worth of tasks.
+    Returns counts of downloaded, skipped and failed URLs.
+    """
+    import aiohttp  # aiohttp and tqdm are loaded only when there is something to download
+    from tqdm import tqdm
+
+    os.makedirs(download_folder, exist_ok=True)
+    manifest = DownloadManifest(download_folder)
+    file_names = plan_file_names(urls)
+    counts = Counter()
+
+    # Verified files are skipped up front, without any network traffic
+    pending = []
+    for url, file_name in file_names.items():
+        file_path = os.path.join(download_folder, file_name)
+        if manifest.is_current(file_path, verify=verify) or (file_name not in manifest.entries and adopt_existing_file(manifest, url, file_path)):
+            counts["skipped"] += 1
+        else:
+            pending.append((url, file_path))
+    print(f"{counts['skipped']} of {len(file_names)} images already downloaded and verified; fetching {len(pending)}.")
+
+    try:
+        if pending:
+            connector = aiohttp.TCPConnector(limit=max_connections, limit_per_host=max_per_host)
+            timeout = aiohttp.ClientTimeout(total=REQUEST_TIMEOUT)
+            queue = asyncio.Queue(maxsize=max_connections * 2)
+            async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+                with tqdm(total=len(pending), desc="Downloading images") as pbar:
+                    workers = [asyncio.create_task(_download_worker(queue, session, manifest, counts, pbar, max_retries)) for _ in range(max_connections)]
+                    try:
+                        for item in pending:
+                            await queue.put(item)
+                        await queue.join()
+                    finally:
+                        for worker in workers:
+                            worker.cancel()
+                        await asyncio.gather(*workers, return_exceptions=True)
+    finally:
+        manifest.close()
+    return counts
+
+
+# Function to read the URL list, dropping blank lines and duplicates while keeping the file order
+def read_urls(url_file_path):
+    with open(url_file_path, 'r') as url_file:
+        return list(dict.fromkeys(line.strip() for line in url_file if line.strip()))
+
+
+# Main function to download the images listed in a URL file
+def main():
+    parser = argparse.ArgumentParser(description="Download the images listed in a URL file, resumably and with integrity checks.")
+    parser.add_argument('--url_file', type=str, default=DEFAULT_URL_FILE, help="Text file with one image URL per line.")
+    parser.add_argument('--download_folder', type=str, default=DEFAULT_DOWNLOAD_FOLDER, help="Folder the images (and manifest.jsonl) are written to.")
+    parser.add_argument('--max_connections', type=int, default=MAX_CONNECTIONS, help="Maximum open connections across all hosts.")
+    parser.add_argument('--max_per_host', type=int, default=MAX_PER_HOST, help="Maximum open connections to any one host.")
+    parser.add_argument('--max_retries', type=int, default=MAX_RETRIES, help="Retries after a timeout, connection error, 429 or 5xx.")
+    parser.add_argument('--verify', action='store_true', help="Re-hash every existing file against the manifest instead of trusting size and mtime.")
+    args = parser.parse_args()
+
+    try:
+        urls = read_urls(args.url_file)
+    except FileNotFoundError:
+        print(f"Error: The URL file '{args.url_file}' was not found.")
+        return
+
+    try:
+        counts = asyncio.run(download_images(urls, args.download_folder, max_connections=args.max_connections, max_per_host=args.max_per_host,
+                                             max_retries=args.max_retries, verify=args.verify))
+    except KeyboardInterrupt:
+        print("\nInterrupted. Finished images are recorded in the manifest; rerun to fetch the rest.")
+        return
+    print(f"Downloaded {counts['downloaded']}, skipped {counts['skipped']}, failed {counts['failed']}.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+import hashlib
+import importlib.util
+import io
+import json
+import os
+import threading
+
+DEFAULT_PREPROCESS_CACHE = ".cache/preprocessed"
+DEFAULT_MAX_DIMENSION = 1024
+DEFAULT_JPEG_QUALITY = 85
+HASH_BITS = 64
+
+
+# Function to compute a 64-bit difference hash (dHash) of an image
+def dhash(image, hash_size=8):
+    from PIL import Image
+
+    # Compare each pixel with its right neighbour on a (hash_size + 1) x hash_size grayscale thumbnail
+    small = image.convert("L").resize((hash_size + 1, hash_size), Image.LANCZOS)
+    pixels = list(small.getdata())
+    value = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * (hash_size + 1) + col]
+            right = pixels[row * (hash_size + 1) + col + 1]
+            value = (value << 1) | (1 if left > right else 0)
+    return value
+
+
+def hamming_distance(hash1, hash2):
+    return bin(hash1 ^ hash2).count("1")
+
+
+# Function to group perceptual duplicates; returns a mapping of each duplicate path to the path that is kept
+def find_duplicates(image_hashes, max_distance=0):
+    """
+    Any two hashes within `max_distance` bits must agree exactly on at least one of
+    `max_distance + 1` bands (pigeonhole), so only images sharing a band are compared.
+    The first image seen in a group is kept.
+    """
+    if max_distance < 0:
+        raise ValueError(f"The duplicate distance must be at least 0 bits, got {max_distance}")
+    bands = max_distance + 1
+    band_width = -(-HASH_BITS // bands)
+    buckets = {}
+    canonical = {}
+
+    for image_path, image_hash in image_hashes.items():
+        if image_hash is None:
+            continue
+        keys = [(band, (image_hash >> (band * band_width)) & ((1 << band_width) - 1)) for band in range(bands)]
+        match = None
+        for key in keys:
+            for kept_path, kept_hash in buckets.get(key, ()):
+                if hamming_distance(image_hash, kept_hash) <= max_distance:
+                    match = kept_path
+                    break
+            if match:
+                break
+        if match:
+            canonical[image_path] = match
+            continue
+        for key in keys:
+            buckets.setdefault(key, []).append((image_path, image_hash))
+
+    return canonical
+
+
+# Helper function to write a cache entry through a temp file, so concurrent workers never read a half-written entry
+def _write_cache_entry(path, data):
+    # Entries are content-addressed: identical images in the dataset map to the same path, possibly on two
+    # prefetch threads at once, so the temp name is unique per process and thread
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_path, "wb") as entry_file:
+        entry_file.write(data)
+    try:
+        os.replace(temp_path, path)
+    except FileNotFoundError:
+        pass  # Lost a race with another writer of the same content-addressed entry, which holds the same bytes
+
+
+class ImagePreprocessor:
+    """
+    Optional resize/recompress stage applied before images are base64-encoded.
+
+    Processed bytes and their dHash are cached on disk keyed by the original file's
+    content hash and the settings, so each image is only decoded and re-encoded once.
+    Leaving max_dimension and jpeg_quality unset passes the original bytes through.
+    """
+
+    def __init__(self, max_dimension=None, jpeg_quality=None, cache_dir=DEFAULT_PREPROCESS_CACHE):
+        # Pillow is only needed when preprocessing is switched on; fail here rather than on the first image
+        if importlib.util.find_spec("PIL") is None:
+            raise ImportError("Image preprocessing requires Pillow (pip install pillow).")
+        self.max_dimension = max_dimension
+        self.jpeg_quality = jpeg_quality
+        self.cache_dir = cache_dir
+
+    @property
+    def transforms(self):
+        return self.max_dimension is not None or self.jpeg_quality is not None
+
+    def _cache_paths(self, original):
+        settings = json.dumps([self.max_dimension, self.jpeg_quality])
+        key = hashlib.sha256(original + settings.encode("utf-8")).hexdigest()
+        base = os.path.join(self.cache_dir, key[:2], key)
+        return base + ".jpg", base + ".dhash"
+
+    def _transform(self, original):
+        from PIL import Image, ImageOps
+
+        image = ImageOps.exif_transpose(Image.open(io.BytesIO(original)))
+        image_hash = dhash(image)
+        if not self.transforms:
+            return original, image_hash
+        original_format, original_size = image.format, image.size
+        if self.max_dimension is not None:
+            image.thumbnail((self.max_dimension, self.max_dimension), Image.LANCZOS)
+        buffer = io.BytesIO()
+        image.convert("RGB").save(buffer, format="JPEG", quality=self.jpeg_quality or DEFAULT_JPEG_QUALITY, optimize=True)
+        # Recompressing an already small JPEG can make it bigger; keep the original then
+        if original_format == "JPEG" and image.size == original_size and buffer.tell() >= len(original):
+            return original, image_hash
+        return buffer.getvalue(), image_hash
+
+    def process(self, image_path):
+        """Return (image bytes, dHash) for `image_path`, or (None, None) if it can't be read."""
+        try:
+            with open(image_path, "rb") as image_file:
+                original = image_file.read()
+        except FileNotFoundError:
+            print(f"Error: The image file at {image_path} was not found.")
+            return None, None
+
+        # Without transforms only the dHash is cached; the bytes sent are the original file's
+        data_path, hash_path = self._cache_paths(original)
+        if os.path.exists(hash_path) and (not self.transforms or os.path.exists(data_path)):
+            with open(hash_path, "r") as hash_file:
+                image_hash = int(hash_file.read(), 16)
+            if not self.transforms:
+                return original, image_hash
+            with open(data_path, "rb") as data_file:
+                return data_file.read(), image_hash
+
+        try:
+            processed, image_hash = self._transform(original)
+        except (OSError, ValueError) as e:
+            print(f"Error: Could not preprocess {image_path}: {e}")
+            return original, None
+
+        os.makedirs(os.path.dirname(data_path), exist_ok=True)
+        if self.transforms:
+            _write_cache_entry(data_path, processed)
+        _write_cache_entry(hash_path, f"{image_hash:016x}".encode("ascii"))
+        return processed, image_hash
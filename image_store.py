@@ -0,0 +1,144 @@
+import base64
+import mmap
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+from perf import get_tracer, traced
+
+
+# Helper function to encode an image in base64
+def encode_image(image_path):
+    try:
+        with open(image_path, "rb") as image_file:
+            return base64.b64encode(image_file.read()).decode('utf-8')
+    except FileNotFoundError:
+        print(f"Error: The image file at {image_path} was not found.")
+        return None
+
+
+class ImageStore:
+    """
+    Lazily encoded base64 image store that can be shared with worker processes.
+
+    Images are encoded on first access and kept in a small LRU cache. Calling
+    `materialize()` streams every encoding into a spool file once; after that
+    the store pickles to a tiny handle (paths plus offsets) and each worker
+    memory-maps the spool instead of receiving its own copy of the data.
+    """
+
+    def __init__(self, image_paths, max_cached=256, preprocessor=None):
+        self.image_paths = list(dict.fromkeys(image_paths))
+        self.max_cached = max_cached
+        self.preprocessor = preprocessor
+        self.aliases = {}  # duplicate image_path -> image_path whose encoding is sent instead
+        self._index = {}  # image_path -> (offset, length) in the spool file, None if the image is unreadable
+        self._spool_path = None
+        self._owns_spool = False
+        self._mmap = None
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()  # get() is called from the prefetch threads
+
+    # Only the handle travels to workers; mapped pages and cached strings stay process-local
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_mmap'] = None
+        state['_cache'] = OrderedDict()
+        state['_owns_spool'] = False
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.image_paths)
+
+    @traced("image_encode")
+    def _encode(self, image_path):
+        if self.preprocessor is None:
+            return encode_image(image_path)
+        data, _ = self.preprocessor.process(image_path)
+        return base64.b64encode(data).decode('utf-8') if data is not None else None
+
+    def canonical_path(self, image_path):
+        return self.aliases.get(image_path, image_path)
+
+    def deduplicate(self, max_distance=0):
+        """Alias perceptual duplicates (dHash within `max_distance` bits) to the first copy seen."""
+        from image_preprocess import ImagePreprocessor, find_duplicates
+
+        preprocessor = self.preprocessor or ImagePreprocessor()
+        image_hashes = {image_path: preprocessor.process(image_path)[1] for image_path in self.image_paths}
+        self.aliases = find_duplicates(image_hashes, max_distance)
+        return self.aliases
+
+    def get(self, image_path, default=None):
+        image_path = self.canonical_path(image_path)
+        if self._spool_path is not None and image_path in self._index:
+            entry = self._index[image_path]
+            if entry is None:
+                return default
+            offset, length = entry
+            with get_tracer().span("image_read"):
+                return self._open_spool()[offset:offset + length].decode('ascii')
+
+        with self._lock:
+            if image_path in self._cache:
+                self._cache.move_to_end(image_path)
+                encoded_image = self._cache[image_path]
+                return encoded_image if encoded_image is not None else default
+        # Encode outside the lock so prefetch threads read and encode different images in parallel
+        encoded_image = self._encode(image_path)
+        with self._lock:
+            self._cache[image_path] = encoded_image
+            if len(self._cache) > self.max_cached:
+                self._cache.popitem(last=False)
+        return encoded_image if encoded_image is not None else default
+
+    def materialize(self, spool_dir=None):
+        """Encode every image once into a spool file, one image in memory at a time."""
+        if self._spool_path is not None:
+            return self
+        fd, spool_path = tempfile.mkstemp(prefix="images-", suffix=".b64", dir=spool_dir)
+        offset = 0
+        with os.fdopen(fd, 'wb') as spool:
+            for image_path in self.image_paths:
+                if image_path in self.aliases:
+                    continue  # Duplicates are served from their canonical image's entry
+                encoded_image = self._encode(image_path)
+                if encoded_image is None:
+                    self._index[image_path] = None
+                    continue
+                data = encoded_image.encode('ascii')
+                spool.write(data)
+                self._index[image_path] = (offset, len(data))
+                offset += len(data)
+        self._spool_path = spool_path
+        self._owns_spool = True
+        self._cache.clear()
+        return self
+
+    def _open_spool(self):
+        if self._mmap is None:
+            with self._lock:
+                if self._mmap is None:
+                    self._mmap = self._map_spool()
+        return self._mmap
+
+    def _map_spool(self):
+        with open(self._spool_path, 'rb') as spool:
+            if os.fstat(spool.fileno()).st_size == 0:
+                return b""  # mmap can't map an empty file (every image was unreadable)
+            return mmap.mmap(spool.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self):
+        if isinstance(self._mmap, mmap.mmap):
+            self._mmap.close()
+        self._mmap = None
+        if self._owns_spool and self._spool_path and os.path.exists(self._spool_path):
+            os.remove(self._spool_path)
+        self._spool_path = None
+        self._index = {}
@@ -0,0 +1,116 @@
+import csv
+import os
+import sqlite3
+
+# (database column, CSV header) for every field of a metadata version, in CSV order
+COLUMNS = (
+    ('location', 'Prompt File Location'),
+    ('version', 'Version'),
+    ('title', 'Prompt Title'),
+    ('creation_date', 'Creation Date'),
+    ('last_modified_date', 'Last Modified Date'),
+    ('summary', 'Summary'),
+    ('content_categories', 'Content Categories'),
+    ('prompt_scope', 'Prompt Scope'),
+    ('risk_sensitivity', 'Risk Sensitivity'),
+    ('prompt_score', 'Prompt Score'),
+    ('score_reason', 'Score Reason'),
+    ('content_hash', 'Content Hash'),
+)
+METADATA_COLUMNS = [header for _, header in COLUMNS]
+_FIELDS = [column for column, _ in COLUMNS]
+
+
+# Function to derive the database path that sits next to a metadata CSV
+def default_store_path(metadata_file):
+    return os.path.splitext(metadata_file)[0] + ".sqlite3"
+
+
+class MetadataStore:
+    """
+    SQLite store of prompt metadata versions, keyed on (prompt location, version).
+
+    The primary key doubles as the index for every per-prompt lookup, so finding the
+    latest version or the last few versions of a prompt is a B-tree seek instead of a
+    scan over the whole history, and each run's new versions are appended in one
+    transaction. Rows are returned as dicts keyed by the CSV headers, and
+    `export_csv` / `append_csv` keep prompt_metadata.csv available for existing tools.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS prompt_metadata (
+                location TEXT NOT NULL,
+                version INTEGER NOT NULL,
+                {", ".join(f"{column} TEXT" for column in _FIELDS[2:])},
+                PRIMARY KEY (location, version)
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS prompt_metadata_hash ON prompt_metadata (location, content_hash)")
+        self._conn.commit()
+
+    def __len__(self):
+        return self._conn.execute("SELECT COUNT(*) FROM prompt_metadata").fetchone()[0]
+
+    def latest_version(self, location):
+        return self._conn.execute("SELECT MAX(version) FROM prompt_metadata WHERE location = ?", (location,)).fetchone()[0] or 0
+
+    def next_version(self, location):
+        return self.latest_version(location) + 1
+
+    def recent_versions(self, location, limit=5):
+        """The last `limit` versions of a prompt, oldest first (like DataFrame.tail)."""
+        rows = self._conn.execute(f"SELECT {', '.join(_FIELDS)} FROM prompt_metadata WHERE location = ? ORDER BY version DESC LIMIT ?", (location, limit)).fetchall()
+        return [dict(zip(METADATA_COLUMNS, row)) for row in reversed(rows)]
+
+    def has_content(self, location, content_hash):
+        """Whether some version of the prompt at `location` was generated from exactly this text."""
+        return self._conn.execute("SELECT 1 FROM prompt_metadata WHERE location = ? AND content_hash = ? LIMIT 1", (location, content_hash)).fetchone() is not None
+
+    def append(self, rows):
+        """Insert metadata rows (dicts keyed by CSV header) atomically: either every row is stored or none is."""
+        values = [tuple(None if row.get(header) is None else (int(row[header]) if header == 'Version' else str(row[header])) for header in METADATA_COLUMNS) for row in rows]
+        with self._conn:
+            self._conn.executemany(f"INSERT INTO prompt_metadata ({', '.join(_FIELDS)}) VALUES ({', '.join('?' * len(_FIELDS))})", values)
+
+    def import_csv(self, metadata_file):
+        """Load an existing prompt_metadata.csv; rows already in the store are left alone."""
+        with open(metadata_file, 'r', newline='') as f:
+            reader = csv.DictReader(f)
+            if 'Prompt File Location' not in (reader.fieldnames or []):
+                print(f"'Prompt File Location' column not found in {metadata_file}, nothing imported.")
+                return 0
+            values = [tuple(row.get(header) or None for header in METADATA_COLUMNS) for row in reader]
+        with self._conn:
+            before = self._conn.total_changes
+            self._conn.executemany(f"INSERT OR IGNORE INTO prompt_metadata ({', '.join(_FIELDS)}) VALUES ({', '.join('?' * len(_FIELDS))})", values)
+            return self._conn.total_changes - before
+
+    def export_csv(self, metadata_file):
+        """Write the whole history to a CSV with the historical columns, in insertion order."""
+        temp_path = f"{metadata_file}.{os.getpid()}.tmp"
+        with open(temp_path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(METADATA_COLUMNS)
+            writer.writerows(self._conn.execute(f"SELECT {', '.join(_FIELDS)} FROM prompt_metadata ORDER BY rowid"))
+        os.replace(temp_path, metadata_file)
+
+    def append_csv(self, metadata_file, rows):
+        """Append just the new rows to an exported CSV (a missing or differently laid out CSV is exported in full)."""
+        if not os.path.exists(metadata_file):
+            self.export_csv(metadata_file)
+            return
+        with open(metadata_file, 'r', newline='') as f:
+            header = next(csv.reader(f), None)
+        if header != METADATA_COLUMNS:
+            self.export_csv(metadata_file)  # Older column layout: rewrite it once in the current one
+            return
+        with open(metadata_file, 'a', newline='') as f:
+            csv.writer(f).writerows([row.get(header) for header in METADATA_COLUMNS] for row in rows)
+
+    def close(self):
+        self._conn.close()
@@ -0,0 +1,179 @@
+import json
+from itertools import repeat
+
+import numpy as np
+
+# Prediction codes used in the stacked prediction matrix
+OFFENSIVE = 1
+NOT_OFFENSIVE = 0
+ABSTAINED = -1  # "DUMMY": the call failed or the response couldn't be parsed
+PREDICTION_CODES = {'offensive': OFFENSIVE, 'not_offensive': NOT_OFFENSIVE}
+
+CELLS = ('TP', 'FP', 'FN', 'TN', 'Abstained')
+DEFAULT_BOOTSTRAP_SAMPLES = 1000
+DEFAULT_CONFIDENCE = 0.95
+CHUNK_SIZE = 1 << 24  # (prompt, row) pairs scored per bincount
+
+
+# Function to read the category names defined in the guidelines file
+def load_guideline_categories(guidelines_file):
+    try:
+        with open(guidelines_file, 'r') as f:
+            return list(json.load(f).keys())
+    except FileNotFoundError:
+        print(f"Error: The guidelines file '{guidelines_file}' was not found.")
+        return []
+
+
+# Function to convert a list of "offensive" / "not_offensive" / "DUMMY" labels to prediction codes
+def encode_predictions(predictions):
+    if isinstance(predictions, np.ndarray) and predictions.dtype.kind in 'iu':
+        return predictions.astype(np.int8, copy=False)
+    # map() over dict.get runs in C, several times faster than building a string array first
+    return np.fromiter(map(PREDICTION_CODES.get, predictions, repeat(ABSTAINED)), dtype=np.int8, count=len(predictions))
+
+
+# Function to convert one prediction label to its code
+def encode_prediction(prediction):
+    return PREDICTION_CODES.get(prediction, ABSTAINED)
+
+
+# Function to turn ground-truth labels (strings, or booleans meaning "offensive") into a boolean array
+def ground_truth_array(labels):
+    labels = np.asarray(labels)
+    if labels.dtype == bool:
+        return labels
+    return labels.astype(str) == 'offensive'
+
+
+# Function to stack every prompt's predictions into one (prompts x rows) matrix
+def prediction_matrix(results):
+    prompt_files = list(results)
+    if not prompt_files:
+        return prompt_files, np.empty((0, 0), dtype=np.int8)
+    return prompt_files, np.vstack([encode_predictions(results[prompt_file]) for prompt_file in prompt_files])
+
+
+def confusion_counts(ground_truth, matrix, row_categories=None, n_categories=1, chunk_size=CHUNK_SIZE):
+    """
+    Return TP, FP, FN, TN and abstention counts for every prompt (row of `matrix`).
+
+    Each (prompt, row) pair is mapped to a single cell index and counted with one
+    bincount, a few prompts at a time so the int64 scratch space stays bounded.
+    The result has shape (prompts, 5), or (prompts, categories, 5) when `row_categories`
+    holds a category code per row.
+    """
+    matrix = np.atleast_2d(matrix)
+    n_prompts, n_rows = matrix.shape
+    truth_offset = np.where(np.asarray(ground_truth, dtype=bool), 0, 1).astype(np.int64)  # TP/FN vs FP/TN
+    if row_categories is not None:
+        truth_offset = truth_offset * n_categories + row_categories
+    n_cells = len(CELLS) * n_categories
+
+    counts = np.empty((n_prompts, n_cells), dtype=np.int64)
+    prompts_per_chunk = max(1, chunk_size // max(n_rows, 1))
+    for start in range(0, n_prompts, prompts_per_chunk):
+        block = matrix[start:start + prompts_per_chunk]
+        # offensive -> TP/FP (0, 1), not_offensive -> FN/TN (2, 3), abstained -> 4
+        cells = np.where(block == OFFENSIVE, 0, 2).astype(np.int64) * n_categories + truth_offset
+        if row_categories is None:
+            cells[block == ABSTAINED] = 4
+        else:
+            cells[block == ABSTAINED] = 4 * n_categories + row_categories[np.nonzero(block == ABSTAINED)[1]]
+        cells += np.arange(len(block))[:, None] * n_cells
+        counts[start:start + len(block)] = np.bincount(cells.ravel(), minlength=len(block) * n_cells).reshape(len(block), n_cells)
+
+    if row_categories is None:
+        return counts
+    # Cells are laid out cell-major; move the category axis ahead of the cell axis
+    return counts.reshape(n_prompts, len(CELLS), n_categories).transpose(0, 2, 1)
+
+
+def metrics_from_counts(counts):
+    """Vectorized metrics for confusion counts of any leading shape (..., 5)."""
+    counts = np.asarray(counts, dtype=np.float64)
+    tp, fp, fn, tn, abstained = (counts[..., i] for i in range(len(CELLS)))
+    answered = tp + fp + fn + tn
+    total = answered + abstained
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return {
+            'Precision': np.where(tp + fp > 0, tp / (tp + fp), 0.0),
+            'Recall': np.where(tp + fn > 0, tp / (tp + fn), 0.0),
+            'F1-Score': np.where(2 * tp + fp + fn > 0, 2 * tp / (2 * tp + fp + fn), 0.0),
+            'Error Rate': np.where(answered > 0, (fp + fn) / answered, 0.0),
+            'Abstention Rate': np.where(total > 0, abstained / total, 0.0),
+        }
+
+
+def bootstrap_confidence_intervals(counts, n_bootstrap=DEFAULT_BOOTSTRAP_SAMPLES, confidence=DEFAULT_CONFIDENCE, seed=None):
+    """
+    Bootstrap intervals for every metric of every prompt at once.
+
+    The metrics depend only on the confusion counts, so resampling rows with
+    replacement is equivalent to drawing the five counts from a multinomial over the
+    observed cell frequencies. Each replicate therefore costs O(1) instead of O(rows),
+    and all prompts are resampled in one call.
+    Returns {metric: array of shape (prompts, 2)} holding the lower and upper bounds.
+    """
+    counts = np.atleast_2d(np.asarray(counts, dtype=np.int64))
+    totals = counts.sum(axis=1)
+    rng = np.random.default_rng(seed)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        frequencies = np.where(totals[:, None] > 0, counts / np.maximum(totals, 1)[:, None], 0.0)
+    draws = rng.multinomial(totals, frequencies, size=(n_bootstrap, len(counts)))
+    tail = (1 - confidence) / 2 * 100
+    return {
+        name: np.percentile(values, [tail, 100 - tail], axis=0).T
+        for name, values in metrics_from_counts(draws).items()
+    }
+
+
+def compute_metrics(labels, results, categories=None, known_categories=None, n_bootstrap=DEFAULT_BOOTSTRAP_SAMPLES,
+                    confidence=DEFAULT_CONFIDENCE, seed=None, category_names=None):
+    """
+    Score every prompt in one pass over a stacked prediction matrix.
+
+    Abstentions ("DUMMY") are counted separately instead of being scored as
+    not_offensive: precision, recall and F1 are computed over answered rows and the
+    abstention rate is reported next to them. When `categories` (one guideline category
+    per row, or integer codes into `category_names`) is given, the same metrics are
+    broken down per category.
+    Returns {prompt_file: metrics} ready to be written by save_metrics.
+    """
+    prompt_files, matrix = prediction_matrix(results)
+    if not prompt_files:
+        return {}
+    ground_truth = ground_truth_array(labels)
+
+    counts = confusion_counts(ground_truth, matrix)
+    point = metrics_from_counts(counts)
+    intervals = bootstrap_confidence_intervals(counts, n_bootstrap, confidence, seed) if n_bootstrap else None
+
+    per_category = None
+    if categories is not None:
+        if category_names is not None:
+            category_codes = np.asarray(categories)
+        else:
+            category_names, category_codes = np.unique(np.asarray(categories, dtype=str), return_inverse=True)
+        unknown = sorted(set(category_names) - set(known_categories or category_names))
+        if unknown:
+            print(f"Warning: Categories not defined in the guidelines: {', '.join(unknown)}")
+        per_category_counts = confusion_counts(ground_truth, matrix, category_codes, len(category_names))  # prompts x categories x 5
+        per_category = (category_names, per_category_counts, metrics_from_counts(per_category_counts))
+
+    metrics = {}
+    for i, prompt_file in enumerate(prompt_files):
+        metric = {name: float(values[i]) for name, values in point.items()}
+        metric['Confusion Matrix'] = {cell: int(count) for cell, count in zip(CELLS, counts[i])}
+        if intervals is not None:
+            metric['Confidence Intervals'] = {name: [float(bound) for bound in values[i]] for name, values in intervals.items()}
+        if per_category is not None:
+            category_names, per_category_counts, per_category_metrics = per_category
+            metric['Per Category'] = {
+                str(name): dict({metric_name: float(values[i, j]) for metric_name, values in per_category_metrics.items()},
+                                Rows=int(per_category_counts[i, j].sum()))
+                for j, name in enumerate(category_names)
+            }
+        metrics[prompt_file] = metric
+
+    return metrics
@@ -0,0 +1,442 @@
+import argparse
+import hashlib
+import io
+import json
+import math
+import random
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+from rate_limiter import CHARS_PER_TOKEN, estimate_tokens
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow is optional; /images then serves random bytes
+    Image = None
+
+DEFAULT_PORT = 8765
+LATENCY_DISTRIBUTIONS = ('constant', 'uniform', 'exponential', 'lognormal')
+WINDOW_SECONDS = 60  # Rate limits are enforced over fixed one-minute windows, like the real API
+EMBEDDING_DIMENSIONS = 256
+
+# Automatic prompt caching as the real API does it: the longest previously seen prefix is reused in 128-token blocks,
+# once at least 1024 tokens match, and cached entries expire after a few idle minutes
+PREFIX_CACHE_MIN_TOKENS = 1024
+PREFIX_CACHE_BLOCK_TOKENS = 128
+PREFIX_CACHE_TTL = 300
+PREFIX_CACHE_MAX_ENTRIES = 100000
+PREFIX_CACHE_SPEEDUP = 0.5  # Fraction of the latency saved when the whole prompt is cached
+
+# Ways a real model wraps or breaks its JSON when JSON mode isn't requested
+MESSY_FORMATS = (
+    "Here is my analysis of the image:\n{content}",
+    "```json\n{content}\n```",
+    "{content}\n```",
+    "```json\n{content}\n```\nLet me know if you need anything else.",
+)
+
+
+class MockOpenAIState:
+    """
+    Configuration, counters and stored batch files shared by every handler thread.
+
+    Verdicts are derived from a hash of the request content, so the same (prompt, image)
+    always gets the same answer and cached or resumed runs stay comparable.
+    """
+
+    def __init__(self, latency_ms=200, latency_distribution='lognormal', latency_sigma=0.5, rate_429=0.0, rate_5xx=0.0,
+                 rpm=None, tpm=None, offensive_rate=0.5, batch_delay=2.0, image_kb=64, messy_rate=0.0, prefix_cache=True, seed=None):
+        self.latency_ms = latency_ms
+        self.latency_distribution = latency_distribution
+        self.latency_sigma = latency_sigma
+        self.rate_429 = rate_429
+        self.rate_5xx = rate_5xx
+        self.rpm = rpm
+        self.tpm = tpm
+        self.offensive_rate = offensive_rate
+        self.batch_delay = batch_delay
+        self.image_kb = image_kb
+        self.messy_rate = messy_rate
+        self.prefix_cache = prefix_cache
+        self._prefix_blocks = OrderedDict()  # Hash of every cached prefix block chain -> last use
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.files = {}
+        self.batches = {}
+        self._image_bytes = {}
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self.lock:
+            self.stats = {'requests': 0, 'responses': {}, 'prompt_tokens': 0, 'completion_tokens': 0, 'tokens_by_model': {}, 'latencies_ms': []}
+            self._window_start = time.time()
+            self._window_requests = 0
+            self._window_tokens = 0
+
+    def sample_latency(self):
+        mean = self.latency_ms / 1000
+        with self.lock:
+            if self.latency_distribution == 'uniform':
+                return self.random.uniform(0, 2 * mean)
+            if self.latency_distribution == 'exponential':
+                return self.random.expovariate(1 / mean) if mean > 0 else 0.0
+            if self.latency_distribution == 'lognormal' and mean > 0:
+                # Choose mu so the distribution's mean is `latency_ms`; sigma controls the tail
+                return self.random.lognormvariate(math.log(mean) - self.latency_sigma ** 2 / 2, self.latency_sigma)
+            return mean
+
+    def admit(self, tokens):
+        """Account a request against the current window; returns (allowed, rate-limit headers)."""
+        with self.lock:
+            now = time.time()
+            if now - self._window_start >= WINDOW_SECONDS:
+                self._window_start, self._window_requests, self._window_tokens = now, 0, 0
+            reset = f"{max(WINDOW_SECONDS - (now - self._window_start), 0):.3f}s"
+            allowed = (self.rpm is None or self._window_requests < self.rpm) and (self.tpm is None or self._window_tokens + tokens <= self.tpm)
+            if allowed:
+                self._window_requests += 1
+                self._window_tokens += tokens
+            headers = {}
+            if self.rpm is not None:
+                headers.update({'x-ratelimit-limit-requests': str(self.rpm), 'x-ratelimit-remaining-requests': str(max(self.rpm - self._window_requests, 0)),
+                                'x-ratelimit-reset-requests': reset})
+            if self.tpm is not None:
+                headers.update({'x-ratelimit-limit-tokens': str(self.tpm), 'x-ratelimit-remaining-tokens': str(max(self.tpm - self._window_tokens, 0)),
+                                'x-ratelimit-reset-tokens': reset})
+            return allowed, headers
+
+    def inject_error(self):
+        with self.lock:
+            roll = self.random.random()
+        if roll < self.rate_429:
+            return 429
+        if roll < self.rate_429 + self.rate_5xx:
+            return 503
+        return None
+
+    # Function to wrap a JSON answer in prose or code fences for a `messy_rate` fraction of answers
+    def messy(self, content):
+        with self.lock:
+            if self.random.random() >= self.messy_rate:
+                return content
+            return self.random.choice(MESSY_FORMATS).format(content=content)
+
+    def cached_tokens(self, payload, prompt_tokens):
+        """Prompt tokens served from the prefix cache for this request; its own prefix blocks are cached for the next one."""
+        if not self.prefix_cache:
+            return 0
+        block_chars = PREFIX_CACHE_BLOCK_TOKENS * CHARS_PER_TOKEN
+        text = request_prefix_text(payload)
+        digest = hashlib.sha1()
+        matched = 0
+        now = time.time()
+        with self.lock:
+            still_matching = True
+            for start in range(0, len(text) - block_chars + 1, block_chars):
+                digest.update(text[start:start + block_chars].encode('utf-8'))
+                key = digest.digest()
+                last_used = self._prefix_blocks.pop(key, None)
+                if still_matching and last_used is not None and now - last_used < PREFIX_CACHE_TTL:
+                    matched += 1
+                else:
+                    still_matching = False
+                self._prefix_blocks[key] = now
+            while len(self._prefix_blocks) > PREFIX_CACHE_MAX_ENTRIES:
+                self._prefix_blocks.popitem(last=False)
+        cached = min(matched * PREFIX_CACHE_BLOCK_TOKENS, prompt_tokens)
+        return cached if cached >= PREFIX_CACHE_MIN_TOKENS else 0
+
+    def record(self, status, latency, model=None, prompt_tokens=0, completion_tokens=0):
+        with self.lock:
+            self.stats['requests'] += 1
+            self.stats['responses'][str(status)] = self.stats['responses'].get(str(status), 0) + 1
+            if latency is not None:
+                self.stats['latencies_ms'].append(latency * 1000)
+            if model is not None:
+                self.stats['prompt_tokens'] += prompt_tokens
+                self.stats['completion_tokens'] += completion_tokens
+                usage = self.stats['tokens_by_model'].setdefault(model, {'prompt_tokens': 0, 'completion_tokens': 0})
+                usage['prompt_tokens'] += prompt_tokens
+                usage['completion_tokens'] += completion_tokens
+
+    def is_offensive(self, *parts):
+        digest = hashlib.sha256("\0".join(parts).encode('utf-8')).digest()
+        return int.from_bytes(digest[:8], 'big') / 2 ** 64 < self.offensive_rate
+
+    def image_bytes(self, name):
+        with self.lock:
+            if name not in self._image_bytes:
+                rng = random.Random(name)
+                if Image is not None:
+                    buffer = io.BytesIO()
+                    Image.frombytes('RGB', (64, 64), rng.randbytes(64 * 64 * 3)).resize((512, 512)).save(buffer, format='JPEG', quality=90)
+                    self._image_bytes[name] = buffer.getvalue()
+                else:
+                    self._image_bytes[name] = rng.randbytes(self.image_kb * 1024)
+            return self._image_bytes[name]
+
+
+# Function to build the completion text the real model would be expected to return for a payload
+def completion_content(state, payload):
+    messages = payload.get('messages', [])
+    system = " ".join(m['content'] for m in messages if m.get('role') == 'system' and isinstance(m.get('content'), str))
+    if 'metadata' in system:
+        return json.dumps({
+            "title": "Mock Prompt", "summary": "A mock summary of the prompt for benchmarking.", "categories": ["nudity", "violence"],
+            "scope": "Broad", "risk_sensitivity": "Medium", "prompt_score": 4, "score_reason": "Generated by the mock server.",
+        })
+
+    # Joined the way the prefix-cache layout merges them, so both request layouts get the same verdicts
+    prompt_text = "\n\n".join(m['content'] for m in messages if isinstance(m.get('content'), str))
+    image_ids, images = [], []
+    for message in messages:
+        if isinstance(message.get('content'), list):
+            for part in message['content']:
+                if part.get('type') == 'text':
+                    image_ids += re.findall(r"image_id:\s*(\S+)", part['text'])
+                elif part.get('type') == 'image_url':
+                    images.append(part['image_url']['url'][-64:])
+
+    if image_ids:
+        return json.dumps([{'image_id': image_id, 'offensive': state.is_offensive(prompt_text, image)} for image_id, image in zip(image_ids, images)])
+    return json.dumps({'offensive': state.is_offensive(prompt_text, images[0] if images else "")})
+
+
+# Function to flatten a request into the text stream prompt caching matches on (images stand in as a hash of their data)
+def request_prefix_text(payload):
+    pieces = []
+    for message in payload.get('messages', []):
+        pieces.append(f"<{message.get('role')}>")
+        content = message.get('content', "")
+        if isinstance(content, str):
+            pieces.append(content)
+            continue
+        for part in content:
+            if part.get('type') == 'image_url':
+                pieces.append(f"<image {hashlib.sha1(part['image_url']['url'].encode('utf-8')).hexdigest()}>")
+            else:
+                pieces.append(part.get('text', ""))
+    return "".join(pieces)
+
+
+# Function to embed text as a normalized hashed bag of words, so texts sharing words get similar vectors
+def text_embedding(text, dimensions=EMBEDDING_DIMENSIONS):
+    vector = [0.0] * dimensions
+    for word in re.findall(r"\w+", text.lower()):
+        digest = hashlib.md5(word.encode('utf-8')).digest()
+        vector[int.from_bytes(digest[:4], 'big') % dimensions] += 1.0 if digest[4] & 1 else -1.0
+    norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+    return [value / norm for value in vector]
+
+
+# Function to build a full chat completion response body and its token usage
+def chat_completion(state, payload, cached_tokens=None):
+    content = completion_content(state, payload)
+    if not payload.get('response_format'):
+        content = state.messy(content)
+    elif payload['response_format'].get('type') == 'json_object' and content.startswith('['):
+        content = json.dumps({'results': json.loads(content)})
+    prompt_tokens = estimate_tokens(dict(payload, max_tokens=0))
+    completion_tokens = max(len(content) // 4, 1)
+    if cached_tokens is None:
+        cached_tokens = state.cached_tokens(payload, prompt_tokens)
+    return {
+        'id': f"chatcmpl-{uuid.uuid4().hex[:12]}",
+        'object': 'chat.completion',
+        'created': int(time.time()),
+        'model': payload.get('model', 'unknown'),
+        'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}],
+        'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens, 'total_tokens': prompt_tokens + completion_tokens,
+                  'prompt_tokens_details': {'cached_tokens': cached_tokens}},
+    }
+
+
+class MockOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Keep-alive, so pooled client sessions behave as they do against the real API
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def state(self):
+        return self.server.state
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b""
+
+    def _send(self, status, body, headers=None, content_type='application/json'):
+        data = body if isinstance(body, bytes) else json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == '/stats':
+            with self.state.lock:
+                return self._send(200, self.state.stats)
+        if path.startswith('/images/'):
+            start = time.time()
+            time.sleep(self.state.sample_latency())
+            status = self.state.inject_error()
+            if status is not None:
+                self.state.record(status, time.time() - start)
+                return self._send(status, {'error': {'message': 'Injected error'}})
+            self.state.record(200, time.time() - start)
+            return self._send(200, self.state.image_bytes(path), content_type='image/jpeg')
+
+        match = re.fullmatch(r"/v1/batches/([\w-]+)", path)
+        if match and match.group(1) in self.state.batches:
+            batch = self.state.batches[match.group(1)]
+            if batch['status'] == 'in_progress' and time.time() - batch['created_at'] >= self.state.batch_delay:
+                batch['status'] = 'completed'
+                batch['request_counts']['completed'] = batch['request_counts']['total']
+            return self._send(200, batch)
+        match = re.fullmatch(r"/v1/files/([\w-]+)/content", path)
+        if match and match.group(1) in self.state.files:
+            return self._send(200, self.state.files[match.group(1)], content_type='application/jsonl')
+        self._send(404, {'error': {'message': f"Unknown path {path}"}})
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        body = self._read_body()
+        if path == '/stats/reset':
+            self.state.reset_stats()
+            return self._send(200, {'reset': True})
+        if path.endswith('/chat/completions'):
+            return self._chat_completions(json.loads(body))
+        if path.endswith('/embeddings'):
+            return self._embeddings(json.loads(body))
+        if path.endswith('/files'):
+            return self._upload_file(body)
+        if path.endswith('/batches'):
+            return self._create_batch(json.loads(body))
+        self._send(404, {'error': {'message': f"Unknown path {path}"}})
+
+    def _chat_completions(self, payload):
+        start = time.time()
+        prompt_tokens = estimate_tokens(dict(payload, max_tokens=0))
+        cached_tokens = self.state.cached_tokens(payload, prompt_tokens)
+        # A cached prefix doesn't have to be processed again, which shows up as lower latency
+        time.sleep(self.state.sample_latency() * (1 - PREFIX_CACHE_SPEEDUP * cached_tokens / max(prompt_tokens, 1)))
+        allowed, headers = self.state.admit(estimate_tokens(payload))
+        status = 429 if not allowed else self.state.inject_error()
+        if status is not None:
+            if status == 429:
+                headers['retry-after'] = "1"
+            self.state.record(status, time.time() - start)
+            return self._send(status, {'error': {'message': 'Injected error' if allowed else 'Rate limit reached', 'code': status}}, headers)
+
+        response = chat_completion(self.state, payload, cached_tokens)
+        self.state.record(200, time.time() - start, response['model'], response['usage']['prompt_tokens'], response['usage']['completion_tokens'])
+        self._send(200, response, headers)
+
+    def _embeddings(self, payload):
+        start = time.time()
+        time.sleep(self.state.sample_latency())
+        texts = payload.get('input', [])
+        texts = [texts] if isinstance(texts, str) else texts
+        prompt_tokens = sum(len(text) // 4 for text in texts)
+        self.state.record(200, time.time() - start, payload.get('model', 'unknown'), prompt_tokens)
+        self._send(200, {
+            'object': 'list', 'model': payload.get('model', 'unknown'),
+            'data': [{'object': 'embedding', 'index': i, 'embedding': text_embedding(text)} for i, text in enumerate(texts)],
+            'usage': {'prompt_tokens': prompt_tokens, 'total_tokens': prompt_tokens},
+        })
+
+    def _upload_file(self, body):
+        message = BytesParser(policy=HTTP).parsebytes(f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode('utf-8') + body)
+        for part in message.iter_parts():
+            if part.get_filename():
+                file_id = f"file-{uuid.uuid4().hex[:12]}"
+                self.state.files[file_id] = part.get_payload(decode=True)
+                return self._send(200, {'id': file_id, 'object': 'file', 'purpose': 'batch'})
+        self._send(400, {'error': {'message': 'No file in upload'}})
+
+    def _create_batch(self, request):
+        input_file = self.state.files.get(request.get('input_file_id'))
+        if input_file is None:
+            return self._send(404, {'error': {'message': 'Unknown input_file_id'}})
+
+        # Answers are computed up front; the batch only reports them once `batch_delay` has passed
+        output_lines = []
+        for line in input_file.decode('utf-8').splitlines():
+            if not line.strip():
+                continue
+            batch_request = json.loads(line)
+            response = chat_completion(self.state, batch_request['body'])
+            self.state.record(200, None, response['model'], response['usage']['prompt_tokens'], response['usage']['completion_tokens'])
+            output_lines.append(json.dumps({'id': f"batch_req_{uuid.uuid4().hex[:12]}", 'custom_id': batch_request['custom_id'],
+                                            'response': {'status_code': 200, 'body': response}, 'error': None}))
+        output_file_id = f"file-{uuid.uuid4().hex[:12]}"
+        self.state.files[output_file_id] = ("\n".join(output_lines) + "\n").encode('utf-8')
+
+        batch_id = f"batch_{uuid.uuid4().hex[:12]}"
+        self.state.batches[batch_id] = {
+            'id': batch_id, 'object': 'batch', 'status': 'in_progress', 'created_at': time.time(),
+            'input_file_id': request['input_file_id'], 'output_file_id': output_file_id, 'error_file_id': None,
+            'request_counts': {'total': len(output_lines), 'completed': 0, 'failed': 0},
+        }
+        self._send(200, self.state.batches[batch_id])
+
+
+class MockOpenAIServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024  # Benchmarks open hundreds of connections at once
+
+    def __init__(self, address, state):
+        super().__init__(address, MockOpenAIHandler)
+        self.state = state
+
+
+# Function to start the mock server on a background thread; port 0 picks a free port
+def start_mock_server(port=0, host='127.0.0.1', **options):
+    server = MockOpenAIServer((host, port), MockOpenAIState(**options))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the OpenAI chat completions, embeddings, files and batches endpoints.")
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help="Port to listen on.")
+    parser.add_argument('--latency_ms', type=float, default=200, help="Mean response latency in milliseconds.")
+    parser.add_argument('--latency_distribution', choices=LATENCY_DISTRIBUTIONS, default='lognormal', help="Shape of the response latency distribution.")
+    parser.add_argument('--latency_sigma', type=float, default=0.5, help="Log-space standard deviation of the lognormal distribution (larger means a longer tail).")
+    parser.add_argument('--rate_429', type=float, default=0.0, help="Fraction of requests answered with an injected 429.")
+    parser.add_argument('--rate_5xx', type=float, default=0.0, help="Fraction of requests answered with an injected 503.")
+    parser.add_argument('--rpm', type=int, default=None, help="Requests per minute before the server starts returning 429s.")
+    parser.add_argument('--tpm', type=int, default=None, help="Tokens per minute before the server starts returning 429s.")
+    parser.add_argument('--offensive_rate', type=float, default=0.5, help="Fraction of images the mock model calls offensive.")
+    parser.add_argument('--batch_delay', type=float, default=2.0, help="Seconds before a submitted batch reports completed.")
+    parser.add_argument('--image_kb', type=int, default=64, help="Size of the images served under /images/ when Pillow isn't installed.")
+    parser.add_argument('--messy_rate', type=float, default=0.0, help="Fraction of answers wrapped in prose or code fences unless JSON mode is requested.")
+    parser.add_argument('--no_prefix_cache', dest='prefix_cache', action='store_false', help="Don't simulate the API's automatic prompt (prefix) caching.")
+    parser.add_argument('--seed', type=int, default=None, help="Seed for latency and error injection.")
+    args = parser.parse_args()
+
+    options = vars(args)
+    port = options.pop('port')
+    server = MockOpenAIServer(('127.0.0.1', port), MockOpenAIState(**options))
+    print(f"Mock OpenAI server listening on http://127.0.0.1:{port}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+import json
+from array import array
+
+import numpy as np
+
+from metrics_engine import ABSTAINED, NOT_OFFENSIVE, OFFENSIVE
+
+ENSEMBLE_STRATEGIES = ('majority', 'escalate')
+ESCALATE_ON = ('abstain', 'offensive', 'not_offensive')
+
+# USD per million (input, cached input, output) tokens; other models are reported without a cost unless the matrix gives prices
+MODEL_PRICES = {
+    "gpt-4o-mini": (0.15, 0.075, 0.60),
+    "gpt-4o": (2.50, 1.25, 10.00),
+    "gpt-4": (30.00, 30.00, 60.00),
+}
+
+
+class ModelSpec:
+    """One model of the matrix: its name, its concurrency budget and optional price and rate-limit overrides."""
+
+    def __init__(self, name, max_concurrency, prices=None, rpm=None, tpm=None):
+        if max_concurrency < 1:
+            raise ValueError(f"Model '{name}' needs a concurrency budget of at least 1, got {max_concurrency}")
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.prices = tuple(prices) if prices else MODEL_PRICES.get(name)
+        self.rpm = rpm
+        self.tpm = tpm
+
+    def __repr__(self):
+        return f"ModelSpec({self.name}, max_concurrency={self.max_concurrency})"
+
+
+# Function to parse prompt_eval's --models: "gpt-4o-mini:16,gpt-4o:4" (name[:concurrency]) or a JSON file listing the models
+def parse_model_matrix(spec, default_concurrency):
+    """
+    Returns the models in the order given, which is also the escalation order (cheapest
+    first). A JSON matrix is a list of objects with "model" and optional
+    "max_concurrency", "prices" ([input, cached input, output] USD per million tokens),
+    "rpm" and "tpm".
+    """
+    if spec.endswith(".json"):
+        with open(spec, 'r') as f:
+            entries = json.load(f)
+        models = [ModelSpec(entry['model'], int(entry.get('max_concurrency', default_concurrency)), entry.get('prices'), entry.get('rpm'), entry.get('tpm'))
+                  for entry in entries]
+    else:
+        models = []
+        for part in filter(None, (part.strip() for part in spec.split(","))):
+            name, _, concurrency = part.partition(":")
+            try:
+                models.append(ModelSpec(name, int(concurrency) if concurrency else default_concurrency))
+            except ValueError as e:
+                raise ValueError(f"Models must look like NAME[:CONCURRENCY],... (e.g. gpt-4o-mini:16,gpt-4o:4), got '{part}'") from e
+    names = [model.name for model in models]
+    if not names:
+        raise ValueError("The model matrix lists no models")
+    if len(set(names)) != len(names):
+        raise ValueError(f"The model matrix lists a model twice: {', '.join(names)}")
+    return models
+
+
+class ModelUsage:
+    """Latency, token and image counts of one model's successful requests in this process."""
+
+    def __init__(self):
+        self.latencies = array('d')
+        self.images = 0
+        self.prompt_tokens = 0
+        self.cached_prompt_tokens = 0
+        self.completion_tokens = 0
+
+    def record(self, seconds, usage, images):
+        usage = usage or {}
+        self.latencies.append(seconds)
+        self.images += images
+        self.prompt_tokens += usage.get('prompt_tokens') or 0
+        self.cached_prompt_tokens += (usage.get('prompt_tokens_details') or {}).get('cached_tokens') or 0
+        self.completion_tokens += usage.get('completion_tokens') or 0
+
+    def cost(self, prices):
+        """USD spent on the recorded requests, or None without prices."""
+        if prices is None:
+            return None
+        input_price, cached_price, output_price = prices
+        return ((self.prompt_tokens - self.cached_prompt_tokens) * input_price + self.cached_prompt_tokens * cached_price
+                + self.completion_tokens * output_price) / 1e6
+
+    def summary(self, prices=None):
+        latencies = np.frombuffer(self.latencies, dtype=np.float64) if len(self.latencies) else np.zeros(1)
+        cost = self.cost(prices)
+        return {
+            'Requests': len(self.latencies),
+            'Images Requested': self.images,
+            'Prompt Tokens': self.prompt_tokens,
+            'Cached Prompt Tokens': self.cached_prompt_tokens,
+            'Completion Tokens': self.completion_tokens,
+            'Mean Latency ms': round(float(latencies.mean()) * 1000, 3),
+            'p95 Latency ms': round(float(np.percentile(latencies, 95)) * 1000, 3),
+            'Cost USD': None if cost is None else round(cost, 6),
+            'Cost per 1k Images USD': None if cost is None or not self.images else round(cost / self.images * 1000, 6),
+        }
+
+
+# Usage per model name, like the rate limiter registry
+_usage = {}
+
+
+def get_model_usage(model):
+    if model not in _usage:
+        _usage[model] = ModelUsage()
+    return _usage[model]
+
+
+# Function to combine several models' prediction codes for the same rows by majority vote
+def majority_vote(codes):
+    """A tie goes to the first model, in matrix order, that answered the row; rows no model answered stay abstained."""
+    stacked = np.vstack(codes)
+    offensive = (stacked == OFFENSIVE).sum(axis=0)
+    not_offensive = (stacked == NOT_OFFENSIVE).sum(axis=0)
+    result = np.full(stacked.shape[1], ABSTAINED, dtype=np.int8)
+    result[offensive > not_offensive] = OFFENSIVE
+    result[not_offensive > offensive] = NOT_OFFENSIVE
+    for model_codes in codes:
+        tied = (result == ABSTAINED) & (model_codes != ABSTAINED)
+        result[tied] = model_codes[tied]
+    return result
+
+
+# Function to mark the rows whose answer should be passed on to the next model of an escalation chain
+def needs_escalation(codes, escalate_on='abstain'):
+    mask = codes == ABSTAINED
+    if escalate_on == 'offensive':
+        mask |= codes == OFFENSIVE
+    elif escalate_on == 'not_offensive':
+        mask |= codes == NOT_OFFENSIVE
+    return mask
+
+
+# Function to combine prediction codes by escalation: each model answers only the rows the models before it passed on
+def escalate(codes, escalate_on='abstain'):
+    """Returns (codes, shares), where shares[i] is the fraction of rows model i had to answer (1.0 for the first)."""
+    result = codes[0].copy()
+    open_rows = needs_escalation(result, escalate_on)
+    shares = [1.0]
+    for model_codes in codes[1:]:
+        shares.append(float(open_rows.mean()) if len(open_rows) else 0.0)
+        result[open_rows] = model_codes[open_rows]
+        open_rows &= needs_escalation(model_codes, escalate_on)
+    return result, shares
+
+
+def ensemble_results(results, prompt_files, models, strategies, escalate_on='abstain'):
+    """
+    Combine the (prompt_file, model) prediction codes of every prompt into each ensemble.
+
+    Returns ({(prompt_file, strategy): codes}, {(prompt_file, strategy): [share of rows
+    each model answers]}). Every model answers every row of a majority vote; an escalation
+    chain only pays for the later models on the rows that reach them, which is what its
+    cost and latency estimates are weighted by.
+    """
+    combined, shares = {}, {}
+    for prompt_file in prompt_files:
+        codes = [results[(prompt_file, model.name)] for model in models if (prompt_file, model.name) in results]
+        if len(codes) < len(models):
+            continue  # The prompt couldn't be loaded
+        for strategy in strategies:
+            if strategy == 'majority':
+                combined[(prompt_file, strategy)], shares[(prompt_file, strategy)] = majority_vote(codes), [1.0] * len(codes)
+            else:
+                combined[(prompt_file, strategy)], shares[(prompt_file, strategy)] = escalate(codes, escalate_on)
+    return combined, shares
+
+
+# Function to estimate what an ensemble costs per image and how long it takes to answer one, from its models' usage
+def ensemble_usage(strategy, model_summaries, shares):
+    costs = [summary['Cost per 1k Images USD'] for summary in model_summaries]
+    latencies = [summary['Mean Latency ms'] for summary in model_summaries]
+    cost = None if any(value is None for value in costs) else round(sum(share * value for share, value in zip(shares, costs)), 6)
+    if strategy == 'majority':
+        latency = max(latencies)  # The models are asked side by side
+    else:
+        latency = sum(share * value for share, value in zip(shares, latencies))  # Later models only see the rows passed on, one after another
+    return {'Model Shares': [round(share, 4) for share in shares], 'Mean Latency ms': round(latency, 3), 'Cost per 1k Images USD': cost}
+
+
+# Function to pick the cheapest model or ensemble whose F1 reaches the bar; `options` maps a label to (F1, cost per 1k images)
+def cheapest_passing(options, min_f1):
+    passing = [(cost, -f1, label) for label, (f1, cost) in options.items() if f1 >= min_f1 and cost is not None]
+    return min(passing)[2] if passing else None
@@ -0,0 +1,189 @@
+import functools
+import json
+import os
+import threading
+import time
+from array import array
+from contextlib import contextmanager
+
+import numpy as np
+
+# Spans recorded on the hot path, in the order they are reported
+SPAN_NAMES = (
+    "image_encode",     # Reading, preprocessing and base64-encoding an image
+    "image_read",       # Slicing an already encoded image out of the memory-mapped spool
+    "payload_build",    # Building the chat completion payload
+    "cache_lookup",     # Response cache lookups
+    "queue_wait",       # Time a request group waited in the async queue for a free worker
+    "rate_limit_wait",  # Time spent waiting on the shared token bucket
+    "retry_sleep",      # Backoff after a 429 before the request could be retried
+    "http",             # HTTP round-trip, including reading the response body
+    "http_prefix_cached",  # HTTP round-trips where the API served part of the prompt from its prompt cache
+    "http_uncached",    # HTTP round-trips with no cached prompt tokens
+    "parse",            # Parsing the model's JSON verdict
+    "batch_job",        # Submitting and polling an offline Batch API job
+    "cascade",          # Scoring images with the cascade's local pre-filter
+    "metrics",          # Computing the evaluation metrics
+)
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class PerfTracer:
+    """
+    In-process collector of timing spans and counters.
+
+    Every span duration is appended to a compact array (8 bytes per sample), so
+    percentiles are exact and recording costs two perf_counter calls. Worker processes
+    keep their own tracer and hand a `snapshot()` back to the parent to `merge()`.
+    Updates take a lock, since the image prefetch threads record spans too.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.spans = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def record(self, name, seconds):
+        with self._lock:
+            samples = self.spans.get(name)
+            if samples is None:
+                samples = self.spans[name] = array('d')
+            samples.append(seconds)
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def count_usage(self, usage):
+        """Add the token counts from a chat completion's `usage` field, including prompt tokens served from the prompt cache."""
+        if not usage:
+            return
+        for key in ("prompt_tokens", "completion_tokens", "total_tokens"):
+            if usage.get(key):
+                self.count(key, usage[key])
+        cached_tokens = (usage.get("prompt_tokens_details") or {}).get("cached_tokens")
+        if cached_tokens:
+            self.count("cached_prompt_tokens", cached_tokens)
+
+    def snapshot(self):
+        with self._lock:
+            return {'spans': {name: samples.tolist() for name, samples in self.spans.items()}, 'counters': dict(self.counters)}
+
+    def merge(self, snapshot):
+        with self._lock:
+            for name, samples in snapshot['spans'].items():
+                self.spans.setdefault(name, array('d')).extend(samples)
+        for name, value in snapshot['counters'].items():
+            self.count(name, value)
+
+    def reset(self):
+        self.__init__()
+
+    def summary(self):
+        """Machine-readable summary: per-span count, total and latency percentiles, plus counters."""
+        spans = {}
+        ordered = [name for name in SPAN_NAMES if name in self.spans] + sorted(set(self.spans) - set(SPAN_NAMES))
+        for name in ordered:
+            samples = np.frombuffer(self.spans[name], dtype=np.float64) if len(self.spans[name]) else np.zeros(1)
+            p50, p95, p99 = np.percentile(samples, [q * 100 for q in QUANTILES])
+            spans[name] = {
+                'count': len(self.spans[name]),
+                'total_seconds': round(float(samples.sum()), 6),
+                'mean_ms': round(float(samples.mean()) * 1000, 3),
+                'p50_ms': round(float(p50) * 1000, 3),
+                'p95_ms': round(float(p95) * 1000, 3),
+                'p99_ms': round(float(p99) * 1000, 3),
+                'max_ms': round(float(samples.max()) * 1000, 3),
+            }
+        return {'wall_seconds': round(time.time() - self.started, 3), 'spans': spans, 'counters': dict(sorted(self.counters.items()))}
+
+    def openmetrics(self, prefix="prompt_eval", labels=None):
+        """Render the summary in the Prometheus/OpenMetrics text exposition format."""
+        base_labels = ",".join(f'{key}="{value}"' for key, value in (labels or {}).items())
+        join = lambda extra: "{" + ",".join(part for part in (base_labels, extra) if part) + "}"
+        summary = self.summary()
+
+        lines = [f"# TYPE {prefix}_span_seconds summary", f"# HELP {prefix}_span_seconds Duration of instrumented hot-path spans."]
+        for name, span in summary['spans'].items():
+            span_label = f'span="{name}"'
+            for quantile, key in zip(QUANTILES, ('p50_ms', 'p95_ms', 'p99_ms')):
+                quantile_label = f'{span_label},quantile="{quantile}"'
+                lines.append(f"{prefix}_span_seconds{join(quantile_label)} {span[key] / 1000}")
+            lines.append(f"{prefix}_span_seconds_sum{join(span_label)} {span['total_seconds']}")
+            lines.append(f"{prefix}_span_seconds_count{join(span_label)} {span['count']}")
+        for name, value in summary['counters'].items():
+            lines.append(f"# TYPE {prefix}_{name} counter")
+            lines.append(f"{prefix}_{name}_total{join('')} {value}")
+        lines.append(f"# TYPE {prefix}_wall_seconds gauge")
+        lines.append(f"{prefix}_wall_seconds{join('')} {summary['wall_seconds']}")
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+
+# One tracer per process, like the rate limiter registry
+_tracer = PerfTracer()
+
+
+def get_tracer():
+    return _tracer
+
+
+# Decorator that records every call of the wrapped function as a span
+def traced(name):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with _tracer.span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# Function to write the per-run performance summary as JSON
+def save_perf_summary(tracer, path, **details):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    summary = tracer.summary()
+    summary.update(details)
+    with open(path, 'w') as f:
+        json.dump(summary, f, indent=4)
+    return summary
+
+
+# Function to export the metrics as an OpenMetrics text file (e.g. for node_exporter's textfile collector) or to a Pushgateway
+def export_openmetrics(tracer, textfile=None, pushgateway=None, job="prompt_eval", labels=None):
+    text = tracer.openmetrics(labels=labels)
+    if textfile:
+        temp_path = f"{textfile}.{os.getpid()}.tmp"
+        with open(temp_path, 'w') as f:
+            f.write(text)
+        os.replace(temp_path, textfile)  # The collector must never read a half-written file
+    if pushgateway:
+        import requests
+
+        try:
+            # The Pushgateway's text parser predates OpenMetrics and rejects the trailing "# EOF"
+            response = requests.put(f"{pushgateway.rstrip('/')}/metrics/job/{job}", data=text.replace("# EOF\n", ""), timeout=10)
+            response.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            print(f"Error: Could not push metrics to {pushgateway} - {e}")
+
+
+# Function to print a one-line-per-span breakdown of where a run spent its time
+def print_perf_summary(summary):
+    print("\nPerformance summary (wall time {:.1f}s):".format(summary['wall_seconds']))
+    for name, span in summary['spans'].items():
+        print(f"  {name:<18} n={span['count']:<8} total={span['total_seconds']:>9.2f}s  p50={span['p50_ms']:>8.1f}ms  p99={span['p99_ms']:>8.1f}ms")
+    counters = summary['counters']
+    if counters:
+        print("  " + ", ".join(f"{name}={value}" for name, value in counters.items()))
+    if counters.get('prompt_tokens'):
+        print(f"  prompt cache: {counters.get('cached_prompt_tokens', 0) / counters['prompt_tokens']:.1%} of prompt tokens served from cache")
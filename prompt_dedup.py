@@ -0,0 +1,282 @@
+import argparse
+import csv
+import hashlib
+import os
+import re
+import sqlite3
+import time
+
+import numpy as np
+
+from response_cache import content_hash
+from similarity_engine import SimilarityEngine
+
+DEFAULT_INDEX_PATH = ".cache/prompt_index.sqlite3"
+DUPLICATE_THRESHOLD = 0.9  # TF-IDF cosine at or above which two prompts count as near-duplicates
+SHINGLE_SIZE = 3  # Words per shingle
+NUM_PERMUTATIONS = 128  # MinHash signature length
+NUM_BANDS = 32  # LSH bands of NUM_PERMUTATIONS / NUM_BANDS rows; pairs with Jaccard ~0.5 and up become candidates
+MINHASH_SEED = 1
+
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64((1 << 32) - 1)
+_WORD = re.compile(r"\w+")
+
+
+# Function to split a prompt into its set of lowercase word shingles
+def shingles(text, size=SHINGLE_SIZE):
+    words = _WORD.findall(text.lower())
+    if len(words) <= size:
+        return {" ".join(words)}
+    return {" ".join(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+class MinHasher:
+    """
+    MinHash signatures over word shingles, computed with NumPy.
+
+    Each shingle is hashed once (32-bit) and all permutations are applied together as
+    (a * x + b) mod p, so a prompt's signature is one vectorized min over a
+    (shingles x permutations) array. The seeded coefficients keep signatures comparable
+    across runs, which is what lets the index persist them.
+    """
+
+    def __init__(self, num_perm=NUM_PERMUTATIONS, seed=MINHASH_SEED):
+        generator = np.random.RandomState(seed)
+        self.num_perm = num_perm
+        self._a = generator.randint(1, np.iinfo(np.int64).max, size=num_perm, dtype=np.int64).astype(np.uint64) % _MERSENNE_PRIME
+        self._b = generator.randint(0, np.iinfo(np.int64).max, size=num_perm, dtype=np.int64).astype(np.uint64) % _MERSENNE_PRIME
+
+    def signature(self, text):
+        hashes = np.fromiter((int.from_bytes(hashlib.blake2b(shingle.encode('utf-8'), digest_size=4).digest(), 'big') for shingle in shingles(text)),
+                             dtype=np.uint64)
+        with np.errstate(over='ignore'):  # Wraps around like the reference implementation; the mod keeps it uniform
+            permuted = ((hashes[:, None] * self._a + self._b) % _MERSENNE_PRIME) & _MAX_HASH
+        return permuted.min(axis=0)
+
+
+# Function to hash each LSH band of a signature to a signed 64-bit bucket id (what SQLite stores as INTEGER)
+def band_buckets(signature, num_bands=NUM_BANDS):
+    return [int.from_bytes(hashlib.blake2b(band.tobytes(), digest_size=8).digest(), 'big', signed=True)
+            for band in np.split(signature, num_bands)]
+
+
+class PromptIndex:
+    """
+    Persistent MinHash/LSH index of the prompt library, keyed by prompt content hash.
+
+    Adding prompts only signs texts the index hasn't seen, so the index grows
+    incrementally as prompt files arrive. Candidate pairs come from an indexed lookup of
+    shared LSH buckets, and each candidate is then verified with the TF-IDF cosine from
+    similarity_engine (one fit over the library, one batched pairwise call), so the
+    threshold means the same thing as in metadata change detection. The index also
+    remembers which prompts have been evaluated.
+    """
+
+    def __init__(self, path=DEFAULT_INDEX_PATH, threshold=DUPLICATE_THRESHOLD, num_perm=NUM_PERMUTATIONS, num_bands=NUM_BANDS):
+        if num_perm % num_bands:
+            raise ValueError(f"{num_perm} permutations can't be split into {num_bands} equal bands")
+        self.path = path
+        self.threshold = threshold
+        self.num_bands = num_bands
+        self.hasher = MinHasher(num_perm)
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS prompts (
+                content_hash TEXT PRIMARY KEY,
+                location TEXT NOT NULL,
+                text TEXT NOT NULL,
+                signature BLOB NOT NULL,
+                added REAL NOT NULL,
+                evaluated REAL
+            )
+        """)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS lsh_buckets (
+                band INTEGER NOT NULL,
+                bucket INTEGER NOT NULL,
+                content_hash TEXT NOT NULL,
+                PRIMARY KEY (band, bucket, content_hash)
+            ) WITHOUT ROWID
+        """)
+        # The primary key leads with (band, bucket); lookups by prompt need their own index
+        self._conn.execute("CREATE INDEX IF NOT EXISTS lsh_buckets_hash ON lsh_buckets (content_hash)")
+        self._conn.commit()
+
+    def __len__(self):
+        return self._conn.execute("SELECT COUNT(*) FROM prompts").fetchone()[0]
+
+    def add(self, prompt_texts):
+        """Index {location: text}; returns how many texts were new. Known texts only have their location refreshed."""
+        known = {row[0] for row in self._conn.execute("SELECT content_hash FROM prompts")}
+        new_rows, bucket_rows, moved = [], [], []
+        for location, text in prompt_texts.items():
+            text_hash = content_hash(text)
+            if text_hash in known:
+                moved.append((location, text_hash))
+                continue
+            known.add(text_hash)
+            signature = self.hasher.signature(text)
+            new_rows.append((text_hash, location, text, signature.tobytes(), time.time()))
+            bucket_rows.extend((band, bucket, text_hash) for band, bucket in enumerate(band_buckets(signature, self.num_bands)))
+        with self._conn:
+            self._conn.executemany("INSERT INTO prompts (content_hash, location, text, signature, added) VALUES (?, ?, ?, ?, ?)", new_rows)
+            self._conn.executemany("INSERT OR IGNORE INTO lsh_buckets (band, bucket, content_hash) VALUES (?, ?, ?)", bucket_rows)
+            self._conn.executemany("UPDATE prompts SET location = ? WHERE content_hash = ?", moved)
+        return len(new_rows)
+
+    def candidate_pairs(self, content_hashes=None):
+        """Pairs of distinct prompts sharing at least one LSH bucket (involving `content_hashes`, if given)."""
+        query = """
+            SELECT DISTINCT a.content_hash, b.content_hash FROM lsh_buckets a
+            JOIN lsh_buckets b ON a.band = b.band AND a.bucket = b.bucket AND a.content_hash < b.content_hash
+        """
+        if content_hashes is None:
+            return set(self._conn.execute(query))
+        # One join against a temporary table of the query hashes instead of one query per prompt
+        self._conn.execute("CREATE TEMP TABLE IF NOT EXISTS query_hashes (content_hash TEXT PRIMARY KEY)")
+        self._conn.execute("DELETE FROM query_hashes")
+        self._conn.executemany("INSERT OR IGNORE INTO query_hashes (content_hash) VALUES (?)", ((text_hash,) for text_hash in content_hashes))
+        pairs = {tuple(sorted(pair)) for pair in self._conn.execute("""
+            SELECT DISTINCT a.content_hash, b.content_hash FROM query_hashes q
+            JOIN lsh_buckets a ON a.content_hash = q.content_hash
+            JOIN lsh_buckets b ON a.band = b.band AND a.bucket = b.bucket AND a.content_hash != b.content_hash
+        """)}
+        self._conn.execute("DELETE FROM query_hashes")
+        self._conn.commit()
+        return pairs
+
+    def near_duplicates(self, content_hashes=None):
+        """Verified near-duplicate pairs as {(hash_a, hash_b): similarity}, scored in one batch."""
+        pairs = sorted(self.candidate_pairs(content_hashes))
+        if not pairs:
+            return {}
+        texts = dict(self._conn.execute("SELECT content_hash, text FROM prompts"))
+        engine = SimilarityEngine().fit(list(texts.values()))
+        scores = engine.pairwise([texts[a] for a, _ in pairs], [texts[b] for _, b in pairs])
+        return {pair: float(score) for pair, score in zip(pairs, scores) if score >= self.threshold}
+
+    def clusters(self, content_hashes=None):
+        """Groups of near-duplicate prompts (union-find over verified pairs), as lists of locations, largest first."""
+        locations = dict(self._conn.execute("SELECT content_hash, location FROM prompts ORDER BY added"))
+        if content_hashes is not None:
+            locations = {text_hash: location for text_hash, location in locations.items() if text_hash in content_hashes}
+        parent = {text_hash: text_hash for text_hash in locations}
+
+        def find(text_hash):
+            while parent[text_hash] != text_hash:
+                parent[text_hash] = parent[parent[text_hash]]
+                text_hash = parent[text_hash]
+            return text_hash
+
+        for a, b in self.near_duplicates(content_hashes):
+            if a not in parent or b not in parent:
+                continue  # A near-duplicate outside the prompts being clustered
+            root_a, root_b = find(a), find(b)
+            if root_a != root_b:
+                parent[root_b] = root_a
+        groups = {}
+        for text_hash in locations:  # Oldest prompt first, so it becomes the cluster's representative
+            groups.setdefault(find(text_hash), []).append(locations[text_hash])
+        return sorted(groups.values(), key=len, reverse=True)
+
+    def mark_evaluated(self, prompt_texts):
+        with self._conn:
+            self._conn.executemany("UPDATE prompts SET evaluated = ? WHERE content_hash = ?",
+                                   [(time.time(), content_hash(text)) for text in prompt_texts])
+
+    def evaluated(self):
+        return {row[0] for row in self._conn.execute("SELECT content_hash FROM prompts WHERE evaluated IS NOT NULL")}
+
+    def plan_skips(self, prompt_texts):
+        """
+        Decide which of {location: text} can be skipped as near-duplicates.
+
+        Prompts are taken in order; one is skipped when its text is within the threshold of
+        an already evaluated prompt or of a prompt kept earlier in the same run. A prompt
+        whose own text was evaluated before is always kept (its responses are cached).
+        Returns {skipped location: (location of the near-duplicate, similarity)}.
+        """
+        self.add(prompt_texts)
+        hashes = {location: content_hash(text) for location, text in prompt_texts.items()}
+        duplicates = {}
+        for (a, b), similarity in self.near_duplicates(set(hashes.values())).items():
+            duplicates.setdefault(a, []).append((b, similarity))
+            duplicates.setdefault(b, []).append((a, similarity))
+        locations = dict(self._conn.execute("SELECT content_hash, location FROM prompts"))
+
+        evaluated = self.evaluated()
+        kept = {text_hash: locations[text_hash] for text_hash in evaluated}
+        skips = {}
+        for location, text_hash in hashes.items():
+            if text_hash in evaluated:
+                continue
+            if text_hash in kept:
+                skips[location] = (kept[text_hash], 1.0)  # The same text twice in one run
+                continue
+            match = max(((kept[other], similarity) for other, similarity in duplicates.get(text_hash, []) if other in kept),
+                        key=lambda item: item[1], default=None)
+            if match:
+                skips[location] = match
+            else:
+                kept[text_hash] = location
+        return skips
+
+    def close(self):
+        self._conn.close()
+
+
+# Function to read every .txt prompt in a folder as {location: text}
+def read_prompt_folder(prompts_folder):
+    prompt_texts = {}
+    for file_name in sorted(os.listdir(prompts_folder)):
+        if file_name.endswith(".txt"):
+            location = os.path.join(prompts_folder, file_name)
+            with open(location, 'r') as f:
+                prompt_texts[location] = f.read().strip()
+    return prompt_texts
+
+
+# Main function to index a prompt folder and report its near-duplicate clusters
+def main():
+    parser = argparse.ArgumentParser(description="Find clusters of near-duplicate prompts with an incremental MinHash/LSH index.")
+    parser.add_argument('--prompts_folder', type=str, default="prompts/", help="Folder containing the prompt text files.")
+    parser.add_argument('--index_file', type=str, default=DEFAULT_INDEX_PATH, help="SQLite file holding the prompt index (updated in place).")
+    parser.add_argument('--threshold', type=float, default=DUPLICATE_THRESHOLD, help="TF-IDF cosine similarity at or above which prompts are near-duplicates.")
+    parser.add_argument('--output_file', type=str, default=None, help="Also write every prompt's cluster to this CSV.")
+    args = parser.parse_args()
+
+    try:
+        prompt_texts = read_prompt_folder(args.prompts_folder)
+    except FileNotFoundError:
+        print(f"Error: The prompts folder '{args.prompts_folder}' was not found.")
+        return
+
+    index = PromptIndex(args.index_file, threshold=args.threshold)
+    try:
+        added = index.add(prompt_texts)
+        print(f"Indexed {added} new prompts ({len(index)} in {args.index_file}).")
+        clusters = index.clusters({content_hash(text) for text in prompt_texts.values()})
+    finally:
+        index.close()
+
+    duplicated = [cluster for cluster in clusters if len(cluster) > 1]
+    print(f"{len(duplicated)} clusters of near-duplicates ({sum(len(cluster) - 1 for cluster in duplicated)} prompts could be skipped).")
+    for number, cluster in enumerate(duplicated, start=1):
+        print(f"\nCluster {number}: {cluster[0]}")
+        for location in cluster[1:]:
+            print(f"  ~ {location}")
+
+    if args.output_file:
+        with open(args.output_file, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['Cluster', 'Representative', 'Prompt File Location'])
+            for number, cluster in enumerate(clusters, start=1):
+                writer.writerows([number, cluster[0], location] for location in cluster)
+        print(f"Clusters written to {args.output_file}")
+
+
+if __name__ == "__main__":
+    main()
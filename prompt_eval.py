@@ -1,29 +1,77 @@
 import os
-import openai
-import base64
-import requests
 import json
-import pandas as pd
-from sklearn.metrics import precision_score, recall_score, f1_score
+import asyncio
+import argparse
+import numpy as np
 from datetime import datetime
-from multiprocessing import Pool, cpu_count
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import time
-import requests
 import random
-from tqdm import tqdm
+from rate_limiter import configure_rate_limits, estimate_tokens, get_rate_limiter, get_rate_limiters, install_rate_limiters
+from response_cache import DEFAULT_CACHE_PATH, ResponseCache, content_hash
+from run_log import DEFAULT_RUNS_FOLDER, RunLog
+from batch_api import POLL_INTERVAL, run_batch_job
+from metrics_engine import ABSTAINED, DEFAULT_BOOTSTRAP_SAMPLES, compute_metrics, encode_prediction, load_guideline_categories
+from dataset_stream import DEFAULT_CHUNK_SIZE, Dataset, PathColumn, load_dataset
+from response_parser import parse_verdict, parse_verdict_list
+from sharding import SHARD_BY, parse_shard
+from prompt_dedup import DEFAULT_INDEX_PATH, DUPLICATE_THRESHOLD, PromptIndex
+from prompt_loader import load_prompt_manifest
+from cascade import Cascade, cascade_report, local_row_codes, split_audit_sample
+from model_matrix import ENSEMBLE_STRATEGIES, ESCALATE_ON, ModelSpec, cheapest_passing, ensemble_results, ensemble_usage, get_model_usage, parse_model_matrix
+from sequential_testing import DEFAULT_CONFIDENCE, DEFAULT_MIN_SAMPLES, DEFAULT_ROUND_SIZE, run_prompt_tournament
+from image_store import ImageStore
+from perf import export_openmetrics, get_tracer, print_perf_summary, save_perf_summary, traced
+from image_preprocess import DEFAULT_JPEG_QUALITY, DEFAULT_MAX_DIMENSION, DEFAULT_PREPROCESS_CACHE, ImagePreprocessor
 
 
 # Set your OpenAI API key (make sure you've set this in your environment variables)
-openai.api_key = os.getenv("OPENAI_API_KEY")
-
-# Helper function to encode an image in base64 (done once for each image)
-def encode_image(image_path):
-    try:
-        with open(image_path, "rb") as image_file:
-            return base64.b64encode(image_file.read()).decode('utf-8')
-    except FileNotFoundError:
-        print(f"Error: The image file at {image_path} was not found.")
-        return None
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+
+# aiohttp, pandas, tqdm and multiprocessing.Pool are imported inside the functions that use them,
+# so `--help`, the other CLI subcommands and spawned pool workers don't pay for loading them
+
+OPENAI_API_BASE = os.getenv("OPENAI_API_BASE", "https://api.openai.com/v1")
+OPENAI_CHAT_URL = f"{OPENAI_API_BASE}/chat/completions"
+DEFAULT_MODEL = "gpt-4o-mini"
+SYSTEM_PROMPT = "You are an image classifier checking for offensive content."
+
+# Multi-image requests: each image is introduced by its id and the model answers with one verdict per id
+BATCH_INSTRUCTIONS = (
+    "Several product images follow, each introduced by its image_id. Evaluate every image separately "
+    "using the instructions above and return ONLY a JSON array with one object per image, in the same order. "
+    "Each object must contain an \"image_id\" field with the id given for that image, plus the fields of "
+    "the JSON format requested above."
+)
+BATCH_TOKENS_PER_IMAGE = 300
+# JSON mode only allows an object at the top level, so the array of verdicts is wrapped
+JSON_MODE_BATCH_INSTRUCTIONS = " Wrap the array in a JSON object under the key \"results\"."
+RESPONSE_FORMAT = None  # Set by configure_json_mode
+
+# 'prefix_cache' puts the system message, prompt and instructions in one stable leading prefix and the images last,
+# so the API's automatic prompt caching can reuse the processed prefix across every image of a prompt
+PROMPT_LAYOUTS = ('default', 'prefix_cache')
+PROMPT_LAYOUT = 'default'  # Set by configure_prompt_layout
+
+# Maximum number of (prompt, image) requests in flight at once across the whole run
+MAX_CONCURRENCY = 16
+PREFETCH_WORKERS = 4  # Threads reading and encoding images ahead of the request queue
+REQUEST_TIMEOUT = 60  # Seconds before a single API call is abandoned
+MAX_RETRIES = 5  # Retries after a 429; the shared rate limiter keeps these rare
+DEFAULT_GUIDELINES_FILE = "guidelines/guidelines.json"
+
+# Helper function to build an argparse type that rejects integers below `minimum` at parse time
+def int_at_least(minimum):
+    def parse(value):
+        try:
+            number = int(value)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"invalid int value: '{value}'")
+        if number < minimum:
+            raise argparse.ArgumentTypeError(f"must be at least {minimum}, got {number}")
+        return number
+    return parse
 
 # Helper function to load the prompt from a text file
 def load_prompt(prompt_file):
@@ -36,139 +84,593 @@ def load_prompt(prompt_file):
 
 
 
-def send_prompt_with_image(encoded_image, prompt, max_retries=3):
-    if not encoded_image:
-        return "DUMMY"  # Return a dummy value if the image can't be encoded
+# Point every API call (chat completions and the Batch API) at another base URL, e.g. a local stub server
+def configure_api_base(api_base):
+    global OPENAI_API_BASE, OPENAI_CHAT_URL
+    OPENAI_API_BASE = api_base.rstrip("/")
+    OPENAI_CHAT_URL = f"{OPENAI_API_BASE}/chat/completions"
+
+# Ask the API for JSON mode ({"type": "json_object"}), so every answer is a syntactically valid JSON object
+def configure_json_mode(enabled):
+    global RESPONSE_FORMAT
+    RESPONSE_FORMAT = {"type": "json_object"} if enabled else None
+
+# Choose how the static prompt text and the per-image content are laid out in each request
+def configure_prompt_layout(layout):
+    global PROMPT_LAYOUT
+    if layout not in PROMPT_LAYOUTS:
+        raise ValueError(f"Unknown prompt layout '{layout}' (expected one of {', '.join(PROMPT_LAYOUTS)})")
+    PROMPT_LAYOUT = layout
 
-    # Headers for OpenAI API
-    headers = {
+# Helper function to build the leading system message of the prefix-cache layout; it is byte-identical for every image of a prompt
+def prefix_cache_messages(prompt):
+    return [{"role": "system", "content": f"{SYSTEM_PROMPT}\n\n{prompt}"}]
+
+# Helper function to build the request headers for the OpenAI API
+def build_headers():
+    return {
         "Content-Type": "application/json",
-        "Authorization": f"Bearer {openai.api_key}"
+        "Authorization": f"Bearer {OPENAI_API_KEY}"
     }
 
-    # Payload to send to OpenAI with the prompt and encoded image
+# Helper function to build an image content part for the chat completions API
+def image_content_part(encoded_image):
+    return {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{encoded_image}"}}
+
+# Helper function to count the images a payload carries
+def payload_image_count(payload):
+    return sum(1 for message in payload["messages"] if isinstance(message["content"], list) for part in message["content"] if part.get("type") == "image_url")
+
+# Helper function to build the chat completion payload for one prompt and image
+@traced("payload_build")
+def build_payload(encoded_image, prompt, model=DEFAULT_MODEL, max_tokens=500):
     payload = {
-        "model": "gpt-4o-mini",  
+        "model": model,
         "messages": [
-            {"role": "system", "content": "You are an image classifier checking for offensive content."},
+            {"role": "system", "content": SYSTEM_PROMPT},
             {"role": "user", "content": prompt},
-            {"role": "user", "content": f"data:image/jpeg;base64,{encoded_image}"}
+            {"role": "user", "content": [image_content_part(encoded_image)]}
         ],
-        "max_tokens": 500  # Adjust this based on your needs
+        "max_tokens": max_tokens  # Adjust this based on your needs
     }
-
-    retries = 0  # Keep track of how many retries have been made
+    if PROMPT_LAYOUT == 'prefix_cache':
+        payload["messages"] = prefix_cache_messages(prompt) + [{"role": "user", "content": [image_content_part(encoded_image)]}]
+        payload["prompt_cache_key"] = content_hash(prompt)[:32]  # Routes every request sharing this prefix to the same cache
+    if RESPONSE_FORMAT:
+        payload["response_format"] = RESPONSE_FORMAT
+    return payload
+
+# Helper function to build one payload that classifies several images; `images` is a list of (image_id, encoded_image)
+@traced("payload_build")
+def build_batch_payload(images, prompt, model=DEFAULT_MODEL, max_tokens_per_image=BATCH_TOKENS_PER_IMAGE):
+    instructions = {"type": "text", "text": BATCH_INSTRUCTIONS + (JSON_MODE_BATCH_INSTRUCTIONS if RESPONSE_FORMAT else "")}
+    content = []
+    for image_id, encoded_image in images:
+        content.append({"type": "text", "text": f"image_id: {image_id}"})
+        content.append(image_content_part(encoded_image))
+    if PROMPT_LAYOUT == 'prefix_cache':
+        # The instructions are the same for every group, so they go ahead of the images and stay inside the cached prefix
+        payload = {
+            "model": model,
+            "messages": prefix_cache_messages(prompt) + [{"role": "user", "content": [instructions] + content}],
+            "max_tokens": max_tokens_per_image * len(images),
+            "prompt_cache_key": content_hash(prompt)[:32],
+        }
+        if RESPONSE_FORMAT:
+            payload["response_format"] = RESPONSE_FORMAT
+        return payload
+    content.append(instructions)
+    payload = {
+        "model": model,
+        "messages": [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": prompt},
+            {"role": "user", "content": content}
+        ],
+        "max_tokens": max_tokens_per_image * len(images)
+    }
+    if RESPONSE_FORMAT:
+        payload["response_format"] = RESPONSE_FORMAT
+    return payload
+
+# Helper function to look up a response in the cache; returns (cache key parts, cached response)
+@traced("cache_lookup")
+def lookup_cached_response(cache, model, prompt, encoded_image, params):
+    if cache is None:
+        return None, None
+    cache_entry = ResponseCache.make_key(model, prompt, encoded_image, params)
+    return cache_entry, cache.get(cache_entry[0])
+
+# Helper function to describe everything besides the model, prompt and image that shapes an answer
+def cache_params(payload, layout):
+    params = {k: v for k, v in payload.items() if k not in ('model', 'messages', 'prompt_cache_key')}
+    params.update(system=SYSTEM_PROMPT, layout=cache_layout(layout))
+    return params
+
+# Helper function to name a request layout for the cache key; the default layout keeps its historical name so cached answers stay valid
+def cache_layout(layout):
+    return layout if PROMPT_LAYOUT == 'default' else f"{layout}+{PROMPT_LAYOUT}"
+
+# Helper function to store a successful response in the response cache
+def store_cached_response(cache, cache_entry, model, response):
+    if cache is not None and cache_entry is not None:
+        key, prompt_hash, image_hash = cache_entry
+        cache.put(key, model, prompt_hash, image_hash, response)
+
+# Helper function to work out how long to back off after a 429
+def retry_wait_time(headers, retries):
+    retry_after = headers.get("retry-after")
+    try:
+        if retry_after is not None:
+            return float(retry_after) + random.uniform(0, 1)
+    except ValueError:
+        pass
+    # Randomized exponential backoff: base wait time + a small random float
+    return 2 ** retries + random.uniform(0, 1)  # Adds some randomness to avoid clumping
+
+# Helper function to read total token usage from a completion response
+def response_token_usage(result):
+    return (result.get('usage') or {}).get('total_tokens')
+
+# Helper function to read how many prompt tokens the API served from its prompt cache
+def cached_prompt_tokens(result):
+    return ((result.get('usage') or {}).get('prompt_tokens_details') or {}).get('cached_tokens') or 0
+
+# Helper function to send one chat completion on a pooled aiohttp session, pacing and retrying through the shared limiter
+async def post_chat_completion_async(session, payload, max_retries=MAX_RETRIES):
+    import aiohttp
+
+    limiter = get_rate_limiter(payload['model'])
+    estimated_tokens = estimate_tokens(payload)
+    tracer = get_tracer()
+    retries = 0
 
     while retries < max_retries:
         try:
-            # Send the request to OpenAI
-            response = requests.post("https://api.openai.com/v1/chat/completions", headers=headers, json=payload)
-            
-            # Check if the response is OK (status code 200)
-            response.raise_for_status()
-            
-            # Parse the response JSON
-            result = response.json()
-            
+            # Waiting out a 429 backoff and ordinary pacing are reported separately
+            with tracer.span("retry_sleep" if retries else "rate_limit_wait"):
+                await limiter.acquire_async(estimated_tokens)
+            tracer.count("requests")
+            http_started = time.perf_counter()
+            async with session.post(OPENAI_CHAT_URL, json=payload) as response:
+                limiter.update_from_headers(response.headers)
+                if response.status == 429:
+                    tracer.record("http", time.perf_counter() - http_started)
+                    tracer.count("rate_limited")
+                    retries += 1
+                    wait_time = retry_wait_time(response.headers, retries)
+                    print(f"Rate limit reached. Retrying in {wait_time} seconds... (Attempt {retries}/{max_retries})")
+                    limiter.penalize(wait_time)  # The next acquire sleeps for every task on this model
+                    continue
+
+                response.raise_for_status()
+                result = await response.json()
+            http_seconds = time.perf_counter() - http_started
+            tracer.record("http", http_seconds)
+            tracer.record("http_prefix_cached" if cached_prompt_tokens(result) else "http_uncached", http_seconds)
+            limiter.settle(estimated_tokens, response_token_usage(result))
+            tracer.count_usage(result.get('usage'))
+            get_model_usage(payload['model']).record(http_seconds, result.get('usage'), payload_image_count(payload))
+
             if 'choices' in result and result['choices']:
-                print(f"Successfully processed the image with prompt: {prompt}")
                 return result['choices'][0]['message']['content'].strip()
-            else:
-                print("Error: No valid response from GPT-4-o")
-                return "DUMMY"
-        
-        except requests.exceptions.HTTPError as http_err:
-            # If we hit the rate limit (429 Too Many Requests), retry
-            if response.status_code == 429:
-                retries += 1
-                # Randomized exponential backoff: base wait time + a small random float
-                wait_time = 2 ** retries + random.uniform(0, 1)  # Adds some randomness to avoid clumping
-                print(f"Rate limit reached. Retrying in {wait_time} seconds... (Attempt {retries}/{max_retries})")
-                time.sleep(wait_time)  # Wait before retrying
-            else:
-                print(f"HTTP error occurred: {http_err}")
-                return "DUMMY"
-        except requests.exceptions.RequestException as e:
+            print("Error: No valid response from GPT-4-o")
+            return "DUMMY"
+
+        except aiohttp.ClientResponseError as http_err:
+            print(f"HTTP error occurred: {http_err}")
+            return "DUMMY"
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
             print(f"Error: API request failed - {e}")
             return "DUMMY"
-    
+
     print("Error: Max retries reached. Returning DUMMY.")
     return "DUMMY"
 
+# Send one image with one prompt on a pooled aiohttp session, answering from the response cache when it can
+async def send_prompt_with_image_async(session, encoded_image, prompt, max_retries=MAX_RETRIES, cache=None, model=DEFAULT_MODEL):
+    if not encoded_image:
+        return "DUMMY"  # Return a dummy value if the image can't be encoded
+
+    payload = build_payload(encoded_image, prompt, model=model)
+    cache_entry, cached_response = lookup_cached_response(cache, payload['model'], prompt, encoded_image, cache_params(payload, 'single'))
+    if cached_response is not None:
+        get_tracer().count("cache_hits")
+        return cached_response
+    if cache is not None and cache.replay:
+        print("Error: No cached response in replay mode. Returning DUMMY.")
+        return "DUMMY"
+
+    content = await post_chat_completion_async(session, payload, max_retries=max_retries)
+    if content != "DUMMY":
+        store_cached_response(cache, cache_entry, payload['model'], content)
+    return content
+
+# Send several images with one prompt in a single request; returns {image_id: verdict JSON} for every verdict recovered
+async def send_prompt_with_images_async(session, images, prompt, max_retries=MAX_RETRIES, cache=None, model=DEFAULT_MODEL):
+    params = {'system': SYSTEM_PROMPT, 'layout': cache_layout('batch'), 'instructions': BATCH_INSTRUCTIONS, 'response_format': RESPONSE_FORMAT}
+    verdicts = {}
+    cache_entries = {}
+    to_send = []
+    for image_id, encoded_image in images:
+        if not encoded_image:
+            verdicts[image_id] = "DUMMY"  # Unreadable images get no verdict, exactly as in single-image mode
+            continue
+        cache_entry, cached_response = lookup_cached_response(cache, model, prompt, encoded_image, params)
+        if cached_response is not None:
+            get_tracer().count("cache_hits")
+            verdicts[image_id] = cached_response
+        elif cache is None or not cache.replay:
+            cache_entries[image_id] = cache_entry
+            to_send.append((image_id, encoded_image))
+
+    if to_send:
+        content = await post_chat_completion_async(session, build_batch_payload(to_send, prompt, model=model), max_retries=max_retries)
+        for image_id, verdict in parse_batch_response(content).items():
+            if image_id in cache_entries:
+                verdicts[image_id] = json.dumps(verdict)
+                store_cached_response(cache, cache_entries[image_id], model, verdicts[image_id])
+
+    return verdicts
+
 # Function to parse the GPT-4-o response
+@traced("parse")
 def parse_gpt_response(response):
     """
-    Parse the GPT-4-o response, expecting it in the structured JSON format.
+    Parse the GPT-4-o response into ("offensive" | "not_offensive" | "DUMMY", parse error).
+
+    The verdict JSON is found even with prose or code fences around it, validated
+    against the verdict schema (see response_parser), and salvaged from truncated
+    answers when possible. The error names why no verdict could be read, or is None.
     """
+    parsed = parse_verdict(response)
+    tracer = get_tracer()
+    if parsed.salvaged:
+        tracer.count("parse_salvaged")
+    if parsed.verdict is None:
+        tracer.count(f"parse_error_{parsed.error}")
+        if parsed.error != "request_failed":  # Failed requests were already reported when they failed
+            print(f"Error: Response has no usable verdict ({parsed.error})")
+        return "DUMMY", parsed.error
+    return ("offensive" if parsed.verdict['offensive'] else "not_offensive"), None
+
+# Function to split a multi-image response into per-image verdicts keyed by image_id
+@traced("parse")
+def parse_batch_response(response):
+    verdicts, error = parse_verdict_list(response)
+    if error is not None and error != "request_failed":
+        get_tracer().count(f"parse_error_{error}")
+        print(f"Error: Multi-image response has no usable verdicts ({error})")
+    return verdicts
+
+# Load dataset with image paths and ground truth labels, streamed in chunks into a compact column store
+def load_image_dataset(csv_path, chunk_size=DEFAULT_CHUNK_SIZE):
     try:
-        # Check if the response is enclosed in backticks and clean it
-        if response.startswith("```json"):
-            response = response.replace("```json", "").replace("```", "").strip()
+        return load_dataset(csv_path, chunk_size=chunk_size)
+    except FileNotFoundError:
+        print(f"Error: The dataset file '{csv_path}' was not found.")
+        return Dataset(PathColumn([], np.empty(0, dtype=np.int32)), np.empty(0, dtype=bool))
 
-        # Parse the JSON response
-        parsed_response = json.loads(response)
+# Build a lazily encoded image store; workers receive a handle to it instead of a copy of every image
+def encode_images(dataset, preprocessor=None, dedupe_distance=None):
+    image_store = ImageStore(dataset.image_paths.unique_paths, preprocessor=preprocessor)
+    if dedupe_distance is not None:
+        duplicates = image_store.deduplicate(dedupe_distance)
+        print(f"Found {len(duplicates)} perceptual duplicate images; their rows reuse the kept image's verdict.")
+    return image_store
 
-        # Check if the 'offensive' field is present and return the correct label
-        return "offensive" if parsed_response.get("offensive", False) else "not_offensive"
+class ImageRows:
+    """
+    Dataset rows grouped by the (canonical) image they show.
 
-    except json.JSONDecodeError:
-        print("Error: Response not in valid JSON format")
-        return "DUMMY"
+    Each unique image is requested once per prompt and its verdict fanned out to every
+    row that uses it, so duplicate rows keep their own labels and calculate_metrics still
+    sees one prediction per row. Rows are grouped with one argsort over int codes instead
+    of a dict of Python lists, which keeps grouping cheap for millions of rows.
+    """
 
-# Load dataset with image paths and ground truth labels
-def load_image_dataset(csv_path):
-    try:
-        return pd.read_csv(csv_path)
-    except FileNotFoundError:
-        print(f"Error: The dataset file '{csv_path}' was not found.")
-        return pd.DataFrame()
-
-# Pre-encode all images to avoid redundant encoding in every process
-def encode_images(df):
-    encoded_images = {}
-    for image_path in df['image_path'].unique():
-        encoded_images[image_path] = encode_image(image_path)
-    return encoded_images
-
-# Function to evaluate a single prompt
-def evaluate_single_prompt(args):
-    df, prompt_file, encoded_images = args
-    prompt = load_prompt(prompt_file)
-    if not prompt:
-        return None  # Skip if the prompt couldn't be loaded
-
-    predictions = []
-    for _, row in df.iterrows():
-        image_path = row['image_path']
+    def __init__(self, image_paths, canonical_path=None):
+        import pandas as pd
+
+        if not isinstance(image_paths, PathColumn):
+            codes, uniques = pd.factorize(pd.Series(list(image_paths), dtype=object))
+            image_paths = PathColumn(list(uniques), codes)
+        paths = image_paths.unique_paths
+        codes = image_paths.codes
+        if canonical_path is not None:
+            # Perceptual duplicates collapse onto the image whose encoding is actually sent
+            canonical_codes, paths = pd.factorize(pd.Series([canonical_path(path) for path in paths], dtype=object))
+            paths = list(paths)
+            codes = canonical_codes[codes]
+        self.paths = paths
+        self._order = np.argsort(codes, kind="stable")
+        self._starts = np.concatenate(([0], np.cumsum(np.bincount(codes, minlength=len(paths)))))
+
+    def __len__(self):
+        return len(self.paths)
+
+    def rows(self, image_index):
+        return self._order[self._starts[image_index]:self._starts[image_index + 1]]
+
+    def pair(self, image_index):
+        return self.rows(image_index), self.paths[image_index]
+
+# Load the prompts and work out which (prompt, image) pairs still need an answer
+def plan_pending_pairs(image_paths, prompt_files, encoded_images, run_log=None, shard=None, local_verdicts=None, model=None, completed=None):
+    """
+    Returns (prompts, prompt_hashes, results, image_rows, pending_by_prompt). `results` maps
+    each prompt file to an int8 prediction-code array (see metrics_engine) pre-filled from
+    `run_log`; `pending_by_prompt` maps each prompt file to the indices into `image_rows`
+    of the images still to request. With a `shard` (see sharding.py) only the pairs that
+    shard owns are pending. Images in `local_verdicts` (decided by the cascade, see
+    cascade.py) get that verdict for every prompt and are never requested. Only the logged
+    answers of `model` (DEFAULT_MODEL unless given) count as done. A `completed` map
+    (see RunLog.completed) is used instead of rereading the log when given.
+    """
+    prompts = {}
+    for prompt_file in prompt_files:
+        prompt = load_prompt(prompt_file)
+        if prompt:
+            prompts[prompt_file] = prompt  # Skip prompts that couldn't be loaded
+
+    results = {prompt_file: np.full(len(image_paths), ABSTAINED, dtype=np.int8) for prompt_file in prompts}
+    image_rows = ImageRows(image_paths, getattr(encoded_images, 'canonical_path', None))
+
+    # Fill in pairs finished by an earlier attempt at this run and queue only the rest
+    prompt_hashes = {prompt_file: content_hash(prompt) for prompt_file, prompt in prompts.items()}
+    if completed is None:
+        completed = run_log.completed(model or DEFAULT_MODEL, default_model=DEFAULT_MODEL) if run_log is not None else {}
+    done = {prompt_file: np.zeros(len(image_rows), dtype=bool) for prompt_file in prompts}
+    if completed:
+        image_index = {image_path: i for i, image_path in enumerate(image_rows.paths)}
+        prompts_by_hash = {}
+        for prompt_file, prompt_hash in prompt_hashes.items():
+            prompts_by_hash.setdefault(prompt_hash, []).append(prompt_file)
+        for (prompt_hash, image_path), prediction in completed.items():
+            i = image_index.get(image_path)
+            if i is None:
+                continue
+            for prompt_file in prompts_by_hash.get(prompt_hash, ()):
+                done[prompt_file][i] = True
+                results[prompt_file][image_rows.rows(i)] = encode_prediction(prediction)
+    locally_decided = 0
+    if local_verdicts:
+        for i, image_path in enumerate(image_rows.paths):
+            verdict = local_verdicts.get(image_path)
+            if verdict is None:
+                continue
+            locally_decided += 1
+            for prompt_file in prompts:
+                done[prompt_file][i] = True
+                results[prompt_file][image_rows.rows(i)] = encode_prediction(verdict)
+    pending_by_prompt = {prompt_file: np.flatnonzero(~done[prompt_file]) for prompt_file in prompts}
+
+    pending = sum(len(indices) for indices in pending_by_prompt.values())
+    already_done = len(prompts) * (len(image_rows) - locally_decided) - pending
+    if already_done:
+        print(f"Resuming run{f' ({model})' if model else ''}: {already_done} pairs already done, {pending} remaining.")
+
+    if shard is not None:
+        for prompt_file, indices in pending_by_prompt.items():
+            pending_by_prompt[prompt_file] = indices[shard.mask(prompt_hashes[prompt_file], image_rows.paths)[indices]]
+        print(f"Shard {shard.index}/{shard.count}: {sum(len(indices) for indices in pending_by_prompt.values())} of {pending} remaining pairs.")
+
+    return prompts, prompt_hashes, results, image_rows, pending_by_prompt
+
+# Generate the request groups lazily: each prompt's pending images in chunks of `images_per_request`, image-major
+# across prompts so consecutive groups share images and each image is encoded once while it is hot
+def iter_request_groups(prompts, prompt_hashes, image_rows, pending_by_prompt, images_per_request=1):
+    longest = max((len(indices) for indices in pending_by_prompt.values()), default=0)
+    for start in range(0, longest, images_per_request):
+        for prompt_file, indices in pending_by_prompt.items():
+            chunk = indices[start:start + images_per_request]
+            if len(chunk):
+                yield prompt_file, prompts[prompt_file], prompt_hashes[prompt_file], [image_rows.pair(i) for i in chunk]
+
+# Worker that pulls groups of (prompt, image) pairs for one model off that model's queue until it is drained
+async def _request_worker(queue, session, results, pbar, cache, run_log, completed=None):
+    tracer = get_tracer()
+    while True:
+        enqueued, ((prompt_file, model), prompt, prompt_hash, group), prefetched = await queue.get()
+        tracer.record("queue_wait", time.perf_counter() - enqueued)
+        try:
+            encoded = [await future for future in prefetched]
+            verdicts = {}
+            if len(group) > 1:
+                images = [(f"image_{position + 1}", encoded_image) for position, encoded_image in enumerate(encoded)]
+                verdicts = await send_prompt_with_images_async(session, images, prompt, cache=cache, model=model)
+
+            for position, (row_indices, image_path) in enumerate(group):
+                gpt_response = verdicts.get(f"image_{position + 1}")
+                prediction, parse_error = parse_gpt_response(gpt_response) if gpt_response is not None else ("DUMMY", None)
+                if gpt_response is None or (prediction == "DUMMY" and gpt_response != "DUMMY"):
+                    # Single image requested, or its verdict was missing/unparseable in the multi-image answer
+                    gpt_response = await send_prompt_with_image_async(session, encoded[position], prompt, cache=cache, model=model)
+                    prediction, parse_error = parse_gpt_response(gpt_response)
+                results[(prompt_file, model)][row_indices] = encode_prediction(prediction)
+                if run_log is not None:
+                    run_log.record(prompt_file, prompt_hash, image_path, gpt_response, prediction, model=model, batch_size=len(group),
+                                   **({'parse_error': parse_error} if parse_error else {}))
+                if completed is not None and prediction != "DUMMY":
+                    completed[(prompt_hash, image_path)] = prediction  # Keep the caller's in-memory copy of the log current
+                pbar.update(1)
+        finally:
+            queue.task_done()
+
+async def evaluate_prompts_async(image_paths, prompt_files, encoded_images, max_concurrency=MAX_CONCURRENCY, cache=None, run_log=None, images_per_request=1,
+                                 prefetch_workers=PREFETCH_WORKERS, shard=None, local_verdicts=None, models=None, completed=None):
+    """
+    Evaluate every (prompt, image) pair as an independent task.
+
+    A fixed pool of `max_concurrency` workers shares one aiohttp session, so the
+    number of requests in flight is bounded globally rather than per prompt.
+    Pairs found in `cache` are answered without an API call, and rows whose images
+    are duplicates (same path, or aliased by the image store's dedupe) share one call.
+    Every result is appended to `run_log` as it completes, and pairs the log already
+    holds (from an interrupted run with the same prompt text) are not requested again.
+    With `images_per_request` > 1 each request carries that many images for one prompt,
+    and any image whose verdict can't be recovered is retried on its own.
+    Request groups are generated lazily and their images prefetched by `prefetch_workers`
+    threads just ahead of the bounded queue. With a `shard` only that shard's pairs are requested,
+    and images in `local_verdicts` are answered by the cascade without a request.
+    With `models` (ModelSpecs, see model_matrix.py) every prompt is evaluated with every
+    model in the same pass: each model has its own queue and `max_concurrency` workers,
+    while one prefetched encoding of each image serves every prompt and model.
+    A `completed` map (see RunLog.completed) stands in for rereading the log and is
+    updated with every answer, so repeated calls (tournament rounds) scan the log once.
+    Returns a dict mapping each prompt file (each (prompt file, model) with `models`) to an
+    int8 array of prediction codes in dataset order.
+    """
+    import aiohttp
+    from tqdm import tqdm
+
+    matrix = models is not None
+    models = models or [ModelSpec(DEFAULT_MODEL, max_concurrency)]
+    if matrix:
+        completed = None  # One map only covers one model's answers
+
+    # Every (prompt, model) arm is planned against the same image rows and scheduled as if it were a prompt of its own
+    prompts, prompt_hashes, results, pending_by_prompt = {}, {}, {}, {}
+    for model in models:
+        model_prompts, model_hashes, model_results, image_rows, model_pending = plan_pending_pairs(image_paths, prompt_files, encoded_images, run_log, shard, local_verdicts,
+                                                                                                  model=model.name if matrix else None, completed=completed)
+        for prompt_file, prompt in model_prompts.items():
+            arm = (prompt_file, model.name)
+            prompts[arm], prompt_hashes[arm], results[arm], pending_by_prompt[arm] = prompt, model_hashes[prompt_file], model_results[prompt_file], model_pending[prompt_file]
+
+    pending = sum(len(indices) for indices in pending_by_prompt.values())
+    groups = iter_request_groups(prompts, prompt_hashes, image_rows, pending_by_prompt, images_per_request)
+
+    # The bounded queues are the only buffer between planning and the workers, so memory stays flat however large the dataset
+    queues = {model.name: asyncio.Queue(maxsize=model.max_concurrency * 2) for model in models}
+    total_concurrency = sum(model.max_concurrency for model in models)
+    prefetch_window = 2 * total_concurrency * images_per_request + total_concurrency
+    loop = asyncio.get_running_loop()
+
+    connector = aiohttp.TCPConnector(limit=total_concurrency)
+    timeout = aiohttp.ClientTimeout(total=REQUEST_TIMEOUT)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout, headers=build_headers()) as session:
+        with tqdm(total=pending, desc="Evaluating Prompts", unit="image") as pbar, ThreadPoolExecutor(prefetch_workers) as executor:
+            workers = [asyncio.create_task(_request_worker(queues[model.name], session, results, pbar, cache, run_log, completed))
+                       for model in models for _ in range(model.max_concurrency)]
+            try:
+                # Images are read and encoded on a thread pool as their groups enter the queue, so file I/O overlaps
+                # the requests ahead of them; groups for other prompts and models reuse the same in-flight encoding
+                prefetching = OrderedDict()
+                for group in groups:
+                    futures = []
+                    for _, image_path in group[3]:
+                        future = prefetching.get(image_path)
+                        if future is None:
+                            future = prefetching[image_path] = loop.run_in_executor(executor, encoded_images.get, image_path)
+                            if len(prefetching) > prefetch_window:
+                                prefetching.popitem(last=False)
+                        futures.append(future)
+                    await queues[group[0][1]].put((time.perf_counter(), group, futures))
+                for queue in queues.values():
+                    await queue.join()
+            finally:
+                # Also runs on Ctrl-C, so no worker is left using the session after it closes
+                for worker in workers:
+                    worker.cancel()
+                await asyncio.gather(*workers, return_exceptions=True)
+
+    if matrix:
+        return results
+    return {prompt_file: predictions for (prompt_file, _), predictions in results.items()}
+
+# Evaluate prompts through the offline Batch API: cheaper and outside the interactive rate limits, but results can take hours
+def evaluate_prompts_with_batch_api(image_paths, prompt_files, encoded_images, batch_folder, cache=None, run_log=None, poll_interval=POLL_INTERVAL, shard=None,
+                                    local_verdicts=None):
+    prompts, prompt_hashes, results, image_rows, pending_by_prompt = plan_pending_pairs(image_paths, prompt_files, encoded_images, run_log, shard, local_verdicts)
+
+    def finish_pair(prompt_file, row_indices, image_path, gpt_response):
+        prediction, parse_error = parse_gpt_response(gpt_response)
+        results[prompt_file][row_indices] = encode_prediction(prediction)
+        if run_log is not None:
+            run_log.record(prompt_file, prompt_hashes[prompt_file], image_path, gpt_response, prediction, engine='batch',
+                           **({'parse_error': parse_error} if parse_error else {}))
+
+    # Walk the pending pairs image-major so each image is encoded once for all of its prompts
+    pending_by_image = {}
+    for prompt_file, indices in pending_by_prompt.items():
+        for i in indices:
+            pending_by_image.setdefault(int(i), []).append(prompt_file)
+
+    # Answer what the cache already knows and give every remaining pair a stable custom_id
+    submitted = {}
+    for i in sorted(pending_by_image):
+        row_indices, image_path = image_rows.pair(i)
         encoded_image = encoded_images.get(image_path)
-        
-        # Send image and prompt to GPT-4-o
-        gpt_response = send_prompt_with_image(encoded_image, prompt)
-        prediction = parse_gpt_response(gpt_response)
-        
-        predictions.append(prediction)
-
-    return prompt_file, predictions
-
-# Function to calculate precision, recall, and F1-score
-def calculate_metrics(df, results):
-    metrics = {}
-
-    for prompt, predictions in results.items():
-        ground_truth = df['label'].map(lambda x: 1 if x == 'offensive' else 0).tolist()
-        predicted_labels = [1 if p == 'offensive' else 0 for p in predictions]
-
-        precision = precision_score(ground_truth, predicted_labels, zero_division=0)
-        recall = recall_score(ground_truth, predicted_labels, zero_division=0)
-        f1 = f1_score(ground_truth, predicted_labels, zero_division=0)
-
-        metrics[prompt] = {
-            'Precision': precision,
-            'Recall': recall,
-            'F1-Score': f1
-        }
-
-    return metrics
+        for prompt_file in pending_by_image[i]:
+            if not encoded_image:
+                finish_pair(prompt_file, row_indices, image_path, "DUMMY")
+                continue
+            payload = build_payload(encoded_image, prompts[prompt_file])
+            cache_entry, cached_response = lookup_cached_response(cache, payload['model'], prompts[prompt_file], encoded_image, cache_params(payload, 'single'))
+            if cached_response is not None or (cache is not None and cache.replay):
+                finish_pair(prompt_file, row_indices, image_path, cached_response or "DUMMY")
+                continue
+            custom_id = content_hash(f"{prompt_hashes[prompt_file]}:{image_path}")[:32]
+            submitted[custom_id] = (prompt_file, row_indices, image_path, cache_entry)
+
+    if not submitted:
+        return results
+
+    # Payloads are built lazily while the batch files are written, one image in memory at a time;
+    # `submitted` is image-major, so each image is fetched once for all of its prompts
+    def batch_requests():
+        current_path = encoded_image = None
+        for custom_id, (prompt_file, _, image_path, _) in submitted.items():
+            if image_path != current_path:
+                current_path, encoded_image = image_path, encoded_images.get(image_path)
+            yield custom_id, build_payload(encoded_image, prompts[prompt_file])
+
+    # Saved batch state only applies to the exact set of requests it was written for
+    requests_key = content_hash("\n".join([DEFAULT_MODEL] + sorted(submitted)))
+    print(f"Submitting {len(submitted)} requests through the Batch API (work folder: {batch_folder})")
+    with get_tracer().span("batch_job"):
+        contents = run_batch_job(batch_requests(), batch_folder, OPENAI_API_BASE, OPENAI_API_KEY, poll_interval=poll_interval, requests_key=requests_key)
+
+    for custom_id, (prompt_file, row_indices, image_path, cache_entry) in submitted.items():
+        gpt_response = contents.get(custom_id, "DUMMY")
+        if gpt_response != "DUMMY":
+            store_cached_response(cache, cache_entry, DEFAULT_MODEL, gpt_response)
+        finish_pair(prompt_file, row_indices, image_path, gpt_response)
+
+    return results
+
+# Per-process state for the multiprocessing engine, installed once per worker rather than pickled into every task
+_worker_state = {}
+
+def _init_pool_worker(api_base, response_format, prompt_layout, limiters, image_paths, encoded_images, cache, run_log, images_per_request, shard, local_verdicts):
+    configure_api_base(api_base)
+    configure_json_mode(response_format is not None)
+    configure_prompt_layout(prompt_layout)
+    install_rate_limiters(limiters)
+    get_tracer().reset()  # A forked worker starts with a copy of the parent's spans, which the parent already reports
+    _worker_state.update(image_paths=image_paths, encoded_images=encoded_images, cache=cache, run_log=run_log, images_per_request=images_per_request, shard=shard,
+                         local_verdicts=local_verdicts)
+
+# Function to evaluate a single prompt (used by the multiprocessing engine)
+def evaluate_single_prompt(prompt_file):
+    results = asyncio.run(evaluate_prompts_async(_worker_state['image_paths'], [prompt_file], _worker_state['encoded_images'], cache=_worker_state['cache'], run_log=_worker_state['run_log'],
+                                                 images_per_request=_worker_state['images_per_request'], shard=_worker_state['shard'],
+                                                 local_verdicts=_worker_state['local_verdicts']))
+    # Hand this task's spans back to the parent and start the next task with an empty tracer
+    perf_snapshot = get_tracer().snapshot()
+    get_tracer().reset()
+    if prompt_file not in results:
+        return None, None, perf_snapshot  # Skip if the prompt couldn't be loaded
+
+    return prompt_file, results[prompt_file], perf_snapshot
+
+# Function to calculate precision, recall, F1-score, abstention rate and their confidence intervals
+@traced("metrics")
+def calculate_metrics(dataset, results, guidelines_file=DEFAULT_GUIDELINES_FILE, n_bootstrap=DEFAULT_BOOTSTRAP_SAMPLES, seed=None):
+    known_categories = load_guideline_categories(guidelines_file) if dataset.category_codes is not None else None
+    return compute_metrics(dataset.offensive, results, categories=dataset.category_codes, category_names=dataset.category_names,
+                           known_categories=known_categories, n_bootstrap=n_bootstrap, seed=seed)
 
 # Function to save metrics to a file
 def save_metrics(metrics, result_path):
@@ -178,42 +680,307 @@ def save_metrics(metrics, result_path):
         with open(metric_file, 'w') as f:
             f.write(json.dumps(metric, indent=4))
 
-# Main function to load dataset, run prompts in parallel, and calculate metrics
+# Function to collect the results every shard of a run has logged, without making any API call
+def merge_shard_results(image_paths, prompt_files, encoded_images, run_log, local_verdicts=None):
+    _, _, results, image_rows, pending_by_prompt = plan_pending_pairs(image_paths, prompt_files, encoded_images, run_log, local_verdicts=local_verdicts)
+    missing = sum(len(indices) for indices in pending_by_prompt.values())
+    if missing:
+        print(f"Warning: {missing} of {len(results) * len(image_rows)} pairs have no result yet and count as abstentions; rerun their shards to fill them in.")
+    return results
+
+# Evaluate prompts with one process per prompt (each process runs its own async loop)
+def evaluate_prompts_with_pool(dataset, prompts, encoded_images, cache=None, run_log=None, images_per_request=1, shard=None, local_verdicts=None):
+    from multiprocessing import Pool, cpu_count
+
+    num_processes = min(len(prompts), cpu_count())
+
+    # Create the limiter in the parent so every worker process paces against the same budget
+    get_rate_limiter(DEFAULT_MODEL)
+
+    # Encode each image once into a memory-mapped spool shared by every worker
+    encoded_images.materialize()
 
+    initargs = (OPENAI_API_BASE, RESPONSE_FORMAT, PROMPT_LAYOUT, get_rate_limiters(), dataset.image_paths, encoded_images, cache, run_log, images_per_request, shard,
+                local_verdicts)
+    with Pool(num_processes, initializer=_init_pool_worker, initargs=initargs) as pool:
+        results_list = list(pool.imap_unordered(evaluate_single_prompt, prompts))
 
+    for _, _, perf_snapshot in results_list:
+        get_tracer().merge(perf_snapshot)
+    return {prompt: predictions for prompt, predictions, _ in results_list if predictions is not None}
+
+# Function to save a prompt comparison (tournament) summary
+def save_tournament(summaries, result_path):
+    os.makedirs(result_path, exist_ok=True)
+    with open(os.path.join(result_path, "tournament.json"), 'w') as f:
+        f.write(json.dumps(summaries, indent=4))
+
+# Function to write runs/<run_id>/perf.json, print where the time went and export it for monitoring if requested
+def report_performance(args, run_log, interrupted=False):
+    tracer = get_tracer()
+    perf_file = f"perf-shard-{args.shard.replace('/', '-of-')}.json" if args.shard else "perf.json"
+    summary = save_perf_summary(tracer, os.path.join(run_log.run_folder, perf_file), run_id=run_log.run_id, engine=args.engine,
+                                max_concurrency=args.max_concurrency, images_per_request=args.images_per_request, interrupted=interrupted)
+    print_perf_summary(summary)
+    if args.openmetrics_file or args.pushgateway:
+        export_openmetrics(tracer, textfile=args.openmetrics_file, pushgateway=args.pushgateway, labels={'run_id': run_log.run_id, 'engine': args.engine})
+
+# Main function to load dataset, run prompts concurrently, and calculate metrics
 def main():
-    # Path to the dataset and prompt files
-    dataset_path = "./downloaded_images/Images_Ground_Truth.csv"  # Update this path
-    prompts_folder = "prompts/"  # Folder containing multiple prompt text files
+    parser = argparse.ArgumentParser(description="Evaluate prompt files against a labeled image dataset.")
+    parser.add_argument('--dataset', type=str, default="./downloaded_images/Images_Ground_Truth.csv", help="CSV, Parquet or JSONL manifest with image paths and ground truth labels.")
+    parser.add_argument('--chunk_size', type=int, default=DEFAULT_CHUNK_SIZE, help="Rows parsed at a time while streaming the dataset.")
+    parser.add_argument('--prefetch_workers', type=int, default=PREFETCH_WORKERS, help="Threads reading and encoding images ahead of the request queue.")
+    parser.add_argument('--prompts_folder', type=str, default="prompts/", help="Folder containing multiple prompt text files.")
+    parser.add_argument('--prompt_manifest', type=str, default=None, help="Evaluate the prompts listed in a prompt_loader.py --sweep manifest instead of --prompts_folder.")
+    parser.add_argument('--results_folder', type=str, default="results/", help="Folder where the metric files are written.")
+    parser.add_argument('--engine', choices=['async', 'pool', 'batch'], default='async', help="'async' schedules every (prompt, image) pair on one event loop; 'pool' runs one process per prompt; 'batch' submits everything through the offline Batch API.")
+    parser.add_argument('--max_concurrency', type=int, default=MAX_CONCURRENCY, help="Maximum number of API requests in flight at once.")
+    parser.add_argument('--rpm', type=int, default=None, help="Requests-per-minute budget for the model (defaults to the model's known limit).")
+    parser.add_argument('--tpm', type=int, default=None, help="Tokens-per-minute budget for the model (defaults to the model's known limit).")
+    parser.add_argument('--cache_path', type=str, default=DEFAULT_CACHE_PATH, help="SQLite file caching responses by model, prompt hash and image hash.")
+    parser.add_argument('--no_cache', action='store_true', help="Always call the API and don't store responses.")
+    parser.add_argument('--replay', action='store_true', help="Read-only cache mode: answer only from the cache and never call the API.")
+    parser.add_argument('--cache_max_mb', type=float, default=None, help="Evict least recently used responses once the cache grows past this size.")
+    parser.add_argument('--cache_max_age_days', type=float, default=None, help="Ignore and evict cached responses older than this.")
+    parser.add_argument('--preprocess', action='store_true', help="Downsize and recompress images before upload.")
+    parser.add_argument('--max_image_dimension', type=int, default=DEFAULT_MAX_DIMENSION, help="Longest image side after preprocessing.")
+    parser.add_argument('--jpeg_quality', type=int, default=DEFAULT_JPEG_QUALITY, help="JPEG quality used when recompressing images.")
+    parser.add_argument('--dedupe_distance', type=int_at_least(0), default=None, help="Send perceptual duplicates (dHash within this many bits) only once.")
+    parser.add_argument('--preprocess_cache', type=str, default=DEFAULT_PREPROCESS_CACHE, help="Folder caching preprocessed image bytes.")
+    parser.add_argument('--runs_folder', type=str, default=DEFAULT_RUNS_FOLDER, help="Folder holding per-run JSONL result logs.")
+    parser.add_argument('--run_id', type=str, default=None, help="Name for a new run (defaults to a timestamp).")
+    parser.add_argument('--resume', type=str, default=None, metavar='RUN_ID', help="Resume an interrupted run, skipping pairs it already completed.")
+    parser.add_argument('--images_per_request', type=int_at_least(1), default=1, help="Classify this many images per request (one JSON verdict per image).")
+    parser.add_argument('--batch_folder', type=str, default=None, help="Work folder for Batch API input files and state (defaults to runs/<run_id>/batch).")
+    parser.add_argument('--batch_poll_interval', type=float, default=POLL_INTERVAL, help="Seconds between Batch API status checks.")
+    parser.add_argument('--compare', action='store_true', help="Adaptive comparison: sample images in stratified random order and stop evaluating prompts that are statistically dominated.")
+    parser.add_argument('--round_size', type=int, default=DEFAULT_ROUND_SIZE, help="Images added to the sample per comparison round.")
+    parser.add_argument('--min_samples', type=int, default=DEFAULT_MIN_SAMPLES, help="Images every prompt sees before it can be eliminated.")
+    parser.add_argument('--confidence', type=float, default=DEFAULT_CONFIDENCE, help="Confidence level of the bootstrap intervals used for elimination.")
+    parser.add_argument('--seed', type=int, default=None, help="Seed for the comparison sampling order and the bootstrap intervals.")
+    parser.add_argument('--bootstrap_samples', type=int, default=DEFAULT_BOOTSTRAP_SAMPLES, help="Bootstrap replicates for the metric confidence intervals (0 disables them).")
+    parser.add_argument('--guidelines_file', type=str, default=DEFAULT_GUIDELINES_FILE, help="Guidelines JSON whose categories label the optional 'category' dataset column.")
+    parser.add_argument('--openmetrics_file', type=str, default=None, help="Also write the run's performance metrics in OpenMetrics text format to this file (e.g. for node_exporter's textfile collector).")
+    parser.add_argument('--pushgateway', type=str, default=None, help="Push the run's performance metrics to this Prometheus Pushgateway URL.")
+    parser.add_argument('--json_mode', action='store_true', help="Request JSON mode (response_format json_object) so answers are always valid JSON objects.")
+    parser.add_argument('--prompt_layout', choices=PROMPT_LAYOUTS, default='default', help="'prefix_cache' sends the prompt and instructions as one stable leading prefix with the images last, so the API's prompt caching can hit.")
+    parser.add_argument('--cascade_model', type=str, default=None, help="Local scorer trained with cascade.py; images it is confident about are decided without an API call.")
+    parser.add_argument('--cascade_low', type=float, default=None, help="Override the model's threshold: scores at or below this are called not offensive locally.")
+    parser.add_argument('--cascade_high', type=float, default=None, help="Override the model's threshold: scores at or above this are called offensive locally.")
+    parser.add_argument('--cascade_audit', type=float, default=0.0, help="Fraction of locally decided images also sent to the LLM, to measure the cascade's accuracy loss.")
+    parser.add_argument('--models', type=str, default=None, help="Evaluate every prompt with each of these models in one pass: NAME[:CONCURRENCY],... (e.g. gpt-4o-mini:16,gpt-4o:4) or a JSON model matrix. List the cheapest model first; it is the first step of an escalation.")
+    parser.add_argument('--ensemble', choices=ENSEMBLE_STRATEGIES, nargs='+', default=[], help="With --models, also score a majority vote and/or an escalation chain across the models.")
+    parser.add_argument('--escalate_on', choices=ESCALATE_ON, default='abstain', help="Answers a model passes on to the next model of an escalation: only abstentions, or abstentions plus its offensive or not offensive calls.")
+    parser.add_argument('--min_f1', type=float, default=None, help="With --models, name the cheapest model or ensemble whose F1-Score reaches this bar for each prompt.")
+    parser.add_argument('--shard', type=str, default=None, metavar='INDEX/COUNT', help="Only evaluate this deterministic slice of the (prompt, image) pairs, e.g. 0/4; run every shard with the same --run_id.")
+    parser.add_argument('--shard_by', choices=SHARD_BY, default='image', help="Split the work by image (all prompts for an image on one shard) or by (prompt, image) pair.")
+    parser.add_argument('--merge_shards', action='store_true', help="With --resume, compute the metrics from every shard's results in the run without making any API call.")
+    parser.add_argument('--skip_near_duplicates', action='store_true', help="Don't evaluate prompts that are near-duplicates of a prompt already evaluated (or kept earlier in this run).")
+    parser.add_argument('--duplicate_threshold', type=float, default=DUPLICATE_THRESHOLD, help="TF-IDF cosine similarity at or above which prompts count as near-duplicates.")
+    parser.add_argument('--prompt_index', type=str, default=DEFAULT_INDEX_PATH, help="SQLite MinHash/LSH index of prompts, recording which ones were evaluated.")
+    parser.add_argument('--api_base', type=str, default=None, help="Base URL of the OpenAI-compatible API (defaults to $OPENAI_API_BASE or api.openai.com).")
+    args = parser.parse_args()
+    get_tracer().reset()  # The run's wall time starts here, not at import
+
+    shard = None
+    if args.shard:
+        try:
+            shard = parse_shard(args.shard, by=args.shard_by)
+        except ValueError as e:
+            print(f"Error: {e}")
+            return
+        if args.compare:
+            print("Error: --compare needs every prompt's results after each round and can't run sharded.")
+            return
+    if args.compare and args.bootstrap_samples < 1:
+        print("Error: --compare drops prompts by their bootstrap intervals and needs --bootstrap_samples of at least 1.")
+        return
+    if args.merge_shards and not args.resume:
+        print("Error: --merge_shards needs the run to merge, given as --resume RUN_ID.")
+        return
+    if args.engine == 'batch' and args.images_per_request > 1:
+        print("Error: --engine batch sends one image per request; --images_per_request above 1 needs the async or pool engine.")
+        return
+
+    # A model matrix runs prompt x model x image on the async engine's single event loop
+    models = None
+    if args.models:
+        try:
+            models = parse_model_matrix(args.models, args.max_concurrency)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Error: Could not read the model matrix - {e}")
+            return
+        if args.engine != 'async' or args.compare or shard is not None or args.merge_shards:
+            print("Error: --models runs on the async engine and can't be combined with --engine pool/batch, --compare, --shard or --merge_shards.")
+            return
+    if args.ensemble and (models is None or len(models) < 2):
+        print("Error: --ensemble needs at least two models in --models.")
+        return
+
+    if args.api_base:
+        configure_api_base(args.api_base)
+    configure_json_mode(args.json_mode)
+    configure_prompt_layout(args.prompt_layout)
+
+    configure_rate_limits(requests_per_minute=args.rpm, tokens_per_minute=args.tpm)
+    for model in models or []:
+        if model.rpm or model.tpm:
+            configure_rate_limits(requests_per_minute=model.rpm, tokens_per_minute=model.tpm, model=model.name)
+
+    cache = None
+    if not args.no_cache:
+        cache = ResponseCache(
+            args.cache_path,
+            max_bytes=int(args.cache_max_mb * 1024 * 1024) if args.cache_max_mb else None,
+            max_age_seconds=args.cache_max_age_days * 86400 if args.cache_max_age_days else None,
+            replay=args.replay
+        )
+        cache.evict()
 
     # Load the dataset of images and labels
-    df = load_image_dataset(dataset_path)
-    if df.empty:
+    dataset = load_image_dataset(args.dataset, chunk_size=args.chunk_size)
+    if dataset.empty:
         return  # Exit if the dataset cannot be loaded
 
-    # Pre-encode all images
-    encoded_images = encode_images(df)
+    # Lazily encode (and optionally preprocess and dedupe) all images
+    preprocessor = None
+    if args.preprocess:
+        preprocessor = ImagePreprocessor(args.max_image_dimension, args.jpeg_quality, cache_dir=args.preprocess_cache)
+    encoded_images = encode_images(dataset, preprocessor=preprocessor, dedupe_distance=args.dedupe_distance)
 
-    # Get all prompt files from the folder
-    prompts = [os.path.join(prompts_folder, f) for f in os.listdir(prompts_folder) if f.endswith(".txt")]
+    # The cascade answers images its local scorer is confident about, for every prompt, without an API call
+    local_verdicts = None
+    if args.cascade_model:
+        try:
+            cascade = Cascade.load(args.cascade_model, low=args.cascade_low, high=args.cascade_high)
+        except (FileNotFoundError, ValueError) as e:
+            print(f"Error: Could not load the cascade model - {e}")
+            return
+        with get_tracer().span("cascade"):
+            local_verdicts, _ = cascade.decide(dataset.image_paths.unique_paths)
+        local_verdicts, audit_verdicts = split_audit_sample(local_verdicts, args.cascade_audit)
+        get_tracer().count("cascade_local_images", len(local_verdicts))
+        print(f"Cascade: {len(local_verdicts)} of {len(dataset.image_paths.unique_paths)} images decided locally"
+              f"{f', {len(audit_verdicts)} more sent to the LLM for audit' if audit_verdicts else ''}.")
+        # Rows are grouped the way the evaluation groups them, so perceptual duplicates follow their kept image
+        image_rows = ImageRows(dataset.image_paths, getattr(encoded_images, 'canonical_path', None))
+        local_mask, _ = local_row_codes(image_rows, local_verdicts, len(dataset))
+        audit_mask, audit_codes = local_row_codes(image_rows, audit_verdicts, len(dataset))
+
+    # Get all prompt files from the folder, or the variants listed in a prompt_loader sweep manifest
+    if args.prompt_manifest:
+        try:
+            prompts = load_prompt_manifest(args.prompt_manifest)
+        except FileNotFoundError:
+            print(f"Error: The prompt manifest '{args.prompt_manifest}' was not found.")
+            return
+    else:
+        prompts = [os.path.join(args.prompts_folder, f) for f in os.listdir(args.prompts_folder) if f.endswith(".txt")]
+
+    # Near-duplicates of prompts that were already evaluated would cost a full pass for nearly the same answers
+    prompt_index = None
+    near_duplicates = {}
+    if args.skip_near_duplicates:
+        prompt_index = PromptIndex(args.prompt_index, threshold=args.duplicate_threshold)
+        prompt_texts = {prompt: load_prompt(prompt) or "" for prompt in sorted(prompts)}
+        near_duplicates = prompt_index.plan_skips(prompt_texts)
+        for prompt, (duplicate_of, similarity) in near_duplicates.items():
+            print(f"Skipping {prompt}: near-duplicate of {duplicate_of} (similarity {similarity:.2f})")
+        prompts = [prompt for prompt in prompts if prompt not in near_duplicates]
+        get_tracer().count("prompts_skipped_near_duplicate", len(near_duplicates))
+
+    # Every result is streamed to runs/<run_id>/ so an interrupted run can be resumed
+    run_log = RunLog(args.resume or args.run_id, runs_folder=args.runs_folder)
+    if args.resume and not run_log.exists():
+        print(f"Error: No run '{args.resume}' found in {args.runs_folder}.")
+        return
+    if not args.merge_shards:
+        run_log.write_manifest(dataset=args.dataset, prompts=prompts, engine=args.engine, images_per_request=args.images_per_request,
+                               **({'num_shards': shard.count, 'shard_by': shard.by} if shard else {}),
+                               **({'models': [model.name for model in models]} if models else {}),
+                               **({'near_duplicates': {prompt: duplicate_of for prompt, (duplicate_of, _) in near_duplicates.items()}} if near_duplicates else {}))
+        print(f"Run ID: {run_log.run_id} (resume with --resume {run_log.run_id})")
 
-    # Set up multiprocessing pool to evaluate prompts in parallel
-    num_processes = min(len(prompts), cpu_count())
-    
-    # Initialize tqdm progress bar with the total number of prompts
-    with tqdm(total=len(prompts), desc="Evaluating Prompts", unit="prompt") as pbar:
-        with Pool(num_processes) as pool:
-            # For each completed prompt, update the progress bar manually
-            results_list = []
-            for result in pool.imap_unordered(evaluate_single_prompt, [(df, prompt, encoded_images) for prompt in prompts]):
-                results_list.append(result)
-                pbar.update(1)  # Update progress bar after each prompt evaluation
-
-    # Process the results
-    results = {prompt: predictions for prompt, predictions in results_list if predictions}
+    try:
+        if args.merge_shards:
+            results = merge_shard_results(dataset.image_paths, prompts, encoded_images, run_log, local_verdicts=local_verdicts)
+        elif args.compare:
+            # The log is read once; each round plans against, and adds its answers to, this in-memory copy
+            completed = run_log.completed(DEFAULT_MODEL, default_model=DEFAULT_MODEL)
+
+            def evaluate_round(round_image_paths, round_prompts):
+                return asyncio.run(evaluate_prompts_async(round_image_paths, round_prompts, encoded_images, max_concurrency=args.max_concurrency, cache=cache, run_log=run_log,
+                                                          images_per_request=args.images_per_request, prefetch_workers=args.prefetch_workers, local_verdicts=local_verdicts,
+                                                          completed=completed))
+
+            summaries = run_prompt_tournament(dataset.offensive, dataset.image_paths, prompts, evaluate_round,
+                                              round_size=args.round_size, min_samples=args.min_samples, confidence=args.confidence, seed=args.seed,
+                                              n_bootstrap=args.bootstrap_samples)
+        elif args.engine == 'batch':
+            batch_folder = args.batch_folder or os.path.join(run_log.run_folder, "batch")
+            results = evaluate_prompts_with_batch_api(dataset.image_paths, prompts, encoded_images, batch_folder, cache=cache, run_log=run_log, poll_interval=args.batch_poll_interval, shard=shard,
+                                                       local_verdicts=local_verdicts)
+        elif args.engine == 'pool':
+            results = evaluate_prompts_with_pool(dataset, prompts, encoded_images, cache=cache, run_log=run_log, images_per_request=args.images_per_request, shard=shard,
+                                                 local_verdicts=local_verdicts)
+        else:
+            results = asyncio.run(evaluate_prompts_async(dataset.image_paths, prompts, encoded_images, max_concurrency=args.max_concurrency, cache=cache, run_log=run_log,
+                                                         images_per_request=args.images_per_request, prefetch_workers=args.prefetch_workers, shard=shard,
+                                                         local_verdicts=local_verdicts, models=models))
+    except KeyboardInterrupt:
+        print(f"\nInterrupted. Completed results are saved; resume with --resume {run_log.run_id}")
+        report_performance(args, run_log, interrupted=True)
+        return
+    finally:
+        run_log.close()
+        encoded_images.close()
+
+    if cache is not None:
+        cache.evict()
+        cache.close()
+
+    if prompt_index is not None:
+        if shard is None:  # A shard worker's prompts are only partly evaluated; the merge records them
+            prompt_index.mark_evaluated(load_prompt(prompt) or "" for prompt in prompts)
+        prompt_index.close()
+
+    if args.compare:
+        for prompt, summary in sorted(summaries.items(), key=lambda item: -item[1]['F1-Score']):
+            low, high = summary['Confidence Intervals']['F1-Score']
+            status = f"eliminated in round {summary['Eliminated In Round']}" if summary['Eliminated In Round'] else "still in contention"
+            print(f"\nPrompt: {prompt} ({status}, {summary['Images Evaluated']} images)")
+            print(f"F1-Score: {summary['F1-Score']:.3f} [{low:.3f}, {high:.3f}]")
+        save_tournament(summaries, args.results_folder)
+        report_performance(args, run_log)
+        return
+
+    if shard is not None:
+        # A shard only holds part of the results; the metrics come from merging every shard
+        print(f"\nShard {shard.index}/{shard.count} finished. Once every shard is done, merge with --resume {run_log.run_id} --merge_shards")
+        report_performance(args, run_log)
+        return
+
+    # Every model's results (keyed by (prompt, model)) are combined into the requested ensembles and scored alongside them
+    if models is not None:
+        ensembles, ensemble_shares = ensemble_results(results, prompts, models, args.ensemble, args.escalate_on)
+        results = {**results, **ensembles}
 
     # Calculate precision, recall, and F1-score
-    metrics = calculate_metrics(df, results)
+    metrics = calculate_metrics(dataset, results, guidelines_file=args.guidelines_file, n_bootstrap=args.bootstrap_samples, seed=args.seed)
+    if local_verdicts is not None:
+        for prompt, metric in metrics.items():
+            metric['Cascade'] = cascade_report(dataset.offensive, results[prompt], local_mask, audit_mask, audit_codes)
+
+    # Latency and token cost are measured per model over the whole run, and estimated for ensembles from their models' shares of the rows
+    if models is not None:
+        model_usage = {model.name: get_model_usage(model.name).summary(model.prices) for model in models}
+        for (prompt, name), metric in metrics.items():
+            if name in model_usage:
+                metric['Usage'] = model_usage[name]
+            else:
+                metric['Usage'] = dict(ensemble_usage(name, list(model_usage.values()), ensemble_shares[(prompt, name)]), Models=list(model_usage))
+        metrics = {f"{prompt}@{name}": metric for (prompt, name), metric in metrics.items()}
 
     # Print and analyze the metrics
     for prompt, metric in metrics.items():
@@ -221,9 +988,25 @@ def main():
         print(f"Precision: {metric['Precision']}")
         print(f"Recall: {metric['Recall']}")
         print(f"F1-Score: {metric['F1-Score']}")
+        print(f"Abstention Rate: {metric['Abstention Rate']} ({metric['Confusion Matrix']['Abstained']} failed or unparseable responses)")
+        if 'Cascade' in metric:
+            accuracy_loss = metric['Cascade'].get('Accuracy Loss')
+            print(f"Escalation Rate: {metric['Cascade']['Escalation Rate']:.3f} (local accuracy {metric['Cascade']['Local Accuracy']}, "
+                  f"accuracy loss {'n/a without --cascade_audit' if accuracy_loss is None else f'{accuracy_loss:.4f}'})")
+        if 'Usage' in metric:
+            cost = metric['Usage']['Cost per 1k Images USD']
+            print(f"Cost per 1k images: {'n/a (no prices, or every answer came from the cache)' if cost is None else f'${cost:.4f}'}, mean latency {metric['Usage']['Mean Latency ms']:.0f}ms")
+
+    if models is not None and args.min_f1 is not None:
+        for prompt in prompts:
+            options = {label.rpartition('@')[2]: (metric['F1-Score'], metric['Usage']['Cost per 1k Images USD'])
+                       for label, metric in metrics.items() if label.rpartition('@')[0] == prompt}
+            choice = cheapest_passing(options, args.min_f1)
+            print(f"\nCheapest option for {prompt} with F1-Score >= {args.min_f1}: {choice or 'none (no priced model or ensemble reaches the bar)'}")
     
     # Save results for each prompt
-    save_metrics(metrics, "results/")
+    save_metrics(metrics, args.results_folder)
+    report_performance(args, run_log)
 
 if __name__ == "__main__":
     main()
@@ -1,7 +1,16 @@
 import json
 import re
 import os
+import random
 import argparse
+from itertools import combinations, product
+from math import prod
+
+from response_cache import content_hash
+
+PLACEHOLDER_PATTERN = re.compile(r"\{(.*?)\}")
+NO_EXCEPTIONS = "None"  # Filled in when a sweep variant drops every exception of a category
+MANIFEST_NAME = "prompt_manifest.jsonl"
 
 # Load exceptions from JSON file
 def load_exceptions(exceptions_file):
@@ -23,19 +32,56 @@ def load_prompt_template(prompt_file):
 
 # Extract placeholders (e.g., {placeholder}) from the prompt template
 def extract_placeholders(prompt_template):
-    return re.findall(r"\{(.*?)\}", prompt_template)
+    return PLACEHOLDER_PATTERN.findall(prompt_template)
+
+# Function to split a template once into its literal text and placeholders, so filling it is a single join
+def compile_prompt_template(prompt_template):
+    parts = PLACEHOLDER_PATTERN.split(prompt_template)
+    return parts[0::2], parts[1::2]
+
+# Function to check that the exceptions config has a value for every placeholder of a compiled template
+def check_placeholders(compiled_template, exceptions):
+    for placeholder in compiled_template[1]:
+        if placeholder not in exceptions:
+            raise ValueError(f"Error: Placeholder '{placeholder}' not found in exceptions config. Unable to generate prompt.")
+
+# Function to fill a compiled template with one string per placeholder
+def render_prompt(compiled_template, values):
+    literals, placeholders = compiled_template
+    pieces = [literals[0]]
+    for placeholder, literal in zip(placeholders, literals[1:]):
+        pieces.append(values[placeholder])
+        pieces.append(literal)
+    return "".join(pieces)
 
 # Function to dynamically replace placeholders in the prompt template
 def generate_dynamic_prompt(prompt_template, exceptions):
-    placeholders = extract_placeholders(prompt_template)
-    
-    for placeholder in placeholders:
-        if placeholder in exceptions:
-            prompt_template = prompt_template.replace(f"{{{placeholder}}}", ", ".join(exceptions[placeholder]))
-        else:
-            raise ValueError(f"Error: Placeholder '{placeholder}' not found in exceptions config. Unable to generate prompt.")
-    
-    return prompt_template
+    compiled_template = compile_prompt_template(prompt_template)
+    check_placeholders(compiled_template, exceptions)
+    return render_prompt(compiled_template, {placeholder: ", ".join(exceptions[placeholder]) for placeholder in compiled_template[1]})
+
+# Function to list every subset of a category's exceptions, the full list first and the empty one last
+def exception_subsets(category_exceptions):
+    return [subset for size in range(len(category_exceptions), -1, -1) for subset in combinations(category_exceptions, size)]
+
+# Function to yield {placeholder: exception subset} for the cartesian product of subsets, or a random sample of it
+def iter_exception_sweep(exceptions, placeholders, vary=None, sample=None, seed=None):
+    placeholders = list(dict.fromkeys(placeholders))
+    # Categories that aren't varied keep their full exception list in every variant
+    options = [exception_subsets(exceptions[placeholder]) if vary is None or placeholder in vary else [tuple(exceptions[placeholder])]
+               for placeholder in placeholders]
+    total = prod(len(choices) for choices in options)
+    if sample is None or sample >= total:
+        for combination in product(*options):
+            yield dict(zip(placeholders, combination))
+        return
+    # random.sample over a range never materializes the product; each index is decoded digit by digit
+    for index in sorted(random.Random(seed).sample(range(total), sample)):
+        combination = []
+        for choices in reversed(options):
+            index, digit = divmod(index, len(choices))
+            combination.append(choices[digit])
+        yield dict(zip(placeholders, reversed(combination)))
 
 # Function to find the next available prompt number
 def get_next_prompt_number(destination_folder):
@@ -59,21 +105,90 @@ def get_next_prompt_number(destination_folder):
     else:
         return 1  # Start from 1 if no prompt files are found
 
+# Function to claim the first free 'PromptX.txt' from `number` on; O_EXCL makes the claim atomic across processes
+def reserve_prompt_file(destination_folder, number):
+    while True:
+        file_path = os.path.join(destination_folder, f"Prompt{number}.txt")
+        try:
+            return number, file_path, os.open(file_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        except FileExistsError:
+            number += 1  # Taken by another writer since the folder was scanned
+
 # Function to save the generated prompt to a file
 def save_prompt_to_file(prompt, destination_folder):
-    # Find the next available prompt number
-    next_number = get_next_prompt_number(destination_folder)
-    
-    # Construct the file name (e.g., 'Prompt1.txt', 'Prompt2.txt', etc.)
-    file_name = f"Prompt{next_number}.txt"
-    file_path = os.path.join(destination_folder, file_name)
+    # Find the next available prompt number and claim its file (e.g., 'Prompt1.txt', 'Prompt2.txt', etc.)
+    _, file_path, fd = reserve_prompt_file(destination_folder, get_next_prompt_number(destination_folder))
     
     # Save the prompt to the file
-    with open(file_path, 'w') as file:
+    with os.fdopen(fd, 'w') as file:
         file.write(prompt)
     
     print(f"Generated prompt saved as: {file_path}")
 
+# Function to read the content hashes already listed in a sweep manifest
+def load_manifest_hashes(manifest_file):
+    hashes = set()
+    if os.path.exists(manifest_file):
+        with open(manifest_file, 'r') as f:
+            for line in f:
+                try:
+                    hashes.add(json.loads(line)['content_hash'])
+                except (json.JSONDecodeError, KeyError):
+                    continue  # A line cut short by a crash
+    return hashes
+
+# Function to write every variant of a sweep in one pass, numbering the files once and logging each in the manifest
+def generate_prompt_sweep(prompt_template, exceptions, destination_folder, template_name=None, manifest_file=None, vary=None, sample=None, seed=None):
+    compiled_template = compile_prompt_template(prompt_template)
+    check_placeholders(compiled_template, exceptions)
+    if vary is not None:
+        unknown = set(vary) - set(compiled_template[1])
+        if unknown:
+            raise ValueError(f"Error: Cannot vary {', '.join(sorted(unknown))}: not a placeholder of the template.")
+    os.makedirs(destination_folder, exist_ok=True)
+    manifest_file = manifest_file or os.path.join(destination_folder, MANIFEST_NAME)
+    manifest_folder = os.path.dirname(os.path.abspath(manifest_file))
+
+    # Each subset is joined once, not once per variant
+    rendered = {}
+    for placeholder in compiled_template[1]:
+        for subset in exception_subsets(exceptions[placeholder]) + [tuple(exceptions[placeholder])]:
+            rendered[placeholder, subset] = ", ".join(subset) or NO_EXCEPTIONS
+
+    # Variants already generated by an earlier sweep (same text) are not written again
+    existing = load_manifest_hashes(manifest_file)
+    next_number = get_next_prompt_number(destination_folder)
+    written = skipped = 0
+    with open(manifest_file, 'a') as manifest:
+        for variant in iter_exception_sweep(exceptions, compiled_template[1], vary=vary, sample=sample, seed=seed):
+            prompt = render_prompt(compiled_template, {placeholder: rendered[placeholder, subset] for placeholder, subset in variant.items()})
+            prompt_hash = content_hash(prompt)
+            if prompt_hash in existing:
+                skipped += 1
+                continue
+            number, file_path, fd = reserve_prompt_file(destination_folder, next_number)
+            with os.fdopen(fd, 'w') as file:
+                file.write(prompt)
+            next_number = number + 1
+            existing.add(prompt_hash)
+            manifest.write(json.dumps({'file': os.path.relpath(os.path.abspath(file_path), manifest_folder), 'template': template_name,
+                                       'exceptions': {placeholder: list(subset) for placeholder, subset in variant.items()},
+                                       'content_hash': prompt_hash}) + "\n")
+            written += 1
+    return written, skipped, manifest_file
+
+# Function to list the prompt files of a sweep manifest, resolved against the manifest's folder
+def load_prompt_manifest(manifest_file):
+    manifest_folder = os.path.dirname(manifest_file)
+    prompt_files = []
+    with open(manifest_file, 'r') as f:
+        for line in f:
+            try:
+                prompt_files.append(os.path.join(manifest_folder, json.loads(line)['file']))
+            except (json.JSONDecodeError, KeyError):
+                continue
+    return prompt_files
+
 # Main function to handle command-line arguments
 def main():
     # Set up command-line argument parsing
@@ -81,6 +196,11 @@ def main():
     parser.add_argument('--exceptions', type=str, required=True, help='Path to the exceptions config file (JSON).')
     parser.add_argument('--template', type=str, required=True, help='Path to the prompt template file (TXT).')
     parser.add_argument('--destination', type=str, required=True, help='Folder to save the generated prompt.')
+    parser.add_argument('--sweep', action='store_true', help="Generate one prompt per combination of exception subsets instead of a single prompt.")
+    parser.add_argument('--vary', type=str, nargs='+', default=None, help="Placeholders whose exceptions are swept (defaults to all); the others keep their full list.")
+    parser.add_argument('--sample', type=int, default=None, help="Write a random sample of this many combinations instead of the full cartesian product.")
+    parser.add_argument('--seed', type=int, default=None, help="Seed for --sample.")
+    parser.add_argument('--manifest', type=str, default=None, help=f"JSONL manifest of the sweep's prompts (defaults to {MANIFEST_NAME} in the destination folder).")
 
     # Parse the arguments
     args = parser.parse_args()
@@ -93,6 +213,12 @@ def main():
 
     if prompt_template:
         try:
+            if args.sweep:
+                written, skipped, manifest_file = generate_prompt_sweep(prompt_template, exceptions, args.destination, template_name=args.template,
+                                                                        manifest_file=args.manifest, vary=args.vary, sample=args.sample, seed=args.seed)
+                print(f"Generated {written} prompt variants in {args.destination} ({skipped} already generated); manifest: {manifest_file}")
+                return
+
             # Generate the dynamic prompt with the loaded exceptions
             dynamic_prompt = generate_dynamic_prompt(prompt_template, exceptions)
             
@@ -3,21 +3,23 @@ import datetime
 import json
 import os
 import time
-import openai
-import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
 
+from rate_limiter import configure_rate_limits, estimate_tokens, get_rate_limiter
+from response_cache import content_hash
+from metadata_store import MetadataStore, default_store_path
+from similarity_engine import DEFAULT_EMBEDDING_CACHE, SIMILARITY_BACKENDS, EmbeddingCache, SimilarityEngine
 
-import requests
-
-# Set your OpenAI API key
-openai.api_key = os.getenv("OPENAI_API_KEY")
+METADATA_MODEL = "gpt-4"
+MAX_WORKERS = 8  # Prompts whose metadata is generated concurrently
 
 # Cosine similarity threshold for determining whether fields are the "Same as before"
 SIMILARITY_THRESHOLD = 0.9
 
+# Fields compared with the previous version by text similarity ("Prompt Score" is compared exactly)
+TEXT_FIELDS = ['Summary', 'Content Categories', 'Prompt Scope', 'Risk Sensitivity', 'Score Reason']
+
 # Predefined Content Categories
 PREDEFINED_CATEGORIES = {
     "nudity": "Nudity and Sexually Suggestive Content",
@@ -35,25 +37,21 @@ PREDEFINED_CATEGORIES = {
 
 
 # Function to get the next version number for a given prompt file
-def get_next_version(existing_metadata, prompt_file_location):
-    if prompt_file_location in existing_metadata['Prompt File Location'].values:
-        existing_versions = existing_metadata[existing_metadata['Prompt File Location'] == prompt_file_location]['Version']
-        return existing_versions.max() + 1
-    return 1
-
-
-# Function to load existing metadata if available
-def load_existing_metadata(metadata_file):
-    if os.path.exists(metadata_file):
-        print(f"Loading existing metadata from {metadata_file}")
-        df = pd.read_csv(metadata_file)
-        if 'Prompt File Location' not in df.columns:
-            print("'Prompt File Location' column not found in existing metadata file, initializing new DataFrame.")
-            return pd.DataFrame(columns=['Prompt File Location', 'Version', 'Prompt Title', 'Creation Date', 'Last Modified Date', 'Summary', 'Content Categories', 'Prompt Scope', 'Risk Sensitivity', 'Prompt Score', 'Score Reason'])
-        return df
+def get_next_version(metadata_store, prompt_file_location):
+    return metadata_store.next_version(prompt_file_location)
+
+
+# Function to open the metadata store, importing an existing CSV the first time
+def load_existing_metadata(metadata_file, store_path=None):
+    metadata_store = MetadataStore(store_path or default_store_path(metadata_file))
+    if len(metadata_store) == 0 and os.path.exists(metadata_file):
+        print(f"Importing existing metadata from {metadata_file} into {metadata_store.path}")
+        metadata_store.import_csv(metadata_file)
+    elif len(metadata_store) == 0:
+        print("No existing metadata found, creating new store.")
     else:
-        print("No existing metadata found, creating new file.")
-        return pd.DataFrame(columns=['Prompt File Location', 'Version', 'Prompt Title', 'Creation Date', 'Last Modified Date', 'Summary', 'Content Categories', 'Prompt Scope', 'Risk Sensitivity', 'Prompt Score', 'Score Reason'])
+        print(f"Loading existing metadata from {metadata_store.path}")
+    return metadata_store
 
 # Function to extract file metadata
 def extract_file_metadata(file_path):
@@ -63,43 +61,71 @@ def extract_file_metadata(file_path):
     return creation_time, modified_time
 
 # Function to ensure data types are correctly processed
-def sanitize_field_value(value):
+def sanitize_field_value(value, verbose=True):
     """Helper function to ensure field values are correctly processed."""
     if isinstance(value, (int, float)):  # If the value is numeric, return it as is for numeric fields
-        print(f"Numeric field detected: {value}")
+        if verbose:
+            print(f"Numeric field detected: {value}")
         return value
     elif isinstance(value, str):  # If the value is a string, lower it
-        print(f"String field detected: {value}")
+        if verbose:
+            print(f"String field detected: {value}")
         return value.lower()
-    print(f"Converting field value to string: {value}")
+    if verbose:
+        print(f"Converting field value to string: {value}")
     return str(value)  # Convert any other type to a string
 
 # Function to calculate cosine similarity between two pieces of text
 def cosine_sim(text1, text2):
-    vectorizer = TfidfVectorizer().fit_transform([text1, text2])
-    vectors = vectorizer.toarray()
-    return cosine_similarity(vectors)[0][1]  # Return the similarity between the two texts
+    return float(SimilarityEngine().fit([text1, text2]).pairwise([text1], [text2])[0])
+
+# Function to score every new text field against the previous version of its prompt, for a whole run at once
+def field_similarities(metadata_store, candidates, similarity_engine):
+    """
+    `candidates` is a list of (prompt file location, new metadata) pairs. The engine is
+    fitted once over every old and new value of the run and all pairs are scored in one
+    batch. Returns one {field: similarity} dict per candidate (empty without history).
+    """
+    pairs = []  # (candidate index, field, previous value, new value)
+    for index, (prompt_file_location, new_metadata) in enumerate(candidates):
+        previous_versions = metadata_store.recent_versions(prompt_file_location, 1)
+        if not previous_versions:
+            continue
+        for field in TEXT_FIELDS:
+            last_value = previous_versions[-1][field] or ""
+            new_value = sanitize_field_value(new_metadata[field], verbose=False)
+            if isinstance(new_value, str):
+                pairs.append((index, field, last_value, new_value))
+
+    similarities = [{} for _ in candidates]
+    if pairs:
+        previous_values = [pair[2] for pair in pairs]
+        new_values = [pair[3] for pair in pairs]
+        scores = similarity_engine.fit(previous_values + new_values).pairwise(previous_values, new_values)
+        for (index, field, _, _), score in zip(pairs, scores):
+            similarities[index][field] = float(score)
+    return similarities
 
 
 
-def evaluate_metadata_changes(existing_metadata, prompt_file_location, new_metadata, similarity_threshold=SIMILARITY_THRESHOLD):
+def evaluate_metadata_changes(metadata_store, prompt_file_location, new_metadata, similarity_threshold=SIMILARITY_THRESHOLD, similarities=None):
     # Fetch the last 5 entries for the given prompt file
-    previous_versions = existing_metadata[existing_metadata['Prompt File Location'] == prompt_file_location].tail(5)
+    previous_versions = metadata_store.recent_versions(prompt_file_location, 5)
     
     # If no prior data exists, no need for comparison
-    if previous_versions.empty:
+    if not previous_versions:
         print(f"No previous versions found for {prompt_file_location}. Proceeding with new metadata.")
         return new_metadata
     
     updated_metadata = {}
 
     for field in ['Summary', 'Content Categories', 'Prompt Scope', 'Risk Sensitivity', 'Prompt Score', 'Score Reason']:
-        last_value = previous_versions[field].values[-1] if not previous_versions[field].empty else ""
+        last_value = previous_versions[-1][field] or ""
         new_value = sanitize_field_value(new_metadata[field])
 
         # Skip comparison for numeric fields like "Prompt Score"
         if field == "Prompt Score":
-            if last_value != new_value:
+            if str(last_value) != str(new_value):  # The store keeps every field as text
                 print(f"New value detected for {field}. Updating to: {new_value}")
                 updated_metadata[field] = new_value
             else:
@@ -107,8 +133,11 @@ def evaluate_metadata_changes(existing_metadata, prompt_file_location, new_metad
                 updated_metadata[field] = "Same as before"
             continue
 
-        # Calculate cosine similarity between old and new values for text fields
-        if isinstance(last_value, str) and isinstance(new_value, str):
+        # Calculate cosine similarity between old and new values for text fields (precomputed for the whole run when given)
+        if similarities is not None and field in similarities:
+            similarity = similarities[field]
+            print(f"Comparing {field}. Cosine similarity: {similarity}")
+        elif isinstance(last_value, str) and isinstance(new_value, str):
             similarity = cosine_sim(last_value, new_value)
             print(f"Comparing {field}. Cosine similarity: {similarity}")
         else:
@@ -125,8 +154,8 @@ def evaluate_metadata_changes(existing_metadata, prompt_file_location, new_metad
             updated_metadata[field] = new_value
 
     # Keep the title unchanged if it exists
-    if not previous_versions['Prompt Title'].empty:
-        updated_metadata['Prompt Title'] = previous_versions.iloc[-1]['Prompt Title']
+    if previous_versions[-1]['Prompt Title']:
+        updated_metadata['Prompt Title'] = previous_versions[-1]['Prompt Title']
         print(f"Keeping title unchanged: {updated_metadata['Prompt Title']}")
     else:
         updated_metadata['Prompt Title'] = new_metadata['Prompt Title']
@@ -150,21 +179,36 @@ MAX_RETRIES = 5
 BACKOFF_FACTOR = 2
 
 def generate_metadata_from_prompt(prompt_text):
+    # The SDK is loaded by the first call, so commands that never generate metadata don't pay for it
+    import openai
+    import requests
+
+    # Set your OpenAI API key
+    openai.api_key = os.getenv("OPENAI_API_KEY")
+
+    messages = [
+        {"role": "system", "content": "You are a helpful assistant that generates metadata for prompt evaluation. Always respond in valid JSON format."},
+        {"role": "user", "content": f"Generate the following metadata for this prompt: \n\nPrompt: {prompt_text}\n\nReturn the result in this structured JSON format exactly:\n{{\"title\": \"Prompt Title\", \"summary\": \"Short summary (20-30 words)\", \"categories\": [\"List of content categories like nudity, violence, etc.\"], \"scope\": \"Broad or specific\", \"risk_sensitivity\": \"Low, Medium, or High\", \"prompt_score\": \"1 to 5 (5 being very clear and safe, 1 being unclear or risky)\", \"score_reason\": \"Why this score was given\"}}"}
+    ]
+    # Every worker thread paces against the same request and token budget instead of sleeping a fixed second
+    limiter = get_rate_limiter(METADATA_MODEL)
+    estimated_tokens = estimate_tokens({"messages": messages, "max_tokens": 300})
+
     retries = 0
     while retries < MAX_RETRIES:
         try:
+            limiter.acquire(estimated_tokens)
+
             # Make GPT-4 API call to generate metadata
             response = openai.ChatCompletion.create(
-                model="gpt-4",
-                messages=[
-                    {"role": "system", "content": "You are a helpful assistant that generates metadata for prompt evaluation. Always respond in valid JSON format."},
-                    {"role": "user", "content": f"Generate the following metadata for this prompt: \n\nPrompt: {prompt_text}\n\nReturn the result in this structured JSON format exactly:\n{{\"title\": \"Prompt Title\", \"summary\": \"Short summary (20-30 words)\", \"categories\": [\"List of content categories like nudity, violence, etc.\"], \"scope\": \"Broad or specific\", \"risk_sensitivity\": \"Low, Medium, or High\", \"prompt_score\": \"1 to 5 (5 being very clear and safe, 1 being unclear or risky)\", \"score_reason\": \"Why this score was given\"}}"}
-                ],
+                model=METADATA_MODEL,
+                messages=messages,
                 max_tokens=300,
                 n=1,
                 temperature=0.5,
                 timeout=30  # Timeout in 30 seconds if no response
             )
+            limiter.settle(estimated_tokens, (response.get('usage') or {}).get('total_tokens'))
 
             # Process the GPT-4 response
             metadata = response['choices'][0]['message']['content'].strip()
@@ -195,6 +239,7 @@ def generate_metadata_from_prompt(prompt_text):
             retries += 1
             wait_time = BACKOFF_FACTOR ** retries
             print(f"Rate limit hit. Retrying in {wait_time} seconds...")
+            limiter.penalize(wait_time)  # Hold back the other workers too
             time.sleep(wait_time)
 
         except openai.error.OpenAIError as e:
@@ -208,12 +253,19 @@ def generate_metadata_from_prompt(prompt_text):
     print("Max retries exceeded. Failed to generate metadata.")
     return None
 
+# Function to read a prompt file with its file dates and content hash
+def read_prompt_file(prompt_path):
+    creation_time, modified_time = extract_file_metadata(prompt_path)
+    with open(prompt_path, "r") as file:
+        prompt_text = file.read()
+    return prompt_text, content_hash(prompt_text), creation_time, modified_time
+
 # Function to scan prompt files and generate metadata
-def generate_prompt_metadata(prompts_folder, metadata_file="prompt_metadata.csv"):
+def generate_prompt_metadata(prompts_folder, metadata_file="prompt_metadata.csv", max_workers=MAX_WORKERS, force=False, store_path=None, similarity_engine=None):
     prompt_metadata = []
 
     # Load existing metadata if it exists
-    existing_metadata = load_existing_metadata(metadata_file)
+    metadata_store = load_existing_metadata(metadata_file, store_path)
     
     # Check if prompts folder exists
     if not os.path.exists(prompts_folder):
@@ -229,29 +281,26 @@ def generate_prompt_metadata(prompts_folder, metadata_file="prompt_metadata.csv"
         print(f"No prompt files found in the folder {prompts_folder}")
         return
 
+    # Only prompts whose exact text has no metadata at their location yet cost an API call
+    changed = []
     for prompt_file in prompt_files:
         prompt_path = os.path.join(prompts_folder, prompt_file)
-        
-        # Extract file metadata (creation date, modification date)
-        creation_time, modified_time = extract_file_metadata(prompt_path)
-        
-        # Read the content of the prompt file
-        with open(prompt_path, "r") as file:
-            prompt_text = file.read()
-
-        # Make a single GPT-4 call to generate all metadata
-        print(f"Generating metadata for prompt file: {prompt_file}")
-        metadata_dict = generate_metadata_from_prompt(prompt_text)  # Already returns a dict
+        prompt_text, prompt_hash, creation_time, modified_time = read_prompt_file(prompt_path)
+        if not force and metadata_store.has_content(prompt_path, prompt_hash):
+            continue
+        changed.append((prompt_file, prompt_path, prompt_text, prompt_hash, creation_time, modified_time))
+    print(f"{len(prompt_files) - len(changed)} of {len(prompt_files)} prompts are unchanged; generating metadata for {len(changed)}.")
 
+    # Make a single GPT-4 call per changed prompt, several at a time under the shared rate limiter
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        generated = list(executor.map(lambda item: generate_metadata_from_prompt(item[2]), changed))
+
+    candidates = []
+    for (prompt_file, prompt_path, _, prompt_hash, creation_time, modified_time), metadata_dict in zip(changed, generated):
         if metadata_dict is None:
             print(f"Skipping metadata generation for {prompt_file} due to GPT-4 error.")
             continue
-
-        # Check if the prompt already exists, and assign the correct version number
-        version = get_next_version(existing_metadata, prompt_path)
-
-        # Compare against the last 5 versions to evaluate changes
-        final_metadata = evaluate_metadata_changes(existing_metadata, prompt_path, {
+        candidates.append(((prompt_file, prompt_path, prompt_hash, creation_time, modified_time), {
             'Prompt Title': metadata_dict.get('title', 'Untitled'),
             'Summary': metadata_dict.get('summary', 'No summary'),
             'Content Categories': ', '.join(metadata_dict.get('categories', [])),
@@ -259,7 +308,18 @@ def generate_prompt_metadata(prompts_folder, metadata_file="prompt_metadata.csv"
             'Risk Sensitivity': metadata_dict.get('risk_sensitivity', 'Unknown'),
             'Prompt Score': metadata_dict.get('prompt_score', 'Unknown'),
             'Score Reason': metadata_dict.get('score_reason', 'Unknown')
-        })
+        }))
+
+    # Score every changed field of the run against its previous version in one batch
+    similarities = field_similarities(metadata_store, [(details[1], new_metadata) for details, new_metadata in candidates], similarity_engine or SimilarityEngine())
+
+    # Versions and change summaries are assigned in folder order
+    for ((prompt_file, prompt_path, prompt_hash, creation_time, modified_time), new_metadata), field_similarity in zip(candidates, similarities):
+        # Check if the prompt already exists, and assign the correct version number
+        version = get_next_version(metadata_store, prompt_path)
+
+        # Compare against the last 5 versions to evaluate changes
+        final_metadata = evaluate_metadata_changes(metadata_store, prompt_path, new_metadata, similarities=field_similarity)
 
         # Add metadata to the list
         prompt_metadata.append({
@@ -273,33 +333,56 @@ def generate_prompt_metadata(prompts_folder, metadata_file="prompt_metadata.csv"
             'Prompt Scope': final_metadata['Prompt Scope'],
             'Risk Sensitivity': final_metadata['Risk Sensitivity'],
             'Prompt Score': final_metadata['Prompt Score'],
-            'Score Reason': final_metadata['Score Reason']
+            'Score Reason': final_metadata['Score Reason'],
+            'Content Hash': prompt_hash
         })
 
         print(f"Metadata for {prompt_file} (version {version}) generated successfully.")
 
-        # Pause to avoid rate-limiting from OpenAI API
-        time.sleep(1)  # Adjust based on your API limits
-
-    # Convert the new metadata into a DataFrame
-    new_metadata_df = pd.DataFrame(prompt_metadata)
+    if not prompt_metadata:
+        print(f"No prompt metadata changes; {metadata_file} left as is.")
+        metadata_store.close()
+        return
 
-    # Concatenate with the existing metadata and save the CSV
-    final_metadata_df = pd.concat([existing_metadata, new_metadata_df], ignore_index=True)
-    final_metadata_df.to_csv(metadata_file, index=False)
-    print(f"Prompt metadata successfully updated in {metadata_file}")
+    # Store every new version in one transaction, then add just those rows to the CSV export
+    metadata_store.append(prompt_metadata)
+    metadata_store.append_csv(metadata_file, prompt_metadata)
+    metadata_store.close()
+    print(f"Prompt metadata successfully updated in {metadata_store.path} and {metadata_file}")
 
 def main():
     # Set up argument parsing
     parser = argparse.ArgumentParser(description="Generate metadata for prompt files.")
     parser.add_argument('--prompts_folder', type=str, required=True, help="The folder containing prompt files.")
     parser.add_argument('--output_file', type=str, default="prompt_metadata.csv", help="The output CSV file to store the metadata.")
+    parser.add_argument('--store_file', type=str, default=None, help="SQLite metadata store (defaults to the output file with a .sqlite3 extension).")
+    parser.add_argument('--export_csv', action='store_true', help="Rewrite the output CSV from the full store history and exit.")
+    parser.add_argument('--max_workers', type=int, default=MAX_WORKERS, help="Number of prompts whose metadata is generated concurrently.")
+    parser.add_argument('--rpm', type=int, default=None, help="Requests-per-minute budget for the metadata model.")
+    parser.add_argument('--tpm', type=int, default=None, help="Tokens-per-minute budget for the metadata model.")
+    parser.add_argument('--similarity_backend', choices=SIMILARITY_BACKENDS, default='tfidf', help="How changed fields are compared with the previous version: one TF-IDF fit per run, or cached OpenAI embeddings.")
+    parser.add_argument('--embedding_cache', type=str, default=DEFAULT_EMBEDDING_CACHE, help="SQLite cache of embeddings for the 'embeddings' backend.")
+    parser.add_argument('--force', action='store_true', help="Regenerate metadata even for prompts whose content hasn't changed.")
 
     # Parse the arguments
     args = parser.parse_args()
+    configure_rate_limits(requests_per_minute=args.rpm, tokens_per_minute=args.tpm)
+
+    if args.export_csv:
+        metadata_store = load_existing_metadata(args.output_file, args.store_file)
+        metadata_store.export_csv(args.output_file)
+        print(f"Exported {len(metadata_store)} metadata versions to {args.output_file}")
+        metadata_store.close()
+        return
+
+    embedding_cache = EmbeddingCache(args.embedding_cache) if args.similarity_backend == 'embeddings' else None
+    similarity_engine = SimilarityEngine(args.similarity_backend, embedding_cache=embedding_cache)
 
     # Generate prompt metadata based on the provided folder and output file
-    generate_prompt_metadata(prompts_folder=args.prompts_folder, metadata_file=args.output_file)
+    generate_prompt_metadata(prompts_folder=args.prompts_folder, metadata_file=args.output_file, max_workers=args.max_workers, force=args.force,
+                             store_path=args.store_file, similarity_engine=similarity_engine)
+    if embedding_cache is not None:
+        embedding_cache.close()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,182 @@
+import asyncio
+import re
+import time
+
+# Default (requests per minute, tokens per minute) budgets per model.
+# These are only starting points; the limiter tightens them from the x-ratelimit-* response headers.
+DEFAULT_LIMITS = {
+    "gpt-4o-mini": (500, 200000),
+    "gpt-4o": (500, 30000),
+    "gpt-4": (500, 10000),
+}
+FALLBACK_LIMITS = (500, 30000)
+
+# Rough token accounting used to price a payload before it is sent
+CHARS_PER_TOKEN = 4
+MESSAGE_OVERHEAD_TOKENS = 4
+IMAGE_TOKEN_ESTIMATE = 765  # A high-detail 512x512 tile for the 4o family
+
+# Slots in the shared state array
+_REQUEST_LEVEL, _TOKEN_LEVEL, _LAST_REFILL, _REQUEST_CAPACITY, _TOKEN_CAPACITY, _BLOCKED_UNTIL = range(6)
+
+
+# Function to estimate the token cost of a chat completion payload before sending it
+def estimate_tokens(payload):
+    tokens = 0
+    for message in payload.get("messages", []):
+        tokens += MESSAGE_OVERHEAD_TOKENS
+        content = message.get("content", "")
+        if isinstance(content, str):
+            tokens += len(content) // CHARS_PER_TOKEN
+            continue
+        for part in content:
+            if part.get("type") == "image_url":
+                tokens += IMAGE_TOKEN_ESTIMATE
+            else:
+                tokens += len(part.get("text", "")) // CHARS_PER_TOKEN
+    # Completion tokens count against the budget as soon as the request is accepted
+    return tokens + payload.get("max_tokens", 0)
+
+
+# Function to convert reset durations such as "1s", "6m0s" or "20ms" to seconds
+def parse_reset_duration(value):
+    if not value:
+        return None
+    seconds = 0.0
+    matched = False
+    for amount, unit in re.findall(r"(\d+(?:\.\d+)?)(ms|h|m|s)", value):
+        matched = True
+        seconds += float(amount) * {"ms": 0.001, "s": 1, "m": 60, "h": 3600}[unit]
+    if not matched:
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return seconds
+
+
+def _header_number(headers, name):
+    value = headers.get(name)
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+class RateLimiter:
+    """
+    Token bucket pacing both requests and tokens for a single model.
+
+    State lives in a shared-memory array guarded by a process lock, so one limiter
+    created in the parent is honoured by every worker process and every asyncio task.
+    Callers reserve capacity up front and sleep for the returned deficit, which keeps
+    concurrent workers from stampeding the API and retrying in lockstep.
+    """
+
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        import multiprocessing
+
+        self._lock = multiprocessing.Lock()
+        self._state = multiprocessing.RawArray('d', 6)
+        self._state[_REQUEST_CAPACITY] = requests_per_minute
+        self._state[_TOKEN_CAPACITY] = tokens_per_minute
+        self._state[_REQUEST_LEVEL] = requests_per_minute
+        self._state[_TOKEN_LEVEL] = tokens_per_minute
+        self._state[_LAST_REFILL] = time.time()
+        self._state[_BLOCKED_UNTIL] = 0.0
+
+    def _refill(self, now):
+        elapsed = max(0.0, now - self._state[_LAST_REFILL])
+        for level, capacity in ((_REQUEST_LEVEL, _REQUEST_CAPACITY), (_TOKEN_LEVEL, _TOKEN_CAPACITY)):
+            rate = self._state[capacity] / 60.0
+            self._state[level] = min(self._state[capacity], self._state[level] + elapsed * rate)
+        self._state[_LAST_REFILL] = now
+
+    def reserve(self, tokens):
+        """Reserve one request and `tokens` tokens; return how long the caller must wait."""
+        with self._lock:
+            now = time.time()
+            self._refill(now)
+            self._state[_REQUEST_LEVEL] -= 1
+            self._state[_TOKEN_LEVEL] -= tokens
+            waits = [self._state[_BLOCKED_UNTIL] - now]
+            for level, capacity in ((_REQUEST_LEVEL, _REQUEST_CAPACITY), (_TOKEN_LEVEL, _TOKEN_CAPACITY)):
+                if self._state[level] < 0:
+                    waits.append(-self._state[level] / (self._state[capacity] / 60.0))
+            return max(0.0, *waits)
+
+    def acquire(self, tokens):
+        wait_time = self.reserve(tokens)
+        if wait_time > 0:
+            time.sleep(wait_time)
+        return wait_time
+
+    async def acquire_async(self, tokens):
+        wait_time = self.reserve(tokens)
+        if wait_time > 0:
+            await asyncio.sleep(wait_time)
+        return wait_time
+
+    def settle(self, estimated_tokens, actual_tokens):
+        """Return over-estimated tokens to the bucket once the response reports real usage."""
+        if actual_tokens is None:
+            return
+        with self._lock:
+            self._state[_TOKEN_LEVEL] = min(self._state[_TOKEN_CAPACITY],
+                                            self._state[_TOKEN_LEVEL] + estimated_tokens - actual_tokens)
+
+    def update_from_headers(self, headers):
+        """Adopt the server's view of the budget from the x-ratelimit-* response headers."""
+        with self._lock:
+            now = time.time()
+            self._refill(now)
+            for kind, level, capacity in (("requests", _REQUEST_LEVEL, _REQUEST_CAPACITY), ("tokens", _TOKEN_LEVEL, _TOKEN_CAPACITY)):
+                limit = _header_number(headers, f"x-ratelimit-limit-{kind}")
+                remaining = _header_number(headers, f"x-ratelimit-remaining-{kind}")
+                if limit:
+                    self._state[capacity] = limit
+                if remaining is not None:
+                    self._state[level] = min(self._state[level], remaining)
+                    if remaining <= 0:
+                        reset = parse_reset_duration(headers.get(f"x-ratelimit-reset-{kind}"))
+                        if reset:
+                            self._state[_BLOCKED_UNTIL] = max(self._state[_BLOCKED_UNTIL], now + reset)
+
+    def penalize(self, wait_time):
+        """After a 429, pause every caller sharing this limiter instead of just the one that was rejected."""
+        with self._lock:
+            now = time.time()
+            self._refill(now)
+            self._state[_REQUEST_LEVEL] = min(self._state[_REQUEST_LEVEL], 0.0)
+            self._state[_BLOCKED_UNTIL] = max(self._state[_BLOCKED_UNTIL], now + wait_time)
+
+
+# Registry of limiters shared by every request for the same model
+_limiters = {}
+_limit_overrides = {}
+
+
+# Function to override the default budgets before limiters are created
+def configure_rate_limits(requests_per_minute=None, tokens_per_minute=None, model=None):
+    key = model or "*"
+    _limit_overrides[key] = (requests_per_minute, tokens_per_minute)
+
+
+def get_rate_limiter(model):
+    if model not in _limiters:
+        rpm, tpm = DEFAULT_LIMITS.get(model, FALLBACK_LIMITS)
+        for key in ("*", model):
+            override_rpm, override_tpm = _limit_overrides.get(key, (None, None))
+            rpm = override_rpm or rpm
+            tpm = override_tpm or tpm
+        _limiters[model] = RateLimiter(rpm, tpm)
+    return _limiters[model]
+
+
+# Function to install limiters created in the parent inside a worker process (Pool initializer)
+def install_rate_limiters(limiters):
+    _limiters.update(limiters)
+
+
+def get_rate_limiters():
+    return dict(_limiters)
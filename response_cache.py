@@ -0,0 +1,130 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+DEFAULT_CACHE_PATH = ".cache/responses.sqlite3"
+
+
+# Function to hash prompt text or encoded image data (not memoized: a cache keyed on the text would pin every encoded image it saw)
+def content_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    """
+    Content-addressed SQLite store for model responses.
+
+    Entries are keyed by the model, a hash of the prompt text, a hash of the image
+    and the remaining payload parameters, so editing one prompt only invalidates
+    that prompt's entries. In replay mode the cache is read-only and misses are
+    reported instead of being sent to the API.
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_bytes=None, max_age_seconds=None, replay=False):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+        self.replay = replay
+        self._conn = None
+
+    # Connections are opened lazily so the cache can be pickled into worker processes
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_conn'] = None
+        return state
+
+    def _connect(self):
+        if self._conn is None:
+            if self.replay:
+                self._conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, check_same_thread=False)
+            else:
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                self._conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+                self._conn.execute("PRAGMA journal_mode=WAL")
+                self._conn.execute("PRAGMA synchronous=NORMAL")
+                self._conn.execute("""
+                    CREATE TABLE IF NOT EXISTS responses (
+                        key TEXT PRIMARY KEY,
+                        model TEXT NOT NULL,
+                        prompt_hash TEXT NOT NULL,
+                        image_hash TEXT NOT NULL,
+                        response TEXT NOT NULL,
+                        size INTEGER NOT NULL,
+                        created_at REAL NOT NULL,
+                        last_access REAL NOT NULL
+                    )
+                """)
+                self._conn.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+                self._conn.commit()
+        return self._conn
+
+    @staticmethod
+    def make_key(model, prompt, encoded_image, params):
+        """Return (key, prompt_hash, image_hash); `params` holds every other payload setting that affects the answer."""
+        prompt_hash = content_hash(prompt)
+        image_hash = content_hash(encoded_image)
+        material = json.dumps({
+            'model': model,
+            'prompt': prompt_hash,
+            'image': image_hash,
+            'params': params,
+        }, sort_keys=True)
+        return hashlib.sha256(material.encode('utf-8')).hexdigest(), prompt_hash, image_hash
+
+    def get(self, key):
+        try:
+            conn = self._connect()
+            row = conn.execute("SELECT response, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+        except sqlite3.OperationalError:
+            return None  # Missing cache file in replay mode behaves like an empty cache
+        if row is None:
+            return None
+        response, created_at = row
+        if self.max_age_seconds is not None and time.time() - created_at > self.max_age_seconds:
+            return None
+        if not self.replay:
+            conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+            conn.commit()
+        return response
+
+    def put(self, key, model, prompt_hash, image_hash, response):
+        if self.replay:
+            return
+        now = time.time()
+        conn = self._connect()
+        conn.execute(
+            "INSERT OR REPLACE INTO responses (key, model, prompt_hash, image_hash, response, size, created_at, last_access) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (key, model, prompt_hash, image_hash, response, len(response.encode('utf-8')), now, now)
+        )
+        conn.commit()
+
+    def evict(self):
+        """Drop entries older than max_age_seconds, then least recently used entries beyond max_bytes."""
+        if self.replay:
+            return 0
+        conn = self._connect()
+        removed = 0
+        if self.max_age_seconds is not None:
+            removed += conn.execute("DELETE FROM responses WHERE created_at < ?", (time.time() - self.max_age_seconds,)).rowcount
+        if self.max_bytes is not None:
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            if total > self.max_bytes:
+                stale_keys = []
+                for key, size in conn.execute("SELECT key, size FROM responses ORDER BY last_access ASC"):
+                    if total <= self.max_bytes:
+                        break
+                    stale_keys.append((key,))
+                    total -= size
+                conn.executemany("DELETE FROM responses WHERE key = ?", stale_keys)
+                removed += len(stale_keys)
+        conn.commit()
+        if removed:
+            print(f"Evicted {removed} cached responses from {self.path}")
+        return removed
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
@@ -0,0 +1,155 @@
+import json
+import re
+from collections import namedtuple
+
+# Why a response yielded no verdict; recorded in the run log and counted by the perf tracer
+PARSE_ERRORS = (
+    "request_failed",      # The call itself failed ("DUMMY") or returned nothing
+    "no_json",             # No JSON value anywhere in the text
+    "invalid_json",        # Something that starts like JSON but doesn't decode, and nothing could be salvaged
+    "not_an_object",       # Valid JSON, but not an object
+    "missing_offensive",   # The object has no "offensive" field
+    "invalid_offensive",   # The "offensive" field isn't a boolean (or true/false/yes/no)
+    "no_results",          # A multi-image answer is an object holding no list of verdicts
+)
+
+# Parsed verdict: {'offensive': bool, 'categories': [names], 'confidence': float or None}, or None with an error
+VerdictParse = namedtuple('VerdictParse', ['verdict', 'error', 'salvaged'])
+
+_decoder = json.JSONDecoder()
+_JSON_START = re.compile(r"[{\[]")
+_OBJECT_START = re.compile(r"\{")
+# A verdict object cut short: the answer itself opens the object (optionally inside a code fence) and names one
+# value for "offensive", not a schema echo such as "true/false" or "true or false"
+_TRUNCATED_VERDICT_START = re.compile(r'\s*(?:```(?:json)?\s*)?\{')
+_OFFENSIVE_FIELD = re.compile(r'"offensive"\s*:\s*"?(true|false|yes|no)\b(?!"?\s*(?:/|\||or\b))', re.IGNORECASE)
+_BOOLEAN_WORDS = {'true': True, 'yes': True, 'false': False, 'no': False}
+
+
+def iter_json_values(text, objects_only=False):
+    """
+    Yield every top-level JSON value embedded in `text`, in order.
+
+    `raw_decode` parses straight from each candidate opening brace and stops at the end
+    of the value, so prose before or after it and code fences on either side need no
+    stripping, and the text is scanned once rather than cleaned and re-parsed.
+    """
+    start_pattern = _OBJECT_START if objects_only else _JSON_START
+    match = start_pattern.search(text)
+    while match:
+        try:
+            value, end = _decoder.raw_decode(text, match.start())
+        except json.JSONDecodeError:
+            end = match.start() + 1  # e.g. a brace in the prose, or an answer cut off by max_tokens
+        else:
+            yield value
+        match = start_pattern.search(text, end)
+
+
+# Function to return (value, error) for the first JSON value in `text`
+def extract_json(text, objects_only=False):
+    for value in iter_json_values(text, objects_only):
+        return value, None
+    return None, "invalid_json" if _JSON_START.search(text) else "no_json"
+
+
+# Function to read a JSON boolean, also accepting "true"/"false"/"yes"/"no" strings and 0/1
+def _coerce_bool(value):
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, int) and value in (0, 1):
+        return bool(value)
+    if isinstance(value, str):
+        return _BOOLEAN_WORDS.get(value.strip().lower())
+    return None
+
+
+# Function to collect flagged category names from a list of names or a {name: flag} mapping
+def _flagged_categories(value):
+    if isinstance(value, dict):
+        return [str(name) for name, flag in value.items() if _coerce_bool(flag)]
+    if isinstance(value, list):
+        return [str(name) for name in value if isinstance(name, (str, int))]
+    return []
+
+
+# Function to read an optional confidence as a probability; percentages are scaled and anything else is dropped
+def _confidence(value):
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return None
+    if 1 < value <= 100:
+        value = value / 100
+    return float(value) if 0 <= value <= 1 else None
+
+
+def validate_verdict(value):
+    """
+    Check a decoded value against the verdict schema and normalize it.
+
+    "offensive" is required; "categories" (a list of names, or a mapping of name to
+    flag, also read from the prompts' "issues" field) and "confidence" are optional,
+    and malformed optional fields are dropped rather than failing the verdict.
+    Returns (verdict, error).
+    """
+    if not isinstance(value, dict):
+        return None, "not_an_object"
+    if "offensive" not in value:
+        return None, "missing_offensive"
+    offensive = _coerce_bool(value["offensive"])
+    if offensive is None:
+        return None, "invalid_offensive"
+    return {
+        'offensive': offensive,
+        'categories': _flagged_categories(value.get("categories", value.get("issues"))),
+        'confidence': _confidence(value.get("confidence")),
+    }, None
+
+
+def parse_verdict(response):
+    """
+    Extract and validate a single-image verdict from a model response.
+
+    When no valid object can be decoded and the response itself starts like a verdict
+    object (typically an answer truncated by max_tokens), the "offensive" field is
+    salvaged from the raw text, since re-asking would pay for the same call again.
+    Prose that merely mentions the field, such as a refusal quoting the format, is not.
+    Returns a VerdictParse.
+    """
+    if not response or response == "DUMMY":
+        return VerdictParse(None, "request_failed", False)
+    # The first object that passes validation wins, so an example object in the prose doesn't mask the verdict
+    error = None
+    for value in iter_json_values(response, objects_only=True):
+        verdict, value_error = validate_verdict(value)
+        if verdict is not None:
+            return VerdictParse(verdict, None, False)
+        error = error or value_error
+    start = _TRUNCATED_VERDICT_START.match(response)
+    match = _OFFENSIVE_FIELD.search(response, start.end()) if start else None
+    if match:
+        return VerdictParse({'offensive': _BOOLEAN_WORDS[match.group(1).lower()], 'categories': [], 'confidence': None}, None, True)
+    if error is None:
+        _, error = extract_json(response)  # No object at all: a bare array or scalar is valid JSON, just not a verdict
+        error = error or "not_an_object"
+    return VerdictParse(None, error, False)
+
+
+def parse_verdict_list(response):
+    """
+    Split a multi-image response into {image_id: raw verdict object}.
+
+    Accepts a bare array or an object wrapping one (e.g. {"results": [...]}, which is
+    what JSON mode produces). Returns (verdicts, error).
+    """
+    if not response or response == "DUMMY":
+        return {}, "request_failed"
+    value, error = extract_json(response)
+    if error is not None:
+        return {}, error
+    if isinstance(value, dict):
+        value = next((item for item in value.values() if isinstance(item, list)), None)
+        if value is None:
+            return {}, "no_results"
+    elif not isinstance(value, list):
+        return {}, "not_an_object"
+    return {str(item["image_id"]): item for item in value if isinstance(item, dict) and "image_id" in item}, None
@@ -0,0 +1,99 @@
+import glob
+import json
+import os
+import socket
+import time
+from datetime import datetime
+
+DEFAULT_RUNS_FOLDER = "runs/"
+
+
+# Function to create a new, sortable run id
+def new_run_id():
+    return datetime.now().strftime('%Y%m%d-%H%M%S')
+
+
+class RunLog:
+    """
+    Append-only JSONL log of every (prompt, image) result in an evaluation run.
+
+    Each raw response and parsed prediction is written and flushed as soon as it
+    completes, so an interrupted run loses at most the requests that were in flight.
+    Every process appends to its own file inside runs/<run_id>/ (named by host and pid,
+    so shards on different machines can be copied into one folder), and `completed()`
+    merges them to tell a resumed or merged run which pairs are done.
+    """
+
+    def __init__(self, run_id=None, runs_folder=DEFAULT_RUNS_FOLDER):
+        self.run_id = run_id or new_run_id()
+        self.run_folder = os.path.join(runs_folder, self.run_id)
+        self._file = None
+
+    # The open file handle stays in the process that opened it
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_file'] = None
+        return state
+
+    def exists(self):
+        return os.path.isdir(self.run_folder)
+
+    def write_manifest(self, **details):
+        os.makedirs(self.run_folder, exist_ok=True)
+        manifest_path = os.path.join(self.run_folder, "run.json")
+        manifest = {}
+        if os.path.exists(manifest_path):
+            with open(manifest_path, 'r') as f:
+                manifest = json.load(f)
+        manifest.setdefault('run_id', self.run_id)
+        manifest.setdefault('created', datetime.now().isoformat(timespec='seconds'))
+        manifest.update(details)
+        # Shard workers share the manifest, so it is replaced atomically rather than rewritten in place
+        temp_path = f"{manifest_path}.{os.getpid()}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(manifest, f, indent=4)
+        os.replace(temp_path, manifest_path)
+
+    def record(self, prompt_file, prompt_hash, image_path, raw_response, prediction, **extra):
+        if self._file is None:
+            os.makedirs(self.run_folder, exist_ok=True)
+            self._file = open(os.path.join(self.run_folder, f"results-{socket.gethostname()}-{os.getpid()}.jsonl"), 'a')
+        entry = {
+            'prompt_file': prompt_file,
+            'prompt_hash': prompt_hash,
+            'image_path': image_path,
+            'raw_response': raw_response,
+            'prediction': prediction,
+            'timestamp': time.time(),
+        }
+        entry.update(extra)
+        self._file.write(json.dumps(entry) + "\n")
+        self._file.flush()
+
+    def entries(self):
+        for results_file in sorted(glob.glob(os.path.join(self.run_folder, "results*.jsonl"))):
+            with open(results_file, 'r') as f:
+                for line in f:
+                    try:
+                        yield json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # A line cut short by a crash is simply redone
+
+    def completed(self, model=None, default_model=None):
+        """
+        Map (prompt_hash, image_path) to the logged prediction for every pair that succeeded.
+        With a `model`, only that model's answers count; entries logged without a model
+        are taken to be `default_model`'s.
+        """
+        done = {}
+        for entry in self.entries():
+            if model is not None and entry.get('model', default_model) != model:
+                continue
+            if entry.get('prediction') != "DUMMY":
+                done[(entry['prompt_hash'], entry['image_path'])] = entry['prediction']
+        return done
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -0,0 +1,88 @@
+import numpy as np
+
+from metrics_engine import DEFAULT_BOOTSTRAP_SAMPLES, DEFAULT_CONFIDENCE, bootstrap_confidence_intervals, confusion_counts, encode_predictions, ground_truth_array, metrics_from_counts
+
+DEFAULT_ROUND_SIZE = 100
+DEFAULT_MIN_SAMPLES = 200
+
+
+# Function to order rows randomly while keeping every prefix stratified by label
+def stratified_order(labels, seed=None):
+    """
+    Each class is shuffled on its own and the classes are then interleaved by relative
+    position, so the first k rows hold (almost exactly) the dataset's class mix for any k.
+    """
+    rng = np.random.default_rng(seed)
+    labels = np.asarray(labels)
+    keys = np.empty(len(labels))
+    for label in np.unique(labels):
+        members = np.flatnonzero(labels == label)
+        rng.shuffle(members)
+        # Spread the class evenly over [0, 1) with a little jitter to break ties between classes
+        keys[members] = (np.arange(len(members)) + rng.random(len(members))) / len(members)
+    return np.argsort(keys, kind="stable")
+
+
+def run_prompt_tournament(labels, image_paths, prompt_files, evaluate_round, round_size=DEFAULT_ROUND_SIZE,
+                          min_samples=DEFAULT_MIN_SAMPLES, confidence=DEFAULT_CONFIDENCE, metric='F1-Score', seed=None,
+                          n_bootstrap=DEFAULT_BOOTSTRAP_SAMPLES):
+    """
+    Compare prompts on a growing stratified sample and stop paying for losers early.
+
+    `evaluate_round(image_paths, prompt_files)` must return {prompt_file: predictions}
+    for the given images. After each round every still-active prompt gets a bootstrap
+    interval on `metric` from `n_bootstrap` replicates; once a prompt has seen
+    `min_samples` images and its upper bound falls below the best prompt's lower bound,
+    it is statistically dominated and dropped. Returns {prompt_file: summary} with the evaluated sample size, point
+    metrics, intervals and the round at which the prompt was eliminated (if any).
+    """
+    labels = np.asarray(labels)
+    order = stratified_order(labels, seed=seed)
+    ground_truth = ground_truth_array(labels)
+
+    active = list(prompt_files)
+    predictions = {prompt_file: [] for prompt_file in prompt_files}
+    summaries = {}
+
+    for round_number, start in enumerate(range(0, len(order), round_size), start=1):
+        rows = order[start:start + round_size]
+        round_results = evaluate_round([image_paths[row] for row in rows], active)
+
+        for prompt_file in list(active):
+            if prompt_file not in round_results:
+                active.remove(prompt_file)  # The prompt couldn't be loaded
+                continue
+            predictions[prompt_file].append(encode_predictions(round_results[prompt_file]))
+        if not active:
+            break
+
+        # Every active prompt has seen the same rows, so all of them are scored in one stacked pass
+        truth = ground_truth[order[:start + len(rows)]]
+        counts = confusion_counts(truth, np.vstack([np.concatenate(predictions[prompt_file]) for prompt_file in active]))
+        point = metrics_from_counts(counts)
+        intervals = bootstrap_confidence_intervals(counts, n_bootstrap, confidence, seed)
+        for i, prompt_file in enumerate(active):
+            summaries[prompt_file] = {
+                'Images Evaluated': len(truth),
+                'Precision': float(point['Precision'][i]),
+                'Recall': float(point['Recall'][i]),
+                'F1-Score': float(point['F1-Score'][i]),
+                'Abstention Rate': float(point['Abstention Rate'][i]),
+                'Confidence Intervals': {name: tuple(float(bound) for bound in values[i]) for name, values in intervals.items()},
+                'Eliminated In Round': None,
+            }
+
+        seen = start + len(rows)
+        if seen >= min_samples and len(active) > 1:
+            best_lower = max(summaries[prompt_file]['Confidence Intervals'][metric][0] for prompt_file in active)
+            for prompt_file in list(active):
+                if summaries[prompt_file]['Confidence Intervals'][metric][1] < best_lower:
+                    summaries[prompt_file]['Eliminated In Round'] = round_number
+                    active.remove(prompt_file)
+                    print(f"Round {round_number}: {prompt_file} is dominated on {metric} after {seen} images and is dropped.")
+
+        # Once a single prompt is left the comparison is decided
+        if len(active) <= 1:
+            break
+
+    return summaries
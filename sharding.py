@@ -0,0 +1,150 @@
+import argparse
+import hashlib
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from run_log import DEFAULT_RUNS_FOLDER, new_run_id
+
+SHARD_BY = ('image', 'pair')
+
+
+# Function to map a key to a stable 64-bit integer (the same on every machine and Python version, unlike hash())
+def stable_hash(key):
+    return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+class Shard:
+    """
+    One deterministic slice of the (prompt, image) work matrix.
+
+    With `by='image'` every prompt for an image lands on the same shard, so each image
+    is read, encoded and uploaded by exactly one worker; with `by='pair'` the prompt hash
+    is mixed in and the pairs spread evenly even when there are few images. Assignment
+    depends only on the (prompt text, image path) key, never on dataset order, so
+    workers agree on the split without talking to each other.
+    """
+
+    def __init__(self, index, count, by='image'):
+        if not 0 <= index < count:
+            raise ValueError(f"Shard index {index} is outside 0..{count - 1}")
+        if by not in SHARD_BY:
+            raise ValueError(f"Unknown shard key '{by}' (expected one of {', '.join(SHARD_BY)})")
+        self.index = index
+        self.count = count
+        self.by = by
+        self._image_mask = (None, None)  # (image_paths, mask) of the last image-keyed lookup
+
+    def __repr__(self):
+        return f"Shard({self.index}/{self.count}, by={self.by})"
+
+    def mask(self, prompt_hash, image_paths):
+        """Boolean array marking which of `image_paths` this shard owns for the given prompt."""
+        if self.by == 'image':
+            # The same for every prompt, so each list of images is hashed once
+            if self._image_mask[0] is not image_paths:
+                self._image_mask = (image_paths, self._owned(image_paths))
+            return self._image_mask[1]
+        return self._owned(f"{prompt_hash}:{image_path}" for image_path in image_paths)
+
+    def _owned(self, keys):
+        return np.fromiter((stable_hash(key) % self.count == self.index for key in keys), dtype=bool)
+
+
+# Function to parse "i/N" as given to prompt_eval's --shard flag
+def parse_shard(spec, by='image'):
+    try:
+        index, count = (int(part) for part in spec.split("/"))
+    except ValueError:
+        raise ValueError(f"Shard must look like INDEX/COUNT (e.g. 0/4), got '{spec}'")
+    return Shard(index, count, by)
+
+
+# Function to read one API key per line; blank lines and # comments are ignored
+def load_api_keys(api_keys_file):
+    try:
+        with open(api_keys_file, 'r') as f:
+            return [line.strip() for line in f if line.strip() and not line.startswith("#")]
+    except FileNotFoundError:
+        print(f"Error: The API keys file '{api_keys_file}' was not found.")
+        return []
+
+
+def launch_local_shards(num_shards, eval_args, run_id, runs_folder=DEFAULT_RUNS_FOLDER, api_keys=None, shard_by='image', merge=True):
+    """
+    Run `num_shards` prompt_eval workers as local processes, then merge their results.
+
+    Every worker gets `--shard i/N` and the same run id, so they all log into
+    runs/<run_id>/ and each one only requests its own slice. With `api_keys`, shard i
+    uses key i (mod the number of keys), letting each worker spend its own budget;
+    --rpm/--tpm in `eval_args` apply per worker. Worker output goes to
+    runs/<run_id>/shard-<i>.log. Returns the workers' exit codes.
+    """
+    run_folder = os.path.join(runs_folder, run_id)
+    os.makedirs(run_folder, exist_ok=True)
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "prompt_eval.py")] + list(eval_args)
+
+    workers = []
+    for index in range(num_shards):
+        env = dict(os.environ)
+        if api_keys:
+            env['OPENAI_API_KEY'] = api_keys[index % len(api_keys)]
+        log = open(os.path.join(run_folder, f"shard-{index}.log"), 'w')
+        shard_args = ['--run_id', run_id, '--runs_folder', runs_folder, '--shard', f"{index}/{num_shards}", '--shard_by', shard_by]
+        workers.append((index, log, subprocess.Popen(command + shard_args, env=env, stdout=log, stderr=subprocess.STDOUT)))
+    print(f"Started {num_shards} shard workers for run {run_id} (logs in {run_folder})")
+
+    start = time.time()
+    exit_codes = []
+    try:
+        for index, log, process in workers:
+            exit_codes.append(process.wait())
+            log.close()
+            status = "done" if process.returncode == 0 else f"failed with exit code {process.returncode}"
+            print(f"Shard {index}/{num_shards} {status} after {time.time() - start:.1f}s")
+    except KeyboardInterrupt:
+        # The workers got the same SIGINT and stop on their own; resume with the same run id
+        for _, _, process in workers:
+            process.wait()
+        print(f"\nInterrupted. Rerun with --run_id {run_id} to finish the remaining pairs.")
+        return [process.returncode for _, _, process in workers]
+
+    if merge:
+        if any(exit_codes):
+            print("Warning: Some shards failed; their missing pairs count as abstentions until rerun.")
+        subprocess.run(command + ['--resume', run_id, '--runs_folder', runs_folder, '--merge_shards'])
+    return exit_codes
+
+
+# Main function to launch local shard workers with their own API keys
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run a sharded prompt_eval on this machine. Arguments after '--' are passed to every prompt_eval worker, "
+                    "e.g. python sharding.py --num_shards 4 -- --dataset data.csv --prompts_folder prompts/")
+    parser.add_argument('--num_shards', type=int, required=True, help="Number of worker processes (shards).")
+    parser.add_argument('--run_id', type=str, default=None, help="Run shared by every shard (defaults to a timestamp); reuse it to resume.")
+    parser.add_argument('--runs_folder', type=str, default=DEFAULT_RUNS_FOLDER, help="Folder holding the per-run JSONL result logs.")
+    parser.add_argument('--shard_by', choices=SHARD_BY, default='image', help="'image' keeps all prompts for an image on one shard; 'pair' spreads (prompt, image) pairs.")
+    parser.add_argument('--api_keys_file', type=str, default=None, help="File with one API key per line; shard i uses line i.")
+    parser.add_argument('--no_merge', action='store_true', help="Only run the shards; merge later with prompt_eval.py --resume RUN_ID --merge_shards.")
+    parser.add_argument('eval_args', nargs=argparse.REMAINDER, help="Arguments for prompt_eval.py (after '--').")
+    args = parser.parse_args()
+
+    eval_args = args.eval_args[1:] if args.eval_args[:1] == ['--'] else args.eval_args
+    api_keys = None
+    if args.api_keys_file:
+        api_keys = load_api_keys(args.api_keys_file)
+        if not api_keys:
+            print(f"Error: No API keys in '{args.api_keys_file}'.")
+            sys.exit(1)
+
+    exit_codes = launch_local_shards(args.num_shards, eval_args, args.run_id or new_run_id(), runs_folder=args.runs_folder,
+                                     api_keys=api_keys, shard_by=args.shard_by, merge=not args.no_merge)
+    sys.exit(1 if any(exit_codes) else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+import os
+import sqlite3
+
+import numpy as np
+
+from response_cache import content_hash
+
+SIMILARITY_BACKENDS = ('tfidf', 'embeddings')
+DEFAULT_EMBEDDING_MODEL = "text-embedding-3-small"
+DEFAULT_EMBEDDING_CACHE = ".cache/embeddings.sqlite3"
+EMBEDDING_BATCH_SIZE = 512  # Texts per embeddings request
+REQUEST_TIMEOUT = 60
+
+
+# Function to compute the cosine similarity of each row of `left` with the same row of `right`
+def rowwise_cosine(left, right):
+    """Works on sparse or dense matrices; rows that are all zeros (empty text) score 0."""
+    if hasattr(left, 'multiply'):
+        dots = np.asarray(left.multiply(right).sum(axis=1)).ravel()
+        norms = np.sqrt(np.asarray(left.multiply(left).sum(axis=1)).ravel() * np.asarray(right.multiply(right).sum(axis=1)).ravel())
+    else:
+        dots = np.einsum('ij,ij->i', left, right)
+        norms = np.linalg.norm(left, axis=1) * np.linalg.norm(right, axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(norms > 0, dots / norms, 0.0)
+
+
+class EmbeddingCache:
+    """SQLite store of embedding vectors keyed by model and a hash of the text, so each text is embedded once."""
+
+    def __init__(self, path=DEFAULT_EMBEDDING_CACHE):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=30)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, model TEXT NOT NULL, vector BLOB NOT NULL)")
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(model, text):
+        return content_hash(f"{model}\n{text}")
+
+    def get_many(self, model, texts):
+        found = {}
+        keys = {self.make_key(model, text): text for text in texts}
+        key_list = list(keys)
+        for start in range(0, len(key_list), 500):  # Stay under SQLite's bound-parameter limit
+            chunk = key_list[start:start + 500]
+            rows = self._conn.execute(f"SELECT key, vector FROM embeddings WHERE key IN ({', '.join('?' * len(chunk))})", chunk)
+            for key, vector in rows:
+                found[keys[key]] = np.frombuffer(vector, dtype=np.float32)
+        return found
+
+    def put_many(self, model, vectors):
+        with self._conn:
+            self._conn.executemany("INSERT OR REPLACE INTO embeddings (key, model, vector) VALUES (?, ?, ?)",
+                                   [(self.make_key(model, text), model, np.asarray(vector, dtype=np.float32).tobytes()) for text, vector in vectors.items()])
+
+    def close(self):
+        self._conn.close()
+
+
+class SimilarityEngine:
+    """
+    Cosine similarity between many pairs of texts in one vectorized step.
+
+    With the 'tfidf' backend a single TfidfVectorizer is fitted once over the whole
+    corpus of a run (so IDF weights reflect every field being compared, not just the
+    two strings of one pair); each side of the pairs is transformed into one sparse
+    matrix and the row-wise cosine is taken without densifying. The 'embeddings'
+    backend embeds the texts with the OpenAI embeddings endpoint instead, fetching
+    only texts missing from the SQLite `embedding_cache`.
+    """
+
+    def __init__(self, backend='tfidf', embedding_model=DEFAULT_EMBEDDING_MODEL, embedding_cache=None, api_base=None):
+        if backend not in SIMILARITY_BACKENDS:
+            raise ValueError(f"Unknown similarity backend '{backend}' (expected one of {', '.join(SIMILARITY_BACKENDS)})")
+        self.backend = backend
+        self.embedding_model = embedding_model
+        self.embedding_cache = embedding_cache
+        self.api_base = (api_base or os.getenv("OPENAI_API_BASE", "https://api.openai.com/v1")).rstrip("/")
+        self._vectorizer = None
+        self._fitted = False
+
+    def fit(self, corpus):
+        """Fit the TF-IDF vocabulary once over every text of the run (a no-op for embeddings)."""
+        if self.backend == 'tfidf':
+            from sklearn.feature_extraction.text import TfidfVectorizer  # Loaded on first use; it dominates the import time of every command
+
+            try:
+                self._vectorizer = TfidfVectorizer().fit([text for text in corpus if text])
+            except ValueError:
+                self._vectorizer = None  # No usable words at all; every pair scores 0
+            self._fitted = True
+        return self
+
+    def pairwise(self, left, right):
+        """Cosine similarity of left[i] and right[i] for every i, as a float array."""
+        if len(left) != len(right):
+            raise ValueError("Both sides must hold the same number of texts")
+        if not left:
+            return np.zeros(0)
+        if self.backend == 'embeddings':
+            import requests
+
+            try:
+                vectors = self.embed(list(left) + list(right))
+                return rowwise_cosine(vectors[:len(left)], vectors[len(left):])
+            except requests.exceptions.RequestException as e:
+                print(f"Error: Embeddings request failed ({e}); comparing with TF-IDF instead.")
+                return SimilarityEngine().pairwise(left, right)
+        if not self._fitted:
+            self.fit(list(left) + list(right))
+        if self._vectorizer is None:
+            return np.zeros(len(left))
+        return rowwise_cosine(self._vectorizer.transform(left), self._vectorizer.transform(right))
+
+    def embed(self, texts):
+        """Return an (n, dimensions) array of embeddings, requesting only uncached, distinct texts."""
+        unique_texts = list(dict.fromkeys(texts))
+        vectors = self.embedding_cache.get_many(self.embedding_model, unique_texts) if self.embedding_cache else {}
+        missing = [text for text in unique_texts if text not in vectors]
+        for start in range(0, len(missing), EMBEDDING_BATCH_SIZE):
+            batch = missing[start:start + EMBEDDING_BATCH_SIZE]
+            fetched = dict(zip(batch, self._request_embeddings(batch)))
+            vectors.update(fetched)
+            if self.embedding_cache:
+                self.embedding_cache.put_many(self.embedding_model, fetched)
+        return np.vstack([vectors[text] for text in texts])
+
+    def _request_embeddings(self, texts):
+        import requests
+
+        response = requests.post(
+            f"{self.api_base}/embeddings",
+            headers={"Content-Type": "application/json", "Authorization": f"Bearer {os.getenv('OPENAI_API_KEY')}"},
+            json={"model": self.embedding_model, "input": [text or " " for text in texts]},  # The API rejects empty strings
+            timeout=REQUEST_TIMEOUT,
+        )
+        response.raise_for_status()
+        data = sorted(response.json()['data'], key=lambda item: item['index'])
+        return [np.asarray(item['embedding'], dtype=np.float32) for item in data]